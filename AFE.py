@@ -16,16 +16,232 @@ from my_utilities import millis, is_timeout, is_delay
 from my_utilities import e_ADC_CHANNEL, CommandStatus, ResetReason
 from my_utilities import p
 from my_utilities import VerbosityLevel
-from my_utilities import SensorChannel, AFECommandChannelMask, AFECommandAverage
+from my_utilities import SensorChannel, MeasurementStore, MeasurementRollups, AFECommandChannelMask, AFECommandAverage
+from my_utilities import CHANNEL_MASK_TABLE
 from my_utilities import extract_bracketed
 from my_utilities import rtc, rtc_synced, rtc_unix_timestamp
 from my_utilities import get_e_ADC_CHANNEL
 from my_utilities import convert_to_si
-from my_RxDeviceCAN import RxDeviceCAN
+from my_utilities import LatencyHistogram, ClockModel
+from my_RxDeviceCAN import RxDeviceCAN, RxFrame
+
+
+# Kinds of REPLY_DECODERS entries
+REPLY_NONE = 0  # acknowledged, nothing to decode
+REPLY_CHANNEL_CONFIG = 1  # (kind, struct format, size, channel config key), payload[0] is the channel mask
+REPLY_METHOD = 2  # (kind, AFEDevice method(self, frame, parsed_data)), no await
+REPLY_ASYNC = 3  # (kind, AFEDevice coroutine method(self, frame, parsed_data)), for decoders that log or await
+
+# Frame data offset of the value that follows the channel mask
+# (command, chunk info, channel mask, value)
+MASKED_VALUE_OFFSET = 3
+
+# parsed_data keys of the decoded channel values
+CHANNEL_KEYS = tuple("{}".format(e_ADC_CHANNEL.get(ch)) for ch in range(8))
+CHANNEL_BYTES_KEYS = tuple("{}_bytes".format(e_ADC_CHANNEL.get(ch)) for ch in range(8))
+
+
+class CommandFuture:
+    """
+    Handle returned by AFEDevice.enqueue_command(..., future=True). Awaiting
+    it gives the parsed reply (the retval dict of the command) or raises
+    uasyncio.TimeoutError when the command timed out or was dropped.
+    """
+
+    def __init__(self, command):
+        self.command = command
+        self.event = uasyncio.Event()
+        self.retval = None
+        self.error = None
+
+    def done(self):
+        return self.event.is_set()
+
+    def set_result(self, retval):
+        if not self.event.is_set():
+            self.retval = retval
+            self.event.set()
+
+    def set_error(self, error):
+        if not self.event.is_set():
+            self.error = error
+            self.event.set()
+
+    async def wait(self):
+        await self.event.wait()
+        if self.error is not None:
+            raise uasyncio.TimeoutError(self.error)
+        return self.retval
+
+    def __await__(self):
+        return self.wait().__await__()
+
+    def __iter__(self):  # MicroPython awaits objects through __iter__
+        return self.wait()
+
+
+async def wait_all(futures, return_exceptions=True):
+    """
+    Awaits CommandFutures of commands already sent in parallel, one after
+    another, so no task is created per future. Failed ones are returned as
+    their exception when return_exceptions is set, else the first raises.
+    """
+    results = []
+    for future in futures:
+        try:
+            results.append(await future.wait())
+        except uasyncio.TimeoutError as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+class CommandRecord:
+    """
+    One queued or sent command. Records are preallocated and reused (see
+    AFEDevice._new_record), each with its own 8-byte frame buffer; a frame
+    packed in advance (enqueue_frame) is referenced instead of copied.
+    Item access (cmd["retval"], cmd.get(...), "key" in cmd) is kept for
+    code written against the former dict; callbacks get to_dict().
+    """
+    __slots__ = ("command", "frame", "frame_len", "buf", "device_id", "can_address",
+                 "timeout_ms", "timestamp_ms", "timestamp_ms_enqueued", "can_timeout_ms",
+                 "status", "preserve", "timeout_start_on_send_ms", "timestamp_us_sent",
+                 "retval", "callback", "callback_error", "future", "chunk_last", "in_use",
+                 "tx_seq", "generation")
+    KEYS = ("command", "frame", "device_id", "can_address", "timeout_ms", "timestamp_ms",
+            "timestamp_ms_enqueued", "can_timeout_ms", "status", "preserve",
+            "timeout_start_on_send_ms", "timestamp_us_sent", "retval", "callback",
+            "callback_error", "future", "chunk_last")
+
+    def __init__(self):
+        self.buf = bytearray(8)
+        self.frame = self.buf
+        self.frame_len = 0
+        self.in_use = False  # taken by AFEDevice._new_record, until _release_record
+        self.tx_seq = 0
+        self.generation = 0  # bumped on every release, see AFEDevice._is_current
+        self.clear()
+
+    def clear(self):
+        """Drops the references a finished command holds."""
+        self.frame = self.buf
+        self.retval = None
+        self.callback = None
+        self.callback_error = None
+        self.future = None
+        self.chunk_last = None
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __contains__(self, key):
+        return key in self.KEYS
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def to_dict(self):
+        retval = {key: getattr(self, key) for key in self.KEYS}
+        retval["frame"] = bytearray(self.frame[:self.frame_len])
+        return retval
+
+    def copy(self):
+        return self.to_dict()
+
+    def __repr__(self):
+        return "<CommandRecord 0x{:02X} to AFE {}: {}>".format(
+            self.command, self.device_id, list(self.frame[:self.frame_len]))
+
+
+class CommandQueue:
+    """
+    Fixed-capacity FIFO ring of CommandRecords. push()/pop() are O(1);
+    put() waits on an Event while the ring is full and counts how often
+    and how long it waited.
+    """
+
+    def __init__(self, capacity):
+        self.slots = [None] * capacity
+        self.capacity = capacity
+        self.head = 0  # oldest record
+        self.count = 0
+        self.not_full = uasyncio.Event()
+        self.not_full.set()
+        self.pushed = 0
+        self.depth_max = 0
+        self.waits = 0
+        self.wait_ms_total = 0
+        self.wait_ms_max = 0
+
+    def __len__(self):
+        return self.count
+
+    def __bool__(self):
+        return self.count > 0
+
+    def __iter__(self):
+        for k in range(self.count):
+            yield self.slots[(self.head + k) % self.capacity]
+
+    def push(self, record):
+        if self.count >= self.capacity:
+            return False
+        self.slots[(self.head + self.count) % self.capacity] = record
+        self.count += 1
+        self.pushed += 1
+        if self.count > self.depth_max:
+            self.depth_max = self.count
+        if self.count >= self.capacity:
+            self.not_full.clear()
+        return True
+
+    async def put(self, record):
+        """push(), waiting for a free slot while the ring is full."""
+        if self.count >= self.capacity:
+            self.waits += 1
+            start_ms = time.ticks_ms()
+            while self.count >= self.capacity:
+                self.not_full.clear()
+                await self.not_full.wait()
+            wait_ms = time.ticks_diff(time.ticks_ms(), start_ms)
+            self.wait_ms_total += wait_ms
+            if wait_ms > self.wait_ms_max:
+                self.wait_ms_max = wait_ms
+        self.push(record)
+
+    def pop(self):
+        if self.count == 0:
+            return None
+        record = self.slots[self.head]
+        self.slots[self.head] = None
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        self.not_full.set()
+        return record
+
+    def get_stats(self):
+        return {
+            "depth": self.count,
+            "capacity": self.capacity,
+            "depth_max": self.depth_max,
+            "pushed": self.pushed,
+            "waits": self.waits,
+            "wait_ms_total": self.wait_ms_total,
+            "wait_ms_max": self.wait_ms_max,
+        }
 
 
 class AFEDevice:
-    def __init__(self, can_interface: RxDeviceCAN, device_id, logger: JSONLogger, config_path=None):
+    def __init__(self, can_interface: RxDeviceCAN, device_id, logger: JSONLogger, config_path=None, history_depth=8,
+                 rollup_resolutions=MeasurementRollups.RESOLUTIONS):
         if not isinstance(can_interface, RxDeviceCAN):
             raise RuntimeError(
                 "can_interface must be an instance of RxDeviceCAN")
@@ -44,7 +260,11 @@ class AFEDevice:
 
         self.can_address = device_id << 2
         self.configuration = {}
-        self.is_online = False
+        self.online_callback = None  # set by AFERegistry, called as (device_id, online)
+        self.schedule_callback = None  # set by HUBDevice, called with self by request_manage()
+        self.manage_requested = False
+        self.schedule_seq = 0  # HUBDevice deadline entry that is current for this AFE
+        self._is_online = False
         self.total_channels = 8
         self.firmware_version = None
         self.version_checked = False
@@ -62,13 +282,30 @@ class AFEDevice:
         self.temperatureLoop_master_is_enabled = False
         self.temperatureLoop_slave_is_enabled = False
 
-        self.to_execute = []
+        # Queued commands: ring of executed_max_len CommandRecords; finished
+        # records go back to free_records (see _new_record/_release_record)
+        self.executed_max_len = 100
+        self.to_execute = CommandQueue(self.executed_max_len)
+        self.free_records = [CommandRecord() for _ in range(self.executed_max_len + 8)]
         self.execute_timestamp = 0
         self.executing = None
-
-        self.executed_max_len = 100
-        self.save_periodic_data = True
-        self.periodic_data = {}
+        # Commands sent while earlier ones still wait for their reply; with
+        # pipeline_depth 1 only self.executing is used (stop-and-wait, paced
+        # by use_tx_delay / tx_timeout_ms); set it higher to pipeline
+        self.pipeline_depth = 1
+        self.in_flight = []
+
+        # Log every periodic set (get_periodic_data() at MEASUREMENT level);
+        # off by default, the sets are kept in self.measurements anyway
+        self.save_periodic_data = False
+        # getSensorDataSi_periodic values, history_depth sets per channel;
+        # get_periodic_data() / get_latest_status() build the dict views
+        self.measurements = MeasurementStore(self.total_channels, history_depth)
+        self.periodic_timestamp_ms = 0  # HUB ms when the newest set started
+        self.periodic_sets = 0
+        # 1 s / 1 min / 1 h trend of the "last" values, bucketed by RTC time
+        # of arrival; rollup_resolutions None or () disables it
+        self.rollups = MeasurementRollups(self.total_channels, rollup_resolutions) if rollup_resolutions else None
 
         self.debug_machine_control_msg = [{}, {}]
 
@@ -85,6 +322,11 @@ class AFEDevice:
         self.afe_can_watchdog_timestamp_ms = 0
         self.afe_can_watchdog_timeout_ms = 20*1000
 
+        # Offset/drift fit of the AFE clock from the getTimestamp replies of
+        # the watchdog; polled fast only while the fit is uncertain
+        self.use_clock_model = True
+        self.clock = ClockModel()
+
         self.init_timestamp_ms = 0
         self.init_wait_ms = 5000
 
@@ -94,10 +336,88 @@ class AFEDevice:
             {"timestamp_ms": None, "value": None} for x in range(self.total_channels)]
 
         self.parsed_data = {}
+        # Newest value of every parsed_data key of the other replies; the
+        # periodic sets stay in self.measurements, get_latest_status() merges both
         self.latest_status = {}
+
+        # Round-trip time per AFECommand (send -> last reply frame off the FIFO)
+        # and delay between a frame leaving the FIFO and being decoded
+        self.use_latency_histograms = True
+        self.rtt_histograms = {}
+        self.rx_delay_histogram = LatencyHistogram()
+
+        # Own receive queue and task, see start_rx_task()
+        self.rx_queue = None
+        self.rx_task = None
         
         self.init_after_restart()
 
+    @property
+    def is_online(self):
+        return self._is_online
+
+    @is_online.setter
+    def is_online(self, online):
+        self._is_online = online
+        if self.online_callback is not None:
+            self.online_callback(self.device_id, online)
+
+    def request_manage(self):
+        """Asks the HUB to run manage_state() on its next pass (new command, reply, state change)."""
+        if self.schedule_callback is not None and not self.manage_requested:
+            self.manage_requested = True
+            self.schedule_callback(self)
+
+    def next_due_ms(self):
+        """
+        Milliseconds until manage_state() has timed work to do (<= 0: due now),
+        None if it only has to run again after new input, see request_manage().
+        """
+        now = millis()
+        due = None
+        if self.use_afe_can_watchdog:
+            due = self.sync_interval_ms() + 1 - time.ticks_diff(now, self.afe_can_watchdog_timestamp_ms)
+        if not self.is_configured and self.is_configuration_started and self.configuration_timeout_ms:
+            d = self.configuration_timeout_ms + 1 - time.ticks_diff(now, self.configuration_start_timestamp_ms)
+            if due is None or d < due:
+                due = d
+        for cmd in self.in_flight:
+            if cmd.timeout_ms:
+                d = cmd.timeout_ms + 1 - time.ticks_diff(now, cmd.timestamp_ms)
+                if due is None or d < due:
+                    due = d
+        if self.executing is not None:
+            if self.executing.timeout_ms:
+                d = self.executing.timeout_ms + 1 - time.ticks_diff(now, self.executing.timestamp_ms)
+                if due is None or d < due:
+                    due = d
+        elif self.pipeline_depth > 1:
+            if self.to_execute and len(self.in_flight) < self.pipeline_depth:
+                due = 0
+        elif self.to_execute:
+            d = self.tx_timeout_ms - time.ticks_diff(now, self.execute_timestamp) if self.use_tx_delay else 0
+            if due is None or d < due:
+                due = d
+        return due
+
+    def sync_interval_ms(self):
+        """
+        Period of the getTimestamp watchdog: a tenth of the AFE CAN watchdog
+        timeout, or the clock model's poll interval capped at a quarter of it.
+        """
+        if not self.use_clock_model:
+            return int(round(self.afe_can_watchdog_timeout_ms/10.0))
+        return min(self.clock.poll_interval_ms, self.afe_can_watchdog_timeout_ms // 4)
+
+    def get_clock_stats(self):
+        return self.clock.to_dict()
+
+    def add_clock_timestamps(self, data):
+        """Adds the HUB ticks and RTC unix time of data["timestamp_ms"] (AFE clock) once the clock is fitted."""
+        if self.use_clock_model and self.clock.is_fitted():
+            data["hub_timestamp_ms"] = self.clock.to_hub_ms(data["timestamp_ms"])
+            data["unix_timestamp"] = self.clock.to_unix(data["timestamp_ms"])
+
     def default_log_dict(self, extra_fields=None, timestamp_ms=None, unix_timestamp=None):
         toReturn = {
             "device_id": self.device_id,
@@ -111,7 +431,7 @@ class AFEDevice:
 
     def trim_dict_for_logger(self, executing):
         trimmed = executing.copy()
-        keys_to_trim = ["frame", "callback", "callback_error"]
+        keys_to_trim = ["frame", "callback", "callback_error", "future"]
         for key in keys_to_trim:
             trimmed.pop(key, None)
         return trimmed
@@ -124,9 +444,11 @@ class AFEDevice:
         self.configuration_timeout_ms = timeout_ms
         self.configuration_start_timestamp_ms = millis()
         self.is_configured = False
+        self.request_manage()
 
     def end_configuration(self, success=True):
         self.is_configured = success
+        self.request_manage()
 
     async def callback_is_configured(self, kwargs=None):  # Changed to async def
         self.afe_first_configured = {
@@ -142,17 +464,18 @@ class AFEDevice:
         self.channels = [SensorChannel(x) for x in range(self.total_channels)]
         self.is_configured = False
         self.is_configuration_started = False
-        self.executing = None
-        self.to_execute = []
+        self.clear_commands("AFE {}: restarted".format(self.device_id))
         self.version_checked = False
         self.periodic_measurement_download_is_enabled = False
         self.blink_is_enabled = False
         self.temperatureLoop_master_is_enabled = False
         self.temperatureLoop_slave_is_enabled = False
-        self.periodic_data = {}
+        self.measurements.clear_staged()
         self.debug_machine_control_msg = [{}, {}]
         self.debug_machine_control_msg_last = [{}, {}]
         self.afe_first_configured = None
+        self.clock.reset()
+        self.request_manage()
 
     def update_output(self, output, value_name, value, channel=None):
         if channel is None:
@@ -259,15 +582,7 @@ class AFEDevice:
             return None
 
     def unmask_channel(self, masked_channel):
-        masked_channel = int(masked_channel & 0xFF)
-        if masked_channel == 0:
-            return []
-        else:
-            channels = []
-            for i in range(8):
-                if 0x01 & (masked_channel >> i):
-                    channels.append(i)
-            return channels
+        return CHANNEL_MASK_TABLE[masked_channel & 0xFF]
 
     def getChannelName(self, number: int) -> str:
         return e_ADC_CHANNEL.get(number, "Unknown")
@@ -277,44 +592,109 @@ class AFEDevice:
     def prepare_command(self, command, data=None, chunk=1, max_chunks=1, timeout_ms=None,
                         preserve=False,
                         # startKeepOutput=False, outputRestart=False,
-                        can_timeout_ms=None, callback=None, callback_error=None, **kwargs):
-        if data is None:
-            data = []
-        elif isinstance(data, int):
-            data = [data]
-        elif not (isinstance(data, list) and all(isinstance(i, int) for i in data)):
-            data = list(map(int, data))
+                        can_timeout_ms=None, callback=None, callback_error=None, frame=None,
+                        record=None, **kwargs):
+        cmd = record if record is not None else CommandRecord()
+        if frame is None:
+            buf = cmd.buf
+            buf[0] = command
+            buf[1] = (max_chunks << 4) | chunk
+            n = 2
+            if data is not None:
+                if isinstance(data, int):
+                    data = (data,)
+                for value in data:
+                    if n >= 8:
+                        break
+                    buf[n] = int(value)
+                    n += 1
+            cmd.frame = buf
+            cmd.frame_len = n
+        else:
+            cmd.frame = frame
+            cmd.frame_len = len(frame)
         timestamp_ms = millis()
-        chunk_info = (max_chunks << 4) | chunk
-        frame = bytearray([command, chunk_info] + data[:6])
-        return {
-            "command": command,  # command
-            "frame": frame,  # payload
-            "device_id": self.device_id,  # AFE ID
-            "can_address": self.can_address,  # can address
-            "timeout_ms": self.default_command_timeout_ms if timeout_ms is None else timeout_ms,
-            "timestamp_ms": timestamp_ms,
-            "timestamp_ms_enqueued": timestamp_ms,
-            "can_timeout_ms": self.default_can_timeout_ms if can_timeout_ms is None else can_timeout_ms,
-            "status": CommandStatus.NONE,
-            "preserve": preserve,
-            "timeout_start_on_send_ms": None,  # if not None then timestamp_ms is restarted
-            "retval": None,
-            "callback": callback,
-            "callback_error": callback_error
-        }
-
-    async def _enqueue_command(self, command, data=None, **kwargs):
-        while len(self.to_execute) > self.executed_max_len:
-            await uasyncio.sleep_ms(1)
-        self.to_execute.append(
-            self.prepare_command(command, data, **kwargs)
-        )
-        return None
+        cmd.command = command
+        cmd.device_id = self.device_id
+        cmd.can_address = self.can_address
+        cmd.timeout_ms = self.default_command_timeout_ms if timeout_ms is None else timeout_ms
+        cmd.timestamp_ms = timestamp_ms
+        cmd.timestamp_ms_enqueued = timestamp_ms
+        cmd.can_timeout_ms = self.default_can_timeout_ms if can_timeout_ms is None else can_timeout_ms
+        cmd.status = CommandStatus.NONE
+        cmd.preserve = preserve
+        cmd.timeout_start_on_send_ms = None  # if not None then timestamp_ms is restarted
+        cmd.timestamp_us_sent = None  # time.ticks_us() when handed to the CAN interface
+        cmd.retval = None
+        cmd.callback = callback
+        cmd.callback_error = callback_error
+        cmd.future = None
+        cmd.chunk_last = None  # last reply chunk matched to this command (pipelined)
+        cmd.tx_seq = 0  # TX ring sequence number of the sent frame, 0 once known sent
+        return cmd
+
+    def clear_commands(self, error="cleared"):
+        """Drops queued, executing and in-flight commands; their futures fail with error."""
+        for cmd in self.in_flight + ([self.executing] if self.executing else []):
+            if cmd.future is not None:
+                cmd.future.set_error(error)
+            self._release_record(cmd)
+        self.executing = None
+        self.in_flight = []
+        cmd = self.to_execute.pop()
+        while cmd is not None:
+            if cmd.future is not None:
+                cmd.future.set_error(error)
+            self._release_record(cmd)
+            cmd = self.to_execute.pop()
+
+    def _new_record(self):
+        cmd = self.free_records.pop() if self.free_records else CommandRecord()
+        cmd.in_use = True
+        return cmd
+
+    def _is_current(self, cmd, generation):
+        """False once cmd was released, it may be reissued for another command since."""
+        return cmd.in_use and cmd.generation == generation
+
+    def _release_record(self, cmd):
+        if not cmd.in_use:
+            return  # Already released, it must not be in free_records twice
+        cmd.in_use = False
+        cmd.generation = (cmd.generation + 1) & 0xFFFF
+        cmd.clear()
+        if len(self.free_records) < self.executed_max_len + 8:
+            self.free_records.append(cmd)
+
+    async def _enqueue_command(self, command, data=None, future=False, **kwargs):
+        cmd = self.prepare_command(command, data, record=self._new_record(), **kwargs)
+        if future:
+            cmd.future = CommandFuture(command)
+        if not self.to_execute.push(cmd):
+            await self.to_execute.put(cmd)
+        self.request_manage()
+        self.can_interface.wake()
+        return cmd.future
+
+    def get_queue_stats(self):
+        """Depth and enqueue wait statistics of the command ring."""
+        stats = self.to_execute.get_stats()
+        stats["in_flight"] = len(self.in_flight) + (self.executing is not None)
+        stats["free_records"] = len(self.free_records)
+        return stats
 
     async def enqueue_command(self, command, data=None, **kwargs):
+        """
+        Queues a command. With future=True returns a CommandFuture resolving
+        to the parsed reply, otherwise None; callback and callback_error
+        still work in both cases.
+        """
         return await self._enqueue_command(command, data, **kwargs)
 
+    async def enqueue_frame(self, frame, **kwargs):
+        """Enqueues a frame packed in advance (command byte first), sent as is."""
+        return await self._enqueue_command(frame[0], frame=frame, **kwargs)
+
     async def enqueue_gpio_set(self, gpio, state, **kwargs):
         return await self.enqueue_command(AFECommand.writeGPIO,
                                           [gpio.port, gpio.pin, state], **kwargs)
@@ -336,21 +716,53 @@ class AFEDevice:
             command, [channel] + list(struct.pack('<I', value)), **kwargs)
 
     async def executing_error_handler(self):
-        self.executing["status"] = CommandStatus.ERROR
+        cmd = self.executing
+        if cmd is None:
+            return
+        self.executing = None  # Before any await, a new command may be issued meanwhile
+        await self.command_error_handler(cmd)
+
+    async def command_error_handler(self, cmd):
+        """
+        Marks cmd failed (timeout or not sent), logs it and runs its
+        callback_error. The caller has already taken cmd out of
+        executing / in_flight; the record is released before the first
+        await, so a late reply or clear_commands() cannot release it again.
+        """
+        cmd.status = CommandStatus.ERROR
+        if cmd.future is not None:
+            cmd.future.set_error("AFE {}: command 0x{:02X} timed out".format(self.device_id, cmd.command))
+        executing = cmd.to_dict()
+        callback_error = cmd.callback_error
+        self._release_record(cmd)
         await self.logger.log(VerbosityLevel["ERROR"],
                               self.default_log_dict(
-            {"error": "TIMEOUT", "executing": self.trim_dict_for_logger(self.executing)}))
-        if "callback_error" in self.executing:
-            try:
-                if self.executing["callback_error"] is not None and callable(self.executing["callback_error"]):
-                    await p.print("Creating task for callback_error: {}".format(
-                        self.executing["callback_error"]))
-                    # If callback_error can be async, create a task for it
-                    uasyncio.create_task(self.executing["callback_error"](
-                        {"afe": self, "afe_id": self.device_id, "executing": self.executing}))
-            except Exception as e:
-                await p.print("AFE executing_error_handler error invoking callback_error: {}".format(e))
-        self.executing = None
+            {"error": "TIMEOUT", "executing": self.trim_dict_for_logger(executing)}))
+        try:
+            if callback_error is not None and callable(callback_error):
+                await p.print("Creating task for callback_error: {}".format(
+                    callback_error))
+                # If callback_error can be async, create a task for it
+                uasyncio.create_task(callback_error(
+                    {"afe": self, "afe_id": self.device_id, "executing": executing}))
+        except Exception as e:
+            await p.print("AFE command_error_handler error invoking callback_error: {}".format(e))
+
+    def _tx_failed(self, cmd):
+        """
+        True when the CAN interface dropped the frame of cmd because no
+        mailbox got free in time; the command then fails without waiting
+        for its reply timeout.
+        """
+        seq = cmd.tx_seq
+        if not seq or not self.can_interface.is_tx_done(seq):
+            return False
+        cmd.tx_seq = 0
+        return self.can_interface.is_tx_failed(seq)
+
+    def is_idle(self):
+        """True when no command is queued, executing or waiting for its reply."""
+        return not self.to_execute and self.executing is None and not self.in_flight
 
     def request_new_file(self):
         self.logger.requestNewFile()
@@ -359,18 +771,26 @@ class AFEDevice:
         self.logger.requestRenameFile(new_name_suffix)
 
     async def execute(self, _):
+        if self.pipeline_depth > 1:
+            await self.execute_pipelined()
+            return
         if self.to_execute and self.executing is None:
             self.execute_timestamp = millis()
-            cmd = self.to_execute.pop(0)
+            cmd = self.to_execute.pop()
             self.executing = cmd
-            self.executing["status"] = CommandStatus.IDLE
-            if self.executing["timeout_start_on_send_ms"] is not None:
-                self.executing["timestamp_ms"] = millis()
-                self.executing["timeout_ms"] = self.executing["timeout_start_on_send_ms"]
+            cmd.status = CommandStatus.IDLE
+            if cmd.timeout_start_on_send_ms is not None:
+                cmd.timestamp_ms = millis()
+                cmd.timeout_ms = cmd.timeout_start_on_send_ms
+            cmd.timestamp_us_sent = time.ticks_us()
+            generation = cmd.generation
             try:
-                if await self.can_interface.send(
-                        cmd.get("frame"), cmd.get("can_address"), cmd.get("can_timeout_ms", self.default_command_timeout_ms)):
-                    await self.executing_error_handler()
+                if await self.can_interface.send(cmd.frame, cmd.can_address, cmd.can_timeout_ms, cmd.frame_len):
+                    # Not already answered, cleared or reissued during send()
+                    if self.executing is cmd and self._is_current(cmd, generation):
+                        await self.executing_error_handler()
+                elif self.executing is cmd and self._is_current(cmd, generation):
+                    cmd.tx_seq = self.can_interface.tx_last_seq
             except Exception as e:
                 # Changed to await p.print
                 await p.print("Error executing command {} -> {} : {}".format(e, type(cmd), cmd))
@@ -379,7 +799,83 @@ class AFEDevice:
                                       self.default_log_dict(
                     {"debug": "Sending {}".format(cmd)}))
 
-    async def _handle_get_subdevice_status(self, target_status_list, chunk_id, chunk_payload):
+    async def execute_pipelined(self):
+        """
+        Sends queued commands until pipeline_depth of them wait for a reply.
+        Each one keeps its own timeout, see manage_state().
+        """
+        while self.to_execute and len(self.in_flight) < self.pipeline_depth:
+            self.execute_timestamp = millis()
+            cmd = self.to_execute.pop()
+            cmd.status = CommandStatus.IDLE
+            cmd.chunk_last = None
+            if cmd.timeout_start_on_send_ms is not None:
+                cmd.timestamp_ms = millis()
+                cmd.timeout_ms = cmd.timeout_start_on_send_ms
+            cmd.timestamp_us_sent = time.ticks_us()
+            self.in_flight.append(cmd)
+            generation = cmd.generation
+            try:
+                if await self.can_interface.send(cmd.frame, cmd.can_address, cmd.can_timeout_ms, cmd.frame_len):
+                    # Not already answered, cleared or reissued during send()
+                    if cmd in self.in_flight and self._is_current(cmd, generation):
+                        self.in_flight.remove(cmd)
+                        await self.command_error_handler(cmd)
+                elif cmd in self.in_flight and self._is_current(cmd, generation):
+                    cmd.tx_seq = self.can_interface.tx_last_seq
+            except Exception as e:
+                await p.print("Error executing command {} -> {} : {}".format(e, type(cmd), cmd))
+
+    def _reply_owner(self, command, chunk_id, mask=None):
+        """
+        The command a reply frame belongs to: self.executing, or the oldest
+        in-flight command with this code, preferring one whose reply is
+        already under way with an earlier chunk. With mask (the channel mask
+        echoed by a *_byMask command) only a command sent with that mask
+        qualifies.
+        """
+        if self.executing is not None:
+            return self.executing if command == self.executing.command else None
+        owner = None
+        for cmd in self.in_flight:
+            if cmd.command != command:
+                continue
+            if mask is not None and cmd.frame_len > 2 and cmd.frame[2] != mask:
+                continue
+            chunk_last = cmd.chunk_last
+            if chunk_last is not None:
+                if chunk_id > chunk_last:
+                    return cmd
+            elif owner is None:
+                owner = cmd
+        return owner
+
+    def _complete_command(self, cmd, frame):
+        """
+        Finishes cmd on the last chunk of its reply, before any await: a
+        timeout in manage_state() could otherwise fail and reuse the record
+        meanwhile. Returns (callback, dict of the command), the dict only
+        when the callback or the preserve log needs it.
+        """
+        cmd.status = CommandStatus.RECIEVED
+        if self.use_latency_histograms and cmd.timestamp_us_sent is not None:
+            self.record_rtt(cmd.command, time.ticks_diff(frame.timestamp_us, cmd.timestamp_us_sent))
+        callback = cmd.callback if callable(cmd.callback) else None
+        done = cmd.to_dict() if callback is not None or cmd.preserve == True else None
+        if cmd.future is not None:
+            cmd.future.set_result(cmd.retval)
+        self._reply_done(cmd)
+        self.request_manage()  # Next command may go out
+        return callback, done
+
+    def _reply_done(self, cmd):
+        if cmd is self.executing:
+            self.executing = None
+        elif cmd in self.in_flight:
+            self.in_flight.remove(cmd)
+        self._release_record(cmd)
+
+    async def _handle_get_subdevice_status(self, target_status_list, frame):
         """
         Handles the processing of getSubdeviceStatus command responses.
 
@@ -391,62 +887,125 @@ class AFEDevice:
         Args:
             target_status_list (list): A list of dictionaries (typically of size 2,
                                        for master and slave) to store the parsed status.
-            chunk_id (int): The chunk ID from the CAN message, used to determine
-                            which specific status field is being transmitted.
-            chunk_payload (list): The payload bytes from the CAN message.
+            frame (RxFrame): The received frame; its chunk ID determines which
+                             specific status field is being transmitted.
         """
-        chunk_id_mod = chunk_id % 13
+        chunk_id_mod = frame.chunk_id % 13
+        chunk_payload = frame.payload
         for uch in self.unmask_channel(chunk_payload[0]):
             if chunk_id_mod == 0: # Voltage
                 target_status_list[uch] = {}  # Clear msg for this subdevice
                 target_status_list[uch]["channel"] = "master" if uch == 0 else "slave"
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage"] = value
             elif chunk_id_mod == 1: # Voltage in bytes
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage_bytes"] = value
             elif chunk_id_mod == 2: # Ramp Target voltage
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage_target"] = value
             elif chunk_id_mod == 3: # Ramp Target voltage in bytes
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage_target_bytes"] = value
             elif chunk_id_mod == 4: # Ramp current voltage
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage_current"] = value
             elif chunk_id_mod == 5: # Ramp current voltage in bytes
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["voltage_current_bytes"] = value
             elif chunk_id_mod == 6: # Average temperature
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["temperature_avg"] = value
             elif chunk_id_mod == 7: # Last temperature in bytes
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["temperature_last_bytes"] = value
             elif chunk_id_mod == 8: # Old temperature
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["temperature_old"] = value
             elif chunk_id_mod == 9: # V offset
-                value = self.bytes_to_float(chunk_payload[1:])
+                value = frame.float_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["V_offset"] = value
             elif chunk_id_mod == 10: # Enabled?
                 target_status_list[uch]["temp_loop"] = "enabled" if chunk_payload[1] else "disabled"
             elif chunk_id_mod == 11: # Ramp target reached
                 target_status_list[uch]["ramp_target_reached"] = "true" if chunk_payload[1] else "false"
             elif chunk_id_mod == 12: # Timestamp
-                value = self.bytes_to_u32(chunk_payload[1:])
+                value = frame.u32_at(MASKED_VALUE_OFFSET)
                 target_status_list[uch]["timestamp_ms"] = value
 
+    def record_rtt(self, command, rtt_us):
+        if rtt_us < 0:
+            return  # Reply received before this command was sent
+        histogram = self.rtt_histograms.get(command)
+        if histogram is None:
+            histogram = LatencyHistogram()
+            self.rtt_histograms[command] = histogram
+        histogram.record(rtt_us)
+
+    def get_latency_stats(self):
+        """Command round-trip and RX decode-delay histograms, keyed by command as "0x05"."""
+        return {
+            "rtt": {"0x{:02X}".format(command): histogram.to_dict()
+                    for command, histogram in self.rtt_histograms.items()},
+            "rx_delay": self.rx_delay_histogram.to_dict(),
+        }
+
+    def reset_latency_stats(self):
+        self.rtt_histograms = {}
+        self.rx_delay_histogram.reset()
+
+    def start_rx_task(self):
+        """
+        Registers a per-AFE receive queue on the CAN interface and starts the
+        task that processes it, so this AFE's traffic is decoded independently
+        of the other AFEs.
+        """
+        if self.rx_queue is None:
+            self.rx_queue = self.can_interface.register_afe(self.device_id)
+        if self.rx_task is None:
+            self.rx_task = uasyncio.create_task(self.rx_loop())
+
+    def stop_rx_task(self):
+        queue = self.rx_queue
+        self.rx_queue = None
+        self.rx_task = None
+        if queue is not None:
+            self.can_interface.unregister_afe(self.device_id)
+
+    async def rx_loop(self):
+        queue = self.rx_queue
+        while self.rx_queue is queue:
+            frame = queue.borrow()
+            if frame is None:
+                await queue.wait()
+                continue
+            try:
+                await self.process_received_frame(frame)
+            except Exception as e:
+                await p.print("AFE {} rx_loop error: {}".format(self.device_id, e))
+            finally:
+                queue.release()
+
     async def process_received_data(self, received_data):  # Changed to async def
+        """Process a get()-style [id, is_extended, fmi, data] message (allocates a frame)."""
+        await self.process_received_frame(RxFrame.from_message(received_data))
+
+    async def process_received_frame(self, frame: RxFrame):
+        """
+        Process one pre-decoded frame borrowed from RxDeviceCAN.
+
+        frame.payload is a view into the RX ring buffer, so values must be
+        decoded here and never stored by reference.
+        """
         command = None
         chunk_id = None
         max_chunks = None
-        chunk_payload = []
         parsed_data = self.parsed_data
+        if self.use_latency_histograms:
+            self.rx_delay_histogram.record(time.ticks_diff(time.ticks_us(), frame.timestamp_us))
         if True:
-            data_bytes = list(bytes(received_data[3]))
-            device_id = (received_data[0] >> 2) & 0xFF
-            msg_from_slave = (received_data[0] >> 10) & 0x001
+            device_id = frame.afe_id
+            msg_from_slave = frame.from_slave
             if msg_from_slave != 1:
                 await self.logger.log(VerbosityLevel["WARNING"],
                                       self.default_log_dict({"debug": "Not from slave"}))
@@ -455,307 +1014,55 @@ class AFEDevice:
                 return
 
             # Ensure the payload has at least 2 bytes for command and chunk_info
-            if len(data_bytes) < 2:
+            if frame.dlc < 2:
                 await self.logger.log(VerbosityLevel["ERROR"],
-                                      self.default_log_dict({"error": "Received CAN message with payload less than 2 bytes", "payload": data_bytes}))
+                                      self.default_log_dict({"error": "Received CAN message with payload less than 2 bytes", "payload": list(frame.data)}))
                 return  # Skip processing this invalid message
 
-            command = int(data_bytes[0])
-            chunk_id = int(data_bytes[1] & 0x0F)
-            max_chunks = int((data_bytes[1] >> 4) & 0x0F)
-            chunk_payload = data_bytes[2:]
-            await self.logger.log(VerbosityLevel["DEBUG"],
-                                  self.default_log_dict({"debug": "R: ID:{}; Command: 0x{:02X}: {}".format(
-                                      device_id, command, data_bytes)}))
-
-            if command == AFECommand.getSerialNumber:
-                await self.logger.log(VerbosityLevel["WARNING"],
+            command = frame.command
+            chunk_id = frame.chunk_id
+            max_chunks = frame.max_chunks
+            if VerbosityLevel["DEBUG"] <= self.logger.verbosity_level:
+                await self.logger.log(VerbosityLevel["DEBUG"],
                                       self.default_log_dict({"debug": "R: ID:{}; Command: 0x{:02X}: {}".format(
-                                          device_id, command, data_bytes)}))
-                chunk_data = self.bytes_to_u32(chunk_payload)
-                if chunk_id == 0:
-                    self.unique_id_str = None
-                    self.unique_id = [0,0,0]
-                    self.output = {}
-                self.unique_id[chunk_id] = chunk_data
-                if chunk_id == max_chunks:
-                    self.is_online = True
-                    self.current_command = None
-                    uid0 = 0x001E0028
-                    uid1 = 0x46415716
-                    uid2 = 0x20353634
-                    self.unique_id_str = "".join(
-                        "{:08X}".format(b) for b in self.unique_id)
-                    await self.logger.log(VerbosityLevel["INFO"],
-                                          self.default_log_dict(
-                        {"info": {"UID": self.unique_id_str}}))
-                    parsed_data["unique_id_str"] = self.unique_id_str
-                    self.configuration["UID"] = self.unique_id_str
-
-            elif command == AFECommand.getVersion:
-                self.firmware_version = int("".join(map(str, chunk_payload)))
-                self.version_checked = True
-                parsed_data["version"] = self.firmware_version
-
-            elif command == AFECommand.resetAll:
-                self.init_after_restart()
-                await self.logger.log(VerbosityLevel["ERROR"],
-                                      self.default_log_dict(
-                    {"error": "AFE {} was restared! Reason {}".format(device_id, ResetReason[chunk_payload[0]])}))
-                await self.logger.sync()
+                                          device_id, command, list(frame.data))}))
 
-            elif command == AFECommand.startADC:
-                pass
-
-            elif command == AFECommand.getTimestamp:
-                HUB_timestamp_ms = millis()
-                AFE_timestamp_ms = self.bytes_to_u32(
-                    chunk_payload[1:])
-                self.last_sync_afe_timestamp_ms = AFE_timestamp_ms
-                parsed_data["AFE_timestamp_ms"] = AFE_timestamp_ms
-                parsed_data["HUB_timestamp_ms"] = HUB_timestamp_ms
-
-            elif command == AFECommand.getSyncTimestamp:
-                if chunk_id == 0:
-                    HUB_timestamp_ms = millis()
-                    AFE_timestamp_ms = self.bytes_to_u32(
-                        chunk_payload[1:])
-                    self.last_sync_afe_timestamp_ms = AFE_timestamp_ms
-                    parsed_data["AFE_timestamp_ms"] = AFE_timestamp_ms
-                    parsed_data["HUB_timestamp_ms"] = HUB_timestamp_ms
-                elif chunk_id == 1:
-                    parsed_data["msg_recieved_by_AFE_timestamp_ms"] = self.bytes_to_u32(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.resetCAN:
-                reason = "unknown"
-                AFE_timestamp_ms = None
-                if len(data_bytes) == 3: # AFE was restarted probably by hardware
-                    reason = ResetReason[data_bytes[2]]
-                    AFE_timestamp_ms = None
-                    self.init_after_restart()
-                elif len(data_bytes) == 7: # AFE was restarted during runtime
-                    AFE_timestamp_ms = self.bytes_to_u32(data_bytes[2:6])
-                    reason = "runtime"
-                retval = {"reason": "AFE CAN Error {}".format(reason), "timestamp_ms": millis()}
-                if AFE_timestamp_ms is not None:
-                    retval["timestamp_ms"] = AFE_timestamp_ms
-                await self.logger.log(VerbosityLevel["ERROR"],
-                                      self.default_log_dict({
-                                          "error": "AFE {} CAN bus reset".format(device_id),
-                                          "retval": self.trim_dict_for_logger(retval)
-                                      }))
-            elif command == AFECommand.getSubdeviceStatus:
-                await self._handle_get_subdevice_status(self.debug_machine_control_msg_last, chunk_id, chunk_payload)
-                if chunk_id == max_chunks:
-                    await p.print("XXXX", self.debug_machine_control_msg_last)
-
-            elif command == AFECommand.setTemperatureLoopForChannelState_byMask_asStatus:
-                pass
-
-            elif command == AFECommand.getSensorDataSi_last_byMask:
-                unmasked_channels = self.unmask_channel(chunk_payload[0])
-                if not "last_data" in parsed_data:
-                    parsed_data["last_data"] = {}
-                if chunk_id == max_chunks:
-                    parsed_data["last_data"].update(
-                        {"timestamp_ms": self.bytes_to_u32(chunk_payload[1:])})
-                else:
-                    for uch in unmasked_channels:
-                        parsed_data["last_data"].update(
-                            {"{}".format(e_ADC_CHANNEL.get(uch)): self.bytes_to_float(chunk_payload[1:])})
-
-            elif command == AFECommand.getSensorDataSi_average_byMask:
-                unmasked_channels = self.unmask_channel(chunk_payload[0])
-                if not "average_data" in parsed_data:
-                    parsed_data["average_data"] = {}
-                if chunk_id == max_chunks:
-                    parsed_data["average_data"].update(
-                        {"timestamp_ms": self.bytes_to_u32(chunk_payload[1:])})
-                else:
-                    for uch in unmasked_channels:
-                        parsed_data["average_data"].update(
-                            {"{}".format(e_ADC_CHANNEL.get(uch)): self.bytes_to_float(chunk_payload[1:])})
-
-            elif command == AFECommand.setAD8402Value_byte_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.configuration["M" if uch == 0 else "S"]["offset [bit]"] = self.bytes_to_u16(
-                        chunk_payload[1:])
-                    if 0x01 & (chunk_payload[2] >> uch):
-                        await self.logger.log(VerbosityLevel["ERROR"],
-                                              self.default_log_dict({"error": "AFE {}: ERROR setAD8402Value_byte_byMask for CH{}".format(
-                                                  device_id, uch
-                                              )}))
-                        # Error
-                        self.configuration["M" if uch ==
-                                           0 else "S"]["offset [bit]"] = None
-
-            elif command == AFECommand.setAveragingMode_byMask:
-                unmasked_channels = self.unmask_channel(chunk_payload[0])
-                for uch in unmasked_channels:
-                    averaging_mode = ''
-                    for a, v in AFECommandAverage.items():
-                        if v == chunk_payload[1]:
-                            averaging_mode = a
-                            break
-                    self.channels[uch].config["averaging_mode"] = averaging_mode
-
-            elif command == AFECommand.setAveragingAlpha_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["alpha"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setChannel_dt_ms_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["time_interval_ms"] = self.bytes_to_u32(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setChannel_a_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["a"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setChannel_b_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["b"] = self.bytes_to_float(
-                        chunk_payload[1:])
-                    
-            elif command == AFECommand.setRegulator_T_opt_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["T_opt"] = self.bytes_to_float(
-                        chunk_payload[1:])
-                    
-            elif command == AFECommand.setRegulator_dT_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["dT"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setRegulator_a_dac_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["a"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setRegulator_b_dac_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["b"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setRegulator_dV_dT_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["dV_dT"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setRegulator_V_opt_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["V_opt"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setRegulator_V_offset_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["V_offset"] = self.bytes_to_float(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.setChannel_period_ms_byMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    self.channels[uch].config["period_ms"] = self.bytes_to_u32(
-                        chunk_payload[1:])
-
-            elif command == AFECommand.getSensorDataSi_periodic:
-                try:
-                    unmasked_channels = self.unmask_channel(chunk_payload[0])
-                    if not "last_data" in self.periodic_data:
-                        self.periodic_data["last_data"] = {}
-                    if not "average_data" in self.periodic_data:
-                        self.periodic_data["average_data"] = {}
-
-                    if chunk_id == 0:  # Last data: data bytes
-                        self.periodic_data = {}  # Clear periodic data if new chunk set arrived
-                        self.periodic_data["last_data"] = {}
-                        self.periodic_data["average_data"] = {}
-                        self.periodic_data["timestamp_ms"] = millis()
-                        for uch in unmasked_channels:
-                            self.periodic_data["last_data"].update(
-                                {"{}".format(e_ADC_CHANNEL.get(uch)): self.bytes_to_float(chunk_payload[1:])})
-                    elif chunk_id == 1: # Last data as bytes
-                        for uch in unmasked_channels:
-                            self.periodic_data["last_data"].update(
-                                {"{}_bytes".format(e_ADC_CHANNEL.get(uch)): self.bytes_to_float(chunk_payload[1:])})
-                    elif chunk_id == 2:  # Last data: data timestamp
-                        self.periodic_data["last_data"].update(
-                            {"timestamp_ms": self.bytes_to_u32(chunk_payload[1:])})
-                    elif chunk_id == 3:  # Average data: data
-                        for uch in unmasked_channels:
-                            self.periodic_data["average_data"].update(
-                                {"{}".format(e_ADC_CHANNEL.get(uch)): self.bytes_to_float(chunk_payload[1:])})
-                    elif chunk_id == 4:  # Average data: calculation timestamp
-                        self.periodic_data["average_data"].update(
-                            {"timestamp_ms": self.bytes_to_u32(chunk_payload[1:])})
-                    if chunk_id == max_chunks: # Data are parsed
-                        parsed_data = self.periodic_data
-
-                except Exception as e:
-                    await p.print("Error getSensorDataSi_periodic: {}: ".format(e))
-
-            # elif command == AFECommand.getSensorDataSiAndTimestamp_average_byMask:
-            #     channel = chunk_payload[0]
-            #     if chunk_id == 0:
-            #         value = self.bytes_to_float(chunk_payload[1:])  # value
-            #     elif chunk_id == 1:
-            #         value = self.bytes_to_u32(chunk_payload[1:])  # timestamp
-
-            elif command == AFECommand.writeGPIO:
-                pass
-            elif command == AFECommand.setCanMsgBurstDelay_ms:
-                await self.logger.log(VerbosityLevel["INFO"],
-                                      self.default_log_dict({
-                                          "info": "Changed CanMsgBurstDelay_ms on AFE to {}".format(
-                                              self.bytes_to_u32(chunk_payload[1:]))
-                                      }))
-                pass
-            elif command == AFECommand.setAfe_can_watchdog_timeout_ms:
-                self.afe_can_watchdog_timeout_ms = self.bytes_to_u32(
-                    chunk_payload[1:])
-                
-            elif command == AFECommand.setTemperatureLoop_loop_every_ms:
-                pass
-
-            elif command == AFECommand.setAveraging_max_dt_ms_byMask:
-                pass
-
-            elif command == AFECommand.setDACValueRaw_bySubdeviceMask:
-                pass
-            elif command == AFECommand.setDACValueSi_bySubdeviceMask:
-                pass
-
-            elif command == AFECommand.setDAC_bySubdeviceMask:
-                for uch in self.unmask_channel(chunk_payload[0]):
-                    if chunk_payload[2] & (1 << uch):
-                        pass
-                    else:
-                        pass
-            elif command == AFECommand.setDACTargetSi_bySubdeviceMask:
-                pass
-                    
-            elif command == AFECommand.debug_machine_control:
-                await self._handle_get_subdevice_status(self.debug_machine_control_msg, chunk_id, chunk_payload)
-            else:
+            decoder = REPLY_DECODERS.get(command)
+            if decoder is None:
                 await p.print("Unknow command: 0x{:02X}: {}".format(
-                    command, data_bytes))
+                    command, list(frame.data)))
                 return
-
-            if self.executing is not None:
-                if command == self.executing["command"]:
-                    if self.executing["preserve"] == True:
-                        if self.executing.get("retval") is None:
-                            self.executing["retval"] = {}
-                        for key, value in parsed_data.items():
-                            if key not in self.executing["retval"]:
-                                self.executing["retval"][key] = value
-                            elif isinstance(self.executing["retval"][key], dict) and isinstance(value, dict):
-                                self.executing["retval"][key].update(value)
-                            else:
-                                self.executing["retval"][key] = value
-            if chunk_id == max_chunks and received_data:
+            kind = decoder[0]
+            if kind == REPLY_CHANNEL_CONFIG:
+                self._reply_channel_config(frame, decoder[1], decoder[2], decoder[3])
+            elif kind == REPLY_METHOD:
+                try:
+                    decoder[1](self, frame, parsed_data)
+                except Exception as e:
+                    await p.print("Error decoding 0x{:02X}: {}: ".format(command, e))
+            elif kind == REPLY_ASYNC:
+                await decoder[1](self, frame, parsed_data)
+
+            mask = frame.payload[0] if command in MASK_ECHO_COMMANDS and frame.dlc > 2 else None
+            executing = self._reply_owner(command, chunk_id, mask)
+            callback = None
+            done = None  # dict of the completed command for the callback and the logs below
+            if executing is not None:
+                executing.chunk_last = chunk_id
+                if executing.preserve == True or executing.future is not None:
+                    if executing.retval is None:
+                        executing.retval = {}
+                    retval = executing.retval
+                    for key, value in parsed_data.items():
+                        if key not in retval:
+                            retval[key] = value
+                        elif isinstance(retval[key], dict) and isinstance(value, dict):
+                            retval[key].update(value)
+                        else:
+                            retval[key] = value
+                if chunk_id == max_chunks:
+                    callback, done = self._complete_command(executing, frame)
+            if chunk_id == max_chunks:
                 for key, value in parsed_data.items():
 
                     if isinstance(value, dict):
@@ -796,66 +1103,42 @@ class AFEDevice:
                     # await p.print(s)
                 #     self.latest_status["key"]
                 # await p.print("$", parsed_data)
-                if self.executing is not None:
-                    if command == self.executing["command"]:
-                        self.executing["status"] = CommandStatus.RECIEVED
+                if executing is not None:
+                    # The record is already released, only done is used from here on
+                    await self.logger.log(
+                        VerbosityLevel["DEBUG"], self.default_log_dict({
+                            "debug": "END 0x{:02X}".format(command)}))
+                    try:
+                        if callback is not None:
+                            # If callback can be async, create a task for it
+                            uasyncio.create_task(callback(done))
+                    except Exception as e_cb:
                         await self.logger.log(
-                            VerbosityLevel["DEBUG"], self.default_log_dict({
-                                "debug": "END 0x{:02X}".format(command)}))
-                        try:
-                            if "callback" in self.executing and callable(self.executing["callback"]):
-                                # If callback can be async, create a task for it
-                                # Assuming callback_is_configured is now async
-                                uasyncio.create_task(
-                                    self.executing["callback"](self.executing))
-                        except Exception as e_cb:
-                            await self.logger.log(
-                                VerbosityLevel["ERROR"],
-                                self.default_log_dict({
-                                    "info": self.trim_dict_for_logger(self.executing),
-                                    "error": "callback error: {}".format(e_cb)}))
-                        toLog = None
-
-                        if self.executing.get("preserve") == True:
-                            toLog = self.default_log_dict({
-                                "request_timestamp_ms": self.executing.get("timestamp_ms"),
-                                "command": command,
-                                "retval": self.trim_dict_for_logger(self.executing.get("retval")),
-                            })
-                            await self.logger.log(
-                                VerbosityLevel["MEASUREMENT"], toLog)
-                        self.executing = None
-                    else:
-                        pass
-                if self.save_periodic_data is True:
-                    # if "timestamp_ms" in self.periodic_data:
+                            VerbosityLevel["ERROR"],
+                            self.default_log_dict({
+                                "info": self.trim_dict_for_logger(done),
+                                "error": "callback error: {}".format(e_cb)}))
+                    toLog = None
+
+                    if done is not None and done["preserve"] == True:
+                        toLog = self.default_log_dict({
+                            "request_timestamp_ms": done["timestamp_ms"],
+                            "command": command,
+                            "retval": self.trim_dict_for_logger(done["retval"]),
+                        })
+                        await self.logger.log(
+                            VerbosityLevel["MEASUREMENT"], toLog)
+                if self.save_periodic_data is True and command == AFECommand.getSensorDataSi_periodic:
+                    toLog = None
                     try:
                         toLog = self.default_log_dict({
                             "command": AFECommand.getSensorDataSi_periodic,
-                            "retval": self.trim_dict_for_logger(self.periodic_data),
+                            "retval": self.get_periodic_data(),
                         })
-                        channel_timestamp = self.periodic_data.get(
-                            "timestamp_ms", None)
-                        last_data = self.periodic_data.get("last_data", None)
-                        average_data = self.periodic_data.get(
-                            "average_data", None)
-                        for ch in self.channels:
-                            if last_data:
-                                if ch.name in last_data:
-                                    ch.last_recieved_data["last"] = {
-                                        "value": last_data[ch.name],
-                                        "bytes": last_data[ch.name+"_bytes"],
-                                        "timestamp_ms": channel_timestamp}
-                            if average_data:
-                                if ch.name in average_data:
-                                    ch.last_recieved_data["average"] = {
-                                        "value": average_data[ch.name], "timestamp_ms": channel_timestamp}
                         await self.logger.log(
                             VerbosityLevel["MEASUREMENT"], toLog)
                     except Exception as e:
                         await p.print("ERROR during save_periodic_data:", e, toLog)
-                    finally:
-                        self.periodic_data = {}
                 if command == AFECommand.debug_machine_control:
                     for subdev in [0, 1]:
                         try:
@@ -873,7 +1156,256 @@ class AFEDevice:
                         finally:
                             self.debug_machine_control_msg[subdev] = {}
 
-            received_data = None
+    def _reply_channel_config(self, frame, fmt, size, key):
+        """Stores the value echoed by a *_byMask setter into config[key] of every masked channel."""
+        value = None
+        if frame.dlc >= MASKED_VALUE_OFFSET + size:
+            value = struct.unpack_from(fmt, frame.raw, MASKED_VALUE_OFFSET)[0]
+        for uch in self.unmask_channel(frame.payload[0]):
+            self.channels[uch].config[key] = value
+
+    async def _reply_getSerialNumber(self, frame, parsed_data):
+        device_id = frame.afe_id
+        command = frame.command
+        chunk_id = frame.chunk_id
+        max_chunks = frame.max_chunks
+        await self.logger.log(VerbosityLevel["WARNING"],
+                              self.default_log_dict({"debug": "R: ID:{}; Command: 0x{:02X}: {}".format(
+                                  device_id, command, list(frame.data))}))
+        chunk_data = frame.u32_at(2)
+        if chunk_id == 0:
+            self.unique_id_str = None
+            self.unique_id = [0,0,0]
+            self.output = {}
+        self.unique_id[chunk_id] = chunk_data
+        if chunk_id == max_chunks:
+            self.is_online = True
+            self.current_command = None
+            uid0 = 0x001E0028
+            uid1 = 0x46415716
+            uid2 = 0x20353634
+            self.unique_id_str = "".join(
+                "{:08X}".format(b) for b in self.unique_id)
+            await self.logger.log(VerbosityLevel["INFO"],
+                                  self.default_log_dict(
+                {"info": {"UID": self.unique_id_str}}))
+            parsed_data["unique_id_str"] = self.unique_id_str
+            self.configuration["UID"] = self.unique_id_str
+
+    def _reply_getVersion(self, frame, parsed_data):
+        chunk_payload = frame.payload
+        self.firmware_version = int("".join(map(str, chunk_payload)))
+        self.version_checked = True
+        parsed_data["version"] = self.firmware_version
+
+    async def _reply_resetAll(self, frame, parsed_data):
+        device_id = frame.afe_id
+        chunk_payload = frame.payload
+        self.init_after_restart()
+        await self.logger.log(VerbosityLevel["ERROR"],
+                              self.default_log_dict(
+            {"error": "AFE {} was restared! Reason {}".format(device_id, ResetReason[chunk_payload[0]])}))
+        await self.logger.sync()
+
+    @staticmethod
+    def _frame_hub_ms(frame):
+        """HUB ticks_ms when frame left the CAN FIFO (RxFrame.timestamp_us), not when it is decoded."""
+        return time.ticks_add(millis(), -(time.ticks_diff(time.ticks_us(), frame.timestamp_us) // 1000))
+
+    def _reply_getTimestamp(self, frame, parsed_data):
+        HUB_timestamp_ms = self._frame_hub_ms(frame)
+        AFE_timestamp_ms = frame.u32_at(MASKED_VALUE_OFFSET)
+        self.last_sync_afe_timestamp_ms = AFE_timestamp_ms
+        parsed_data["AFE_timestamp_ms"] = AFE_timestamp_ms
+        parsed_data["HUB_timestamp_ms"] = HUB_timestamp_ms
+        if self.use_clock_model:
+            self.clock.add(HUB_timestamp_ms, AFE_timestamp_ms)
+
+    def _reply_getSyncTimestamp(self, frame, parsed_data):
+        chunk_id = frame.chunk_id
+        if chunk_id == 0:
+            HUB_timestamp_ms = self._frame_hub_ms(frame)
+            AFE_timestamp_ms = frame.u32_at(MASKED_VALUE_OFFSET)
+            self.last_sync_afe_timestamp_ms = AFE_timestamp_ms
+            parsed_data["AFE_timestamp_ms"] = AFE_timestamp_ms
+            parsed_data["HUB_timestamp_ms"] = HUB_timestamp_ms
+            if self.use_clock_model:
+                self.clock.add(HUB_timestamp_ms, AFE_timestamp_ms)
+        elif chunk_id == 1:
+            parsed_data["msg_recieved_by_AFE_timestamp_ms"] = frame.u32_at(MASKED_VALUE_OFFSET)
+
+    async def _reply_resetCAN(self, frame, parsed_data):
+        device_id = frame.afe_id
+        chunk_payload = frame.payload
+        reason = "unknown"
+        AFE_timestamp_ms = None
+        if frame.dlc == 3: # AFE was restarted probably by hardware
+            reason = ResetReason[chunk_payload[0]]
+            AFE_timestamp_ms = None
+            self.init_after_restart()
+        elif frame.dlc == 7: # AFE was restarted during runtime
+            AFE_timestamp_ms = frame.u32_at(2)
+            reason = "runtime"
+        retval = {"reason": "AFE CAN Error {}".format(reason), "timestamp_ms": millis()}
+        if AFE_timestamp_ms is not None:
+            retval["timestamp_ms"] = AFE_timestamp_ms
+        await self.logger.log(VerbosityLevel["ERROR"],
+                              self.default_log_dict({
+                                  "error": "AFE {} CAN bus reset".format(device_id),
+                                  "retval": self.trim_dict_for_logger(retval)
+                              }))
+
+    async def _reply_getSubdeviceStatus(self, frame, parsed_data):
+        chunk_id = frame.chunk_id
+        max_chunks = frame.max_chunks
+        await self._handle_get_subdevice_status(self.debug_machine_control_msg_last, frame)
+        if chunk_id == max_chunks:
+            await p.print("XXXX", self.debug_machine_control_msg_last)
+
+    def _reply_getSensorDataSi_last_byMask(self, frame, parsed_data):
+        data = parsed_data.get("last_data")
+        if data is None:
+            data = {}
+            parsed_data["last_data"] = data
+        if frame.chunk_id == frame.max_chunks:
+            data["timestamp_ms"] = frame.u32_at(MASKED_VALUE_OFFSET)
+        else:
+            value = frame.float_at(MASKED_VALUE_OFFSET)
+            for uch in self.unmask_channel(frame.payload[0]):
+                data[CHANNEL_KEYS[uch]] = value
+
+    def _reply_getSensorDataSi_average_byMask(self, frame, parsed_data):
+        data = parsed_data.get("average_data")
+        if data is None:
+            data = {}
+            parsed_data["average_data"] = data
+        if frame.chunk_id == frame.max_chunks:
+            data["timestamp_ms"] = frame.u32_at(MASKED_VALUE_OFFSET)
+        else:
+            value = frame.float_at(MASKED_VALUE_OFFSET)
+            for uch in self.unmask_channel(frame.payload[0]):
+                data[CHANNEL_KEYS[uch]] = value
+
+    async def _reply_setAD8402Value_byte_byMask(self, frame, parsed_data):
+        device_id = frame.afe_id
+        chunk_payload = frame.payload
+        for uch in self.unmask_channel(chunk_payload[0]):
+            self.configuration["M" if uch == 0 else "S"]["offset [bit]"] = frame.u16_at(MASKED_VALUE_OFFSET)
+            if 0x01 & (chunk_payload[2] >> uch):
+                await self.logger.log(VerbosityLevel["ERROR"],
+                                      self.default_log_dict({"error": "AFE {}: ERROR setAD8402Value_byte_byMask for CH{}".format(
+                                          device_id, uch
+                                      )}))
+                # Error
+                self.configuration["M" if uch ==
+                                   0 else "S"]["offset [bit]"] = None
+
+    def _reply_setAveragingMode_byMask(self, frame, parsed_data):
+        chunk_payload = frame.payload
+        unmasked_channels = self.unmask_channel(chunk_payload[0])
+        for uch in unmasked_channels:
+            averaging_mode = ''
+            for a, v in AFECommandAverage.items():
+                if v == chunk_payload[1]:
+                    averaging_mode = a
+                    break
+            self.channels[uch].config["averaging_mode"] = averaging_mode
+
+    def _reply_getSensorDataSi_periodic(self, frame, parsed_data):
+        chunk_id = frame.chunk_id
+        measurements = self.measurements
+        if chunk_id == 0:  # Last data: data
+            measurements.clear_staged()  # Drop values of an incomplete set
+            self.periodic_timestamp_ms = millis()
+            measurements.stage(MeasurementStore.KIND_LAST, frame.payload[0], frame.float_at(MASKED_VALUE_OFFSET))
+        elif chunk_id == 1:  # Last data as bytes
+            measurements.stage(MeasurementStore.KIND_BYTES, frame.payload[0], frame.float_at(MASKED_VALUE_OFFSET))
+        elif chunk_id == 2:  # Last data: data timestamp
+            timestamp_ms = frame.u32_at(MASKED_VALUE_OFFSET)
+            mask = measurements.commit(MeasurementStore.KIND_LAST, timestamp_ms)
+            measurements.commit(MeasurementStore.KIND_BYTES, timestamp_ms)
+            if mask and self.rollups is not None:
+                now_s = rtc_unix_timestamp()
+                for ch in CHANNEL_MASK_TABLE[mask]:
+                    self.rollups.add(ch, measurements.newest_value(MeasurementStore.KIND_LAST, ch), now_s)
+        elif chunk_id == 3:  # Average data: data
+            measurements.stage(MeasurementStore.KIND_AVERAGE, frame.payload[0], frame.float_at(MASKED_VALUE_OFFSET))
+        elif chunk_id == 4:  # Average data: calculation timestamp
+            measurements.commit(MeasurementStore.KIND_AVERAGE, frame.u32_at(MASKED_VALUE_OFFSET))
+        if chunk_id == frame.max_chunks:  # Data are parsed
+            self.periodic_sets += 1
+
+    def get_periodic_data(self):
+        """
+        Newest periodic set in the shape logged with every set:
+        {"timestamp_ms": HUB ms, "last_data": {name: value, name_bytes: value,
+        "timestamp_ms": AFE ms}, "average_data": {name: value, "timestamp_ms": AFE ms}}.
+        """
+        measurements = self.measurements
+        last_data = {}
+        timestamp_ms = measurements.newest_into(MeasurementStore.KIND_LAST, CHANNEL_KEYS, last_data)
+        measurements.newest_into(MeasurementStore.KIND_BYTES, CHANNEL_BYTES_KEYS, last_data)
+        if timestamp_ms is not None:
+            last_data["timestamp_ms"] = timestamp_ms
+            self.add_clock_timestamps(last_data)
+        average_data = {}
+        timestamp_ms = measurements.newest_into(MeasurementStore.KIND_AVERAGE, CHANNEL_KEYS, average_data)
+        if timestamp_ms is not None:
+            average_data["timestamp_ms"] = timestamp_ms
+            self.add_clock_timestamps(average_data)
+        return {"timestamp_ms": self.periodic_timestamp_ms, "last_data": last_data, "average_data": average_data}
+
+    def get_latest_status(self):
+        """latest_status with the newest periodic values merged into last_data / average_data."""
+        retval = dict(self.latest_status)
+        for key, kind, suffix in (("last_data", MeasurementStore.KIND_LAST, ""),
+                                  ("last_data", MeasurementStore.KIND_BYTES, "_bytes"),
+                                  ("average_data", MeasurementStore.KIND_AVERAGE, "")):
+            view = self.measurements.kind_view(kind, suffix)
+            if not view:
+                continue
+            merged = dict(retval.get(key, {}))
+            for name, entry in view.items():
+                current = merged.get(name)
+                if current is None or entry["timestamp_ms"] >= current["timestamp_ms"]:
+                    merged[name] = entry
+            retval[key] = merged
+        return retval
+
+    def get_channel_data(self, channel):
+        """
+        Newest periodic values of one channel, {"last": {...}, "average": {...}};
+        timestamp_ms is the AFE time of each value.
+        """
+        return self.measurements.channel_view(channel)
+
+    def get_rollup_rows(self, channel, resolution_s, start_s=None, end_s=None):
+        """
+        (start_s, count, min, max, mean) of the channel's rollup buckets of
+        resolution_s starting in [start_s, end_s), oldest first. None when
+        there is no such resolution.
+        """
+        level = self.rollups.level(resolution_s) if self.rollups is not None else None
+        if level is None:
+            return None
+        return level.rows(channel, start_s, end_s)
+
+    def get_measurement_history(self, channel, kind="last", last=None):
+        """Bounded history of one channel and kind ("last", "average" or "bytes"), oldest first."""
+        return self.measurements.history(MeasurementStore.KINDS.index(kind), channel, last)
+
+    async def _reply_setCanMsgBurstDelay_ms(self, frame, parsed_data):
+        await self.logger.log(VerbosityLevel["INFO"],
+                              self.default_log_dict({
+                                  "info": "Changed CanMsgBurstDelay_ms on AFE to {}".format(
+                                      frame.u32_at(MASKED_VALUE_OFFSET))
+                              }))
+
+    def _reply_setAfe_can_watchdog_timeout_ms(self, frame, parsed_data):
+        self.afe_can_watchdog_timeout_ms = frame.u32_at(MASKED_VALUE_OFFSET)
+
+    async def _reply_debug_machine_control(self, frame, parsed_data):
+        await self._handle_get_subdevice_status(self.debug_machine_control_msg, frame)
 
     # Changed to async def
     async def start_periodic_measurement_download(self, interval_ms=2500):
@@ -901,7 +1433,7 @@ class AFEDevice:
 
     async def manage_state(self):
         if self.use_afe_can_watchdog:
-            if is_timeout(self.afe_can_watchdog_timestamp_ms, int(round(self.afe_can_watchdog_timeout_ms/10.0))):
+            if is_timeout(self.afe_can_watchdog_timestamp_ms, self.sync_interval_ms()):
                 self.afe_can_watchdog_timestamp_ms = millis()
                 commandKwargs = {"timeout_ms": 10220,
                                  "preserve": True,
@@ -920,32 +1452,82 @@ class AFEDevice:
                                           self.default_log_dict({"error": "configuration timeout", "timestamp_ms": millis()}))
                     await self.restart_device()
 
+        if self.in_flight:
+            timed_out = [(cmd, cmd.generation) for cmd in self.in_flight
+                         if is_timeout(cmd.timestamp_ms, cmd.timeout_ms) or self._tx_failed(cmd)]
+            for cmd, generation in timed_out:
+                # The awaits below let replies finish (and release or reissue) later entries
+                if cmd in self.in_flight and self._is_current(cmd, generation):
+                    self.in_flight.remove(cmd)
+                    await self.command_error_handler(cmd)
+
         if self.executing is not None:
-            if is_timeout(self.executing["timestamp_ms"], self.executing["timeout_ms"]):
-                self.executing["status"] = CommandStatus.ERROR
-                await self.logger.log(VerbosityLevel["ERROR"],
-                                      self.default_log_dict(
-                    {
-                        "error": "TIMEOUT",
-                        "executing": self.trim_dict_for_logger(self.executing)
-                    }))
-                if "callback_error" in self.executing:
-                    try:
-                        if self.executing["callback_error"] is not None and callable(self.executing["callback_error"]):
-                            await p.print("Creating task for callback_error in manage_state: {}".format(
-                                self.executing["callback_error"]))
-                            # If callback_error can be async, create a task for it
-                            uasyncio.create_task(self.executing["callback_error"](
-                                {"afe": self, "afe_id": self.device_id, "executing": self.executing}))
-                    except Exception as e:
-                        await p.print("AFE manage_state error invoking callback_error: {}".format(e))
-                self.executing = None
+            if is_timeout(self.executing.timestamp_ms, self.executing.timeout_ms) or self._tx_failed(self.executing):
+                await self.executing_error_handler()
 
         # Try send commands
-        if self.use_tx_delay:
+        if self.pipeline_depth > 1:
+            await self.execute_pipelined()  # the window paces the AFE instead of tx_timeout_ms
+        elif self.use_tx_delay:
             if is_delay(self.execute_timestamp, self.tx_timeout_ms):
                 pass
             else:
                 await self.execute(0)  # Changed to await
         else:
             await self.execute(0)  # Changed to await
+
+
+def _channel_config(fmt, key):
+    return (REPLY_CHANNEL_CONFIG, fmt, struct.calcsize(fmt), key)
+
+
+# Reply decoder per command code, used by AFEDevice.process_received_frame
+REPLY_DECODERS = {
+    AFECommand.getSerialNumber: (REPLY_ASYNC, AFEDevice._reply_getSerialNumber),
+    AFECommand.getVersion: (REPLY_METHOD, AFEDevice._reply_getVersion),
+    AFECommand.resetAll: (REPLY_ASYNC, AFEDevice._reply_resetAll),
+    AFECommand.startADC: (REPLY_NONE,),
+    AFECommand.getTimestamp: (REPLY_METHOD, AFEDevice._reply_getTimestamp),
+    AFECommand.getSyncTimestamp: (REPLY_METHOD, AFEDevice._reply_getSyncTimestamp),
+    AFECommand.resetCAN: (REPLY_ASYNC, AFEDevice._reply_resetCAN),
+    AFECommand.getSubdeviceStatus: (REPLY_ASYNC, AFEDevice._reply_getSubdeviceStatus),
+    AFECommand.setTemperatureLoopForChannelState_byMask_asStatus: (REPLY_NONE,),
+    AFECommand.getSensorDataSi_last_byMask: (REPLY_METHOD, AFEDevice._reply_getSensorDataSi_last_byMask),
+    AFECommand.getSensorDataSi_average_byMask: (REPLY_METHOD, AFEDevice._reply_getSensorDataSi_average_byMask),
+    AFECommand.setAD8402Value_byte_byMask: (REPLY_ASYNC, AFEDevice._reply_setAD8402Value_byte_byMask),
+    AFECommand.setAveragingMode_byMask: (REPLY_METHOD, AFEDevice._reply_setAveragingMode_byMask),
+    AFECommand.setAveragingAlpha_byMask: _channel_config("<f", "alpha"),
+    AFECommand.setChannel_dt_ms_byMask: _channel_config("<I", "time_interval_ms"),
+    AFECommand.setChannel_a_byMask: _channel_config("<f", "a"),
+    AFECommand.setChannel_b_byMask: _channel_config("<f", "b"),
+    AFECommand.setRegulator_T_opt_byMask: _channel_config("<f", "T_opt"),
+    AFECommand.setRegulator_dT_byMask: _channel_config("<f", "dT"),
+    AFECommand.setRegulator_a_dac_byMask: _channel_config("<f", "a"),
+    AFECommand.setRegulator_b_dac_byMask: _channel_config("<f", "b"),
+    AFECommand.setRegulator_dV_dT_byMask: _channel_config("<f", "dV_dT"),
+    AFECommand.setRegulator_V_opt_byMask: _channel_config("<f", "V_opt"),
+    AFECommand.setRegulator_V_offset_byMask: _channel_config("<f", "V_offset"),
+    AFECommand.setChannel_period_ms_byMask: _channel_config("<I", "period_ms"),
+    AFECommand.getSensorDataSi_periodic: (REPLY_METHOD, AFEDevice._reply_getSensorDataSi_periodic),
+    # AFECommand.getSensorDataSiAndTimestamp_average_byMask is not decoded: payload[0] is the
+    # channel, chunk 0 carries the value (float) and chunk 1 the timestamp (u32)
+    AFECommand.writeGPIO: (REPLY_NONE,),
+    AFECommand.setCanMsgBurstDelay_ms: (REPLY_ASYNC, AFEDevice._reply_setCanMsgBurstDelay_ms),
+    AFECommand.setAfe_can_watchdog_timeout_ms: (REPLY_METHOD, AFEDevice._reply_setAfe_can_watchdog_timeout_ms),
+    AFECommand.setTemperatureLoop_loop_every_ms: (REPLY_NONE,),
+    AFECommand.setAveraging_max_dt_ms_byMask: (REPLY_NONE,),
+    AFECommand.setDACValueRaw_bySubdeviceMask: (REPLY_NONE,),
+    AFECommand.setDACValueSi_bySubdeviceMask: (REPLY_NONE,),
+    AFECommand.setDAC_bySubdeviceMask: (REPLY_NONE,),
+    AFECommand.setDACTargetSi_bySubdeviceMask: (REPLY_NONE,),
+    AFECommand.debug_machine_control: (REPLY_ASYNC, AFEDevice._reply_debug_machine_control),
+}
+
+# Commands whose reply echoes the channel mask they were sent with in
+# payload[0]; _reply_owner tells apart in-flight commands by it
+MASK_ECHO_COMMANDS = set(
+    [command for command, decoder in REPLY_DECODERS.items() if decoder[0] == REPLY_CHANNEL_CONFIG]
+    + [AFECommand.getSensorDataSi_last_byMask,
+       AFECommand.getSensorDataSi_average_byMask,
+       AFECommand.setAD8402Value_byte_byMask,
+       AFECommand.setAveragingMode_byMask])
@@ -2,6 +2,11 @@ import json
 import time
 import struct
 import random
+from array import array
+try:
+    import heapq
+except ImportError:
+    import uheapq as heapq
 try:
     import _thread
     import pyb
@@ -10,7 +15,7 @@ try:
 except:
     import asyncio as uasyncio
 
-from AFE import AFEDevice, AFECommand
+from AFE import AFEDevice, AFECommand, wait_all
 from my_utilities import JSONLogger, AFECommandChannel, AFECommandSubdevice, AFECommandGPIO, AFECommandAverage, read_callibration_csv
 from my_utilities import channel_name_xxx, e_ADC_CHANNEL
 from my_utilities import wdt
@@ -21,7 +26,301 @@ from my_utilities import extract_bracketed
 from my_utilities import millis, is_timeout, is_delay
 from my_utilities import convert_to_si
 from my_RxDeviceCAN import RxDeviceCAN
-from my_utilities import get_configuration_from_files
+from my_utilities import get_configuration_from_files, CalibrationStore
+from my_utilities import MeasurementRollups
+
+# Calibration key -> (command, channel selector, struct format) of the
+# set commands default_procedure sends; see HUBDevice.compile_configuration()
+CONFIGURATION_COMMANDS = {
+    "T_measured_a": (AFECommand.setChannel_a_byMask, "T", "<f"),
+    "T_measured_b": (AFECommand.setChannel_b_byMask, "T", "<f"),
+    "offset": (AFECommand.setAD8402Value_byte_byMask, "subdevice", "<B"),
+    "U_measured_a": (AFECommand.setChannel_a_byMask, "U", "<f"),
+    "U_measured_b": (AFECommand.setChannel_b_byMask, "U", "<f"),
+    "I_measured_a": (AFECommand.setChannel_a_byMask, "I", "<f"),
+    "I_measured_b": (AFECommand.setChannel_b_byMask, "I", "<f"),
+    "U_set_a": (AFECommand.setRegulator_a_dac_byMask, "subdevice", "<f"),
+    "U_set_b": (AFECommand.setRegulator_b_dac_byMask, "subdevice", "<f"),
+    "V_opt": (AFECommand.setRegulator_V_opt_byMask, "subdevice", "<f"),
+    "dV/dT": (AFECommand.setRegulator_dV_dT_byMask, "subdevice", "<f"),
+    "T_opt": (AFECommand.setRegulator_T_opt_byMask, "subdevice", "<f"),
+    "dT": (AFECommand.setRegulator_dT_byMask, "subdevice", "<f"),
+    "V_offset": (AFECommand.setRegulator_V_offset_byMask, "subdevice", "<f"),
+}
+
+# Channel selector -> (master, slave) channel or mask
+CONFIGURATION_CHANNELS = {
+    "T": (AFECommandChannel.AFECommandChannel_7, AFECommandChannel.AFECommandChannel_6),
+    "U": (AFECommandChannel.AFECommandChannel_2, AFECommandChannel.AFECommandChannel_3),
+    "I": (AFECommandChannel.AFECommandChannel_4, AFECommandChannel.AFECommandChannel_5),
+    "subdevice": (AFECommandSubdevice.AFECommandSubdevice_master, AFECommandSubdevice.AFECommandSubdevice_slave),
+    "general": (AFECommandChannelMask.master, AFECommandChannelMask.slave),
+}
+
+DISCOVERY_OUTSTANDING = 0x01  # discovery_flags: probe sent, no answer yet
+DISCOVERY_RESOLVED = 0x02  # discovery_flags: answered or timed out at least once in this sweep
+
+
+class AFERegistry:
+    """
+    Indexed collection of the AFEs known to the HUB.
+
+    Lookups by AFE ID go through a dict, the online state of every ID is
+    kept in a 256-bit bitset (updated by AFEDevice.is_online) and iteration
+    follows insertion order. It behaves like the list HUBDevice.afe_devices
+    used to be: len(), iteration, indexing, `in` and append().
+    """
+
+    def __init__(self):
+        self.by_id = {}
+        self.order = []
+        self.online = bytearray(32)  # one bit per AFE ID 0..255
+        self.online_count = 0
+        self.on_add = None  # called with every newly registered AFE
+
+    def __len__(self):
+        return len(self.order)
+
+    def __iter__(self):
+        return iter(self.order)
+
+    def __getitem__(self, index):
+        return self.order[index]
+
+    def __contains__(self, afe):
+        return self.by_id.get(afe.device_id) is afe
+
+    def get(self, afe_id):
+        return self.by_id.get(afe_id)
+
+    def add(self, afe):
+        """Adds afe unless its ID is already registered; returns the registered AFE."""
+        known = self.by_id.get(afe.device_id)
+        if known is not None:
+            return known
+        self.by_id[afe.device_id] = afe
+        self.order.append(afe)
+        afe.online_callback = self.set_online
+        self.set_online(afe.device_id, afe.is_online)
+        if self.on_add is not None:
+            self.on_add(afe)
+        return afe
+
+    append = add  # list compatibility
+
+    def remove(self, afe_id):
+        afe = self.by_id.pop(afe_id, None)
+        if afe is None:
+            return None
+        self.order.remove(afe)
+        afe.online_callback = None
+        self.set_online(afe_id, False)
+        return afe
+
+    def clear(self):
+        for afe in self.order:
+            afe.online_callback = None
+        self.by_id = {}
+        self.order = []
+        for i in range(len(self.online)):
+            self.online[i] = 0
+        self.online_count = 0
+
+    def ids(self):
+        return [afe.device_id for afe in self.order]
+
+    def set_online(self, afe_id, online):
+        mask = 1 << (afe_id & 7)
+        was_online = self.online[afe_id >> 3] & mask
+        if online and not was_online:
+            self.online[afe_id >> 3] |= mask
+            self.online_count += 1
+        elif was_online and not online:
+            self.online[afe_id >> 3] &= ~mask & 0xFF
+            self.online_count -= 1
+
+    def is_online(self, afe_id):
+        return self.online[afe_id >> 3] & (1 << (afe_id & 7)) != 0
+
+
+class HubADCSampler:
+    """
+    Background sampler of the HUB's own analog inputs. Every every_ms one
+    burst of `burst` samples per channel is taken at freq_hz into
+    preallocated array('H') buffers. The burst mean, times the channel gain,
+    goes into a ring of ring_len entries, so the ring covers
+    ring_len * every_ms of history. No allocation per burst.
+
+    With use_timer_irq the readings are taken one per timer tick in the
+    pyb.Timer(timer_id) callback, which sets a ThreadSafeFlag after the last
+    one; main_loop only waits for the flag and averages, so the other tasks
+    run during the burst. Otherwise pyb.ADC.read_timed_multi takes the whole
+    burst and stalls every task for burst / freq_hz (1.6 ms by default).
+    """
+    CHANNELS = ("I_SIPM_MEAS", "U_SIPM_MEAS", "VSUP_MEAS")
+    RESERVED_TIMERS = (3, 5)  # pyb: 3 is used internally, 5 drives the servos
+
+    def __init__(self, adcs, gains, logger=None, burst=16, freq_hz=10000, every_ms=100,
+                 ring_len=600, log_every_ms=10000, timer_id=6):
+        self.adcs = tuple(adcs)
+        self.gains = tuple(gains)  # raw counts -> channel unit
+        self.logger = logger
+        self.burst = burst
+        self.freq_hz = freq_hz
+        self.every_ms = every_ms
+        self.log_every_ms = log_every_ms  # 0 disables logging
+        self.timer_id = timer_id  # may be changed before main_loop starts
+        self._check_timer_id()
+        self.timer = None
+        self.use_timer_irq = True
+        self.flag = uasyncio.ThreadSafeFlag()  # set by _tick after the last reading of a burst
+        self.tick = 0  # next buffer slot _tick fills
+        self.tick_start_us = 0
+        self.burst_span_us = 0  # first to last reading of the latest IRQ burst
+        self._tick_cb = self._tick  # bound once, not per burst
+        self.buffers = [array('H', [0] * burst) for _ in self.adcs]
+        n = len(self.adcs)
+        self.ring_len = ring_len
+        self.ring = array('f', [0.0] * (ring_len * n))  # entry i: ring[i*n:(i+1)*n]
+        self.ring_ms = array('L', [0] * ring_len)
+        self.head = 0  # next entry to write
+        self.count = 0
+        self.run = False
+        self.bursts = 0
+        self.late_bursts = 0  # samples missed (read_timed_multi) or taken late (IRQ)
+        self.burst_us_max = 0  # longest the sampler held the CPU for one burst
+        self.log_timestamp_ms = 0
+
+    def _check_timer_id(self):
+        if not 1 <= self.timer_id <= 14 or self.timer_id in self.RESERVED_TIMERS:
+            raise ValueError("HubADCSampler: pyb.Timer {} is not available".format(self.timer_id))
+
+    def _get_timer(self):
+        if self.timer is None:
+            self._check_timer_id()
+            self.timer = pyb.Timer(self.timer_id, freq=self.freq_hz)
+        return self.timer
+
+    def sample(self):
+        """Takes one burst with read_timed_multi (blocking) and stores its means as the newest ring entry."""
+        start_us = time.ticks_us()
+        if not pyb.ADC.read_timed_multi(self.adcs, self.buffers, self._get_timer()):
+            self.late_bursts += 1
+        self._store_burst(start_us)
+
+    def _tick(self, timer):
+        # Timer IRQ: one reading per channel into the preallocated buffers, nothing else
+        k = self.tick
+        for i in range(len(self.adcs)):
+            self.buffers[i][k] = self.adcs[i].read()
+        if k == 0:
+            self.tick_start_us = time.ticks_us()
+        k += 1
+        self.tick = k
+        if k >= self.burst:
+            timer.callback(None)
+            self.burst_span_us = time.ticks_diff(time.ticks_us(), self.tick_start_us)
+            self.flag.set()
+
+    async def sample_irq(self):
+        """Takes one burst from the timer callback and stores its means; other tasks run meanwhile."""
+        timer = self._get_timer()
+        self.tick = 0
+        self.flag.clear()
+        timer.callback(self._tick_cb)
+        await self.flag.wait()
+        start_us = time.ticks_us()
+        # A reading more than one period late stretches the burst past burst periods
+        if self.burst_span_us > self.burst * 1000000 // self.freq_hz:
+            self.late_bursts += 1
+        self._store_burst(start_us)
+
+    def _store_burst(self, start_us):
+        n = len(self.adcs)
+        base = self.head * n
+        for i in range(n):
+            self.ring[base + i] = sum(self.buffers[i]) * self.gains[i] / self.burst
+        self.ring_ms[self.head] = time.ticks_ms()
+        self.head = (self.head + 1) % self.ring_len
+        if self.count < self.ring_len:
+            self.count += 1
+        self.bursts += 1
+        burst_us = time.ticks_diff(time.ticks_us(), start_us)
+        if burst_us > self.burst_us_max:
+            self.burst_us_max = burst_us
+
+    def _entry(self, index):
+        n = len(self.adcs)
+        retval = {"timestamp_ms": self.ring_ms[index]}
+        for i in range(n):
+            retval[self.CHANNELS[i]] = self.ring[index * n + i]
+        return retval
+
+    def latest(self):
+        """Newest burst means as {"timestamp_ms": ..., "I_SIPM_MEAS": ..., ...}, None before the first."""
+        if self.count == 0:
+            return None
+        return self._entry((self.head - 1) % self.ring_len)
+
+    def history(self, last=None):
+        """Oldest first; at most `last` entries."""
+        n = self.count if last is None else min(last, self.count)
+        start = (self.head - n) % self.ring_len
+        return [self._entry((start + k) % self.ring_len) for k in range(n)]
+
+    def mean(self, last_ms):
+        """Mean of every channel over the entries of the last last_ms."""
+        n = len(self.adcs)
+        sums = [0.0] * n
+        taken = 0
+        now = time.ticks_ms()
+        index = self.head
+        for _ in range(self.count):
+            index = (index - 1) % self.ring_len
+            if time.ticks_diff(now, self.ring_ms[index]) > last_ms:
+                break
+            for i in range(n):
+                sums[i] += self.ring[index * n + i]
+            taken += 1
+        if taken == 0:
+            return None
+        retval = {"samples": taken}
+        for i in range(n):
+            retval[self.CHANNELS[i]] = sums[i] / taken
+        return retval
+
+    def get_stats(self):
+        return {
+            "bursts": self.bursts,
+            "late_bursts": self.late_bursts,
+            "burst": self.burst,
+            "freq_hz": self.freq_hz,
+            "every_ms": self.every_ms,
+            "burst_us_max": self.burst_us_max,
+            "use_timer_irq": self.use_timer_irq,
+            "timer_id": self.timer_id,
+            "entries": self.count,
+        }
+
+    async def main_loop(self):
+        self.run = True
+        while self.run:
+            start_ms = time.ticks_ms()
+            if self.use_timer_irq:
+                await self.sample_irq()
+            else:
+                self.sample()
+            if self.logger is not None and self.log_every_ms and is_timeout(self.log_timestamp_ms, self.log_every_ms):
+                self.log_timestamp_ms = time.ticks_ms()
+                await self.logger.log(VerbosityLevel["INFO"], {
+                    "device_id": 0,
+                    "timestamp_ms": self.log_timestamp_ms,
+                    "hub_adc": self.mean(self.log_every_ms)})
+            await uasyncio.sleep_ms(max(0, self.every_ms - time.ticks_diff(time.ticks_ms(), start_ms)))
+        if self.timer is not None:
+            self.timer.callback(None)
+            self.timer.deinit()
+            self.timer = None
 
 
 class HUBDevice:
@@ -41,11 +340,44 @@ class HUBDevice:
 
     def __init__(self, can_bus: pyb.CAN, logger: JSONLogger, rxDeviceCAN: RxDeviceCAN, use_rxcallback=True, use_automatic_restart=False):
         self.can_bus = can_bus
-        self.afe_devices: list[AFEDevice] = []
+        self.afe_registry = AFERegistry()
+        self.afe_registry.on_add = self._on_afe_added
+        # Deadline scheduler for AFEDevice.manage_state(): a heap of
+        # [key, seq, due_ms, afe] entries plus the AFEs that asked to run now
+        self.use_afe_scheduler = True
+        self.afe_deadlines = []
+        self.afe_ready = []
+        self._sched_epoch_ms = millis()  # heap keys are ms relative to this, survives ticks wrap
+        self._sched_seq = 0
+        self.afe_manage_runs = 0  # manage_state() calls, for comparing with the fleet size
         self.afe_devices_max = 8
+        self.measurement_history_depth = 8  # periodic sets kept per AFE channel, see MeasurementStore
+        self.measurement_rollups = MeasurementRollups.RESOLUTIONS  # None disables the trend of new AFEs
+        self.afe_pipeline_depth = 1  # commands in flight per new AFE, 1 is stop-and-wait
+        self.afe_save_periodic_data = False  # log every periodic set of new AFEs
         self.use_automatic_restart = use_automatic_restart
+        # Automatic (re)configuration runs default_full in its own task per
+        # AFE, at most config_concurrency at a time; the rest wait in
+        # config_queue. uasyncio has no Semaphore, the slots are counted here.
+        # Bring-up takes as long as inline (the bus is the limit), but
+        # main_process no longer packs whole configurations and the first
+        # AFEs are configured sooner, see bench_fleet_bringup.
+        self.use_config_tasks = True
+        self.config_concurrency = 4
+        self.config_running = 0
+        self.config_queue = []  # AFEs waiting for a configuration slot
+        self.config_progress = {}  # afe_id -> progress dict, see get_fleet_status()
+        self.config_poll_ms = 50  # how often a configuration task checks its AFE
+        self.fleet_bringup_start_ms = None  # first AFE queued while no configuration ran
+        self.fleet_bringup_ms = None  # duration of the last bring-up, until no AFE was queued or configuring
 
         self.main_loop_yield_ms = 1
+        self.use_rx_event = True  # sleep until frames arrive or a timer is due instead of polling every main_loop_yield_ms
+        self.main_loop_idle_ms = 50  # longest sleep of main_loop when nothing is due
+        self.rx_batch_max = 16  # maximum CAN frames processed per main_process pass
+        self.use_afe_rx_tasks = True  # each AFE decodes its frames in its own task from a per-AFE queue
+        self.use_can_filters = True  # narrow the hardware acceptance filters to the known AFEs
+        self._can_filter_key = None  # (AFE IDs, accept all AFEs) the filters were last built for
 
         self.rx_timeout_ms = 1000
         self.run = True
@@ -65,6 +397,31 @@ class HUBDevice:
         self.afe_id_max = 255
         self.current_discovery_id = self.afe_id_min
 
+        # Windowed discovery: probes go out in bursts while at most
+        # discovery_window of them wait for an answer; IDs that stay silent
+        # are probed again with an exponential backoff
+        self.use_discovery_window = True
+        self.discovery_burst = 8  # probes sent per burst
+        self.discovery_burst_interval_ms = 5  # gap between bursts
+        self.discovery_window = 32  # probes waiting for an answer at most
+        self.discovery_probe_timeout_ms = 50  # an unanswered probe counts as a miss after this
+        self.discovery_reprobe_min_ms = 500  # delay before the first re-probe of a silent ID
+        self.discovery_reprobe_max_ms = 10000  # the backoff doubles up to this
+        self.discovery_flags = bytearray(256)  # DISCOVERY_* bits per ID
+        self.discovery_misses = bytearray(256)  # unanswered probes in a row per ID
+        self.discovery_sent_ms = [0] * 256  # when the outstanding probe of an ID was sent
+        self.discovery_next_ms = [0] * 256  # earliest re-probe of a silent ID
+        self.discovery_outstanding = []  # IDs with a probe waiting for an answer
+        self.discovery_wake_ms = None  # next time discover_devices_async has work, for main_loop
+        self._discovery_last_burst_ms = 0
+        self.discovery_started_ms = None  # sweep start, None until the first pass
+        self.discovery_unresolved = 0  # IDs not yet answered or timed out once
+        self.discovery_sweep_ms = None  # time until every ID was answered or timed out once
+        self.discovery_last_found_ms = None  # time from the start until the last new AFE answered
+        self.discovery_probes = 0
+        self.discovery_answers = 0
+        self.discovery_timeouts = 0
+
         self.tx_timeout_ms = 100
         self.last_tx_time = 0
 
@@ -83,23 +440,53 @@ class HUBDevice:
         self.adc_U_SIPM_MEAS = pyb.ADC(pyb.Pin.cpu.A3)
         self.adc_I_SIPM_MEAS = pyb.ADC(pyb.Pin.cpu.C2)
         self.adc_VSUP_MEAS = pyb.ADC(pyb.Pin.cpu.C3)
+        # Burst-averaged I_SIPM_MEAS (raw counts), U_SIPM_MEAS and VSUP_MEAS (V),
+        # started with main_loop(); see hub_adc_read()
+        self.adc_sampler = HubADCSampler(
+            (self.adc_I_SIPM_MEAS, self.adc_U_SIPM_MEAS, self.adc_VSUP_MEAS),
+            (1.0, self._adc_val_rr(1, 1, 33), self._adc_val_rr(1, 10, 43)),
+            logger=self.logger)
 
         self.msg_to_process = None
 
         self.logger_sync_active = True
+
+        self.calibration_store = CalibrationStore()  # CSV calibration parsed once, see load()
+
+        # Configuration plans: the frames default_procedure sends, packed once
+        # per (afe_id, UID, configuration hash) and replayed on re-configuration
+        self.use_config_plans = True
+        self.config_plans = {}  # afe_id -> ((afe_id, UID, hash), [frame, ...])
+        self.config_plan_builds = 0
+        self.config_plan_hits = 0
+        self._config_key_cache = {}  # calibration column -> (name, unit)
+
+        self.can_stats_log_every_ms = 60000  # 0 disables periodic logging of the CAN RX/TX counters
+        self.can_stats_log_timestamp_ms = 0
     
+    @property
+    def afe_devices(self) -> AFERegistry:
+        """Known AFEs in discovery order; see AFERegistry for the list-like API."""
+        return self.afe_registry
+
+    @afe_devices.setter
+    def afe_devices(self, afes):
+        self.afe_registry.clear()
+        for afe in afes:
+            self.afe_registry.add(afe)
+
     def _adc_val_rr(self, adc, R1, R2):
         return (3.3*adc/(4095))*((R1+R2)/R1)
     
-    def hub_adc_read(self):     
-        # Read ADC value from PA3
-        # adc_value = self.adc_pa3.read()
-        # await self.logger.log(VerbosityLevel["INFO"], {"info": "ADC PA3 value: {}".format(adc_value)}) 
-        # print("ADC PA3 value: {}\nADC PA3 value: {}".format(adc_value))
-        retavls = {"I_SIPM_MEAS": self.adc_I_SIPM_MEAS.read(),
-                   "U_SIPM_MEAS": self._adc_val_rr(self.adc_U_SIPM_MEAS.read(), 1, 33),
-                   "VSUP_MEAS": self._adc_val_rr(self.adc_VSUP_MEAS.read(), 10, 43)}
+    def hub_adc_read(self):
+        """Newest burst means of the ADC sampler, or single reads if it has not run yet."""
+        retavls = self.adc_sampler.latest()
+        if retavls is None:
+            retavls = {"I_SIPM_MEAS": self.adc_I_SIPM_MEAS.read(),
+                       "U_SIPM_MEAS": self._adc_val_rr(self.adc_U_SIPM_MEAS.read(), 1, 33),
+                       "VSUP_MEAS": self._adc_val_rr(self.adc_VSUP_MEAS.read(), 10, 43)}
         print(retavls)
+        return retavls
         
     def hub_update_afe_status(self):
         for afe in self.afe_devices:
@@ -132,9 +519,14 @@ class HUBDevice:
 
     async def reset_all(self):  # Changed to async def
         await self.stop_discovery()
-        self.afe_devices = []
+        for afe in self.afe_devices:
+            afe.stop_rx_task()
+        self.afe_registry.clear()
+        self.config_queue = []
+        self.config_progress = {}
         self.message_queue = []
         self.current_discovery_id = 1
+        self.discovery_started_ms = None
 
     async def close_all(self):  # Changed to async def
         await self.logger.log(VerbosityLevel["INFO"], {
@@ -195,6 +587,43 @@ class HUBDevice:
         self.msg_to_process = await self.can_interface.get()
         return self.msg_to_process
 
+    async def process_received_batch(self, timer=None):
+        """
+        Drain up to rx_batch_max frames from the CAN interface and process them
+        in a single pass of main_process. Frames of AFEs with their own receive
+        task are only copied to that AFE's queue.
+
+        Returns:
+            int: Number of frames dequeued.
+        """
+        count = 0
+        while count < self.rx_batch_max:
+            frame = self.can_interface.borrow()
+            if frame is None:
+                break
+            try:
+                await self.process_received_frame(frame)
+            finally:
+                self.can_interface.release()
+            count += 1
+        return count
+
+    async def process_received_frame(self, frame):
+        """
+        Process one frame borrowed from the CAN interface ring buffer.
+
+        The frame is copied into the owning AFE's receive queue if it runs its
+        own task, otherwise it is handed to the AFE without copying; it must
+        not be kept after this call returns.
+        """
+        if not self.rx_process_active:
+            return
+        if self.can_interface.dispatch(frame):
+            return
+        afe = await self._get_or_add_afe(frame.afe_id)
+        if afe is not None:
+            await afe.process_received_frame(frame)
+
     def _message_queue_len(self):
         return len(self.message_queue)
 
@@ -207,10 +636,7 @@ class HUBDevice:
         Returns:
             The AFEDevice object if found, otherwise None.
         """
-        for afe in self.afe_devices:
-            if afe.device_id == afe_id:
-                return afe
-        return None
+        return self.afe_registry.by_id.get(afe_id)
 
     # Changed to async def
     async def process_received_messages(self, timer=None):
@@ -232,22 +658,41 @@ class HUBDevice:
         if message is None:
             return
         afe_id = (message[0] >> 2) & 0xFF  # unmask the AFE ID
+        afe = await self._get_or_add_afe(afe_id)
+        if afe is None:
+            return
+        # Process the received data using the AFE device's method
+        await afe.process_received_data(message)
+
+    async def _get_or_add_afe(self, afe_id) -> AFEDevice:
+        """
+        Returns the AFE with afe_id, adding it when it is new. Returns None
+        for a new AFE once afe_devices_max are known: a discovery burst can
+        get more answers than there are free places.
+        """
         afe = self.get_afe_by_id(afe_id)
+        if afe is None and len(self.afe_registry) >= self.afe_devices_max:
+            return None
         if afe is None:  # Add new discovered AFE
             # Create a new AFE device instance with the discovered ID
-            afe = AFEDevice(self.can_interface, afe_id, logger=self.logger)
+            afe = AFEDevice(self.can_interface, afe_id, logger=self.logger,
+                            history_depth=self.measurement_history_depth,
+                            rollup_resolutions=self.measurement_rollups)
+            afe.pipeline_depth = self.afe_pipeline_depth
+            afe.save_periodic_data = self.afe_save_periodic_data
             await self.logger.log(VerbosityLevel["INFO"],
                                   {
                 "device_id": 0,
                 "timestamp_ms": millis(),
                 "info": "found new AFE {}".format(afe_id)
             })
-            # Add the new AFE device to the list of known devices
-            self.afe_devices.append(afe)
+            # Add the new AFE device to the registry of known devices
+            self.afe_registry.add(afe)
+            if self.use_afe_rx_tasks:
+                afe.start_rx_task()
             if not self.afe0:
                 self.afe0 = afe
-        # Process the received data using the AFE device's method
-        await afe.process_received_data(message)
+        return afe
 
     # Renamed to avoid conflict if old one is kept temporarily
     async def discover_devices_async(self):
@@ -256,10 +701,11 @@ class HUBDevice:
             return
 
         if len(self.afe_devices) >= self.afe_devices_max:  # Use >= for safety
-            self.stop_discovery()
+            await self.stop_discovery()
             return
 
-        if self.use_tx_delay and is_delay(self.last_tx_time, self.tx_delay_ms):
+        # The windowed sweep paces its bursts with discovery_burst_interval_ms
+        if not self.use_discovery_window and self.use_tx_delay and is_delay(self.last_tx_time, self.tx_delay_ms):
             return
 
         if self.can_interface.state() > 1:
@@ -278,10 +724,15 @@ class HUBDevice:
                     "error": "CAN bus warning state {}.".format(self.can_interface.state())})
             return
 
+        if self.use_discovery_window:
+            await self._discovery_sweep()
+            return
+
         if self.current_discovery_id > self.afe_id_max:
             self.current_discovery_id = self.afe_id_min
 
-        if not any(afe.is_online and afe.device_id == self.current_discovery_id for afe in self.afe_devices):
+        if not self.afe_registry.is_online(self.current_discovery_id):
+            self.update_can_filters(accept_all_afes=True)  # before the answer can arrive
             send_result = await self.can_interface.send(
                 toSend=b"\x00\x11",  # Command to request AFE presence/ID
                 can_address=self.current_discovery_id << 2,
@@ -293,8 +744,166 @@ class HUBDevice:
                 await self.logger.log(VerbosityLevel["DEBUG"], "Sent discovery to ID: {}".format(self.current_discovery_id))
         self.current_discovery_id += 1
 
+    def _discovery_reset(self):
+        """Starts a new sweep over afe_id_min..afe_id_max."""
+        flags = self.discovery_flags
+        for afe_id in range(256):
+            flags[afe_id] = 0
+            self.discovery_misses[afe_id] = 0
+        self.discovery_outstanding = []
+        self.discovery_wake_ms = None
+        self.current_discovery_id = self.afe_id_min
+        self.discovery_started_ms = millis()
+        self.discovery_unresolved = self.afe_id_max - self.afe_id_min + 1
+        self.discovery_sweep_ms = None
+        self.discovery_last_found_ms = None
+        self.discovery_probes = 0
+        self.discovery_answers = 0
+        self.discovery_timeouts = 0
+        self._discovery_last_burst_ms = time.ticks_add(self.discovery_started_ms, -self.discovery_burst_interval_ms)
+
+    def _discovery_resolve(self, afe_id):
+        """Marks afe_id as answered or timed out at least once in this sweep."""
+        if not self.discovery_flags[afe_id] & DISCOVERY_RESOLVED:
+            self.discovery_flags[afe_id] |= DISCOVERY_RESOLVED
+            self.discovery_unresolved -= 1
+            if self.discovery_unresolved == 0:
+                self.discovery_sweep_ms = time.ticks_diff(millis(), self.discovery_started_ms)
+
+    def _discovery_collect(self, now):
+        """
+        Retires answered and timed-out probes from the outstanding window.
+        Returns the number of probes retired.
+        """
+        outstanding = self.discovery_outstanding
+        retired = 0
+        i = 0
+        while i < len(outstanding):
+            afe_id = outstanding[i]
+            if self.afe_registry.is_online(afe_id):
+                self.discovery_answers += 1
+                self.discovery_misses[afe_id] = 0
+                self.discovery_last_found_ms = time.ticks_diff(now, self.discovery_started_ms)
+            elif time.ticks_diff(now, self.discovery_sent_ms[afe_id]) >= self.discovery_probe_timeout_ms:
+                self.discovery_timeouts += 1
+                misses = self.discovery_misses[afe_id]
+                if misses < 255:
+                    self.discovery_misses[afe_id] = misses + 1
+                backoff_ms = self.discovery_reprobe_min_ms << min(misses, 16)
+                if backoff_ms > self.discovery_reprobe_max_ms:
+                    backoff_ms = self.discovery_reprobe_max_ms
+                self.discovery_next_ms[afe_id] = time.ticks_add(now, backoff_ms)
+            else:
+                i += 1
+                continue
+            self.discovery_flags[afe_id] &= ~DISCOVERY_OUTSTANDING & 0xFF
+            outstanding[i] = outstanding[-1]
+            outstanding.pop()
+            self._discovery_resolve(afe_id)
+            retired += 1
+        return retired
+
+    async def _discovery_burst(self, now):
+        """
+        Sends up to discovery_burst probes, walking the ID range from
+        current_discovery_id and skipping IDs that are online, outstanding or
+        backing off. Returns when the next burst has work to do.
+        """
+        flags = self.discovery_flags
+        outstanding = self.discovery_outstanding
+        window = self.discovery_window
+        wake_ms = None
+        for afe_id in outstanding:
+            due_ms = time.ticks_add(self.discovery_sent_ms[afe_id], self.discovery_probe_timeout_ms)
+            if wake_ms is None or time.ticks_diff(due_ms, wake_ms) < 0:
+                wake_ms = due_ms
+        if len(outstanding) >= window:
+            return wake_ms  # an answer or the earliest timeout frees a slot
+
+        next_burst_ms = time.ticks_add(self._discovery_last_burst_ms, self.discovery_burst_interval_ms)
+        if time.ticks_diff(next_burst_ms, now) > 0:
+            return next_burst_ms
+
+        sent = 0
+        id_min = self.afe_id_min
+        id_max = self.afe_id_max
+        afe_id = self.current_discovery_id
+        for _ in range(id_max - id_min + 1):
+            if sent >= self.discovery_burst or len(outstanding) >= window:
+                break
+            if afe_id > id_max or afe_id < id_min:
+                afe_id = id_min
+            if self.afe_registry.is_online(afe_id):
+                self._discovery_resolve(afe_id)
+            elif not flags[afe_id] & DISCOVERY_OUTSTANDING:
+                if self.discovery_misses[afe_id] and time.ticks_diff(self.discovery_next_ms[afe_id], now) > 0:
+                    due_ms = self.discovery_next_ms[afe_id]
+                    if wake_ms is None or time.ticks_diff(due_ms, wake_ms) < 0:
+                        wake_ms = due_ms
+                else:
+                    self.update_can_filters(accept_all_afes=True)  # before the answer can arrive
+                    send_result = await self.can_interface.send(
+                        toSend=b"\x00\x11",  # Command to request AFE presence/ID
+                        can_address=afe_id << 2,
+                        timeout_ms=self.tx_timeout_ms
+                    )
+                    if send_result is not None:
+                        break  # TX ring full, try again on the next burst
+                    flags[afe_id] |= DISCOVERY_OUTSTANDING
+                    self.discovery_sent_ms[afe_id] = now
+                    outstanding.append(afe_id)
+                    self.discovery_probes += 1
+                    sent += 1
+            afe_id += 1
+        self.current_discovery_id = afe_id
+
+        if sent:
+            self._discovery_last_burst_ms = now
+            if len(outstanding) < window:
+                return time.ticks_add(now, self.discovery_burst_interval_ms)
+        if wake_ms is None:
+            # Every ID is online: look again later for AFEs that went offline
+            wake_ms = time.ticks_add(now, self.discovery_reprobe_min_ms)
+        return wake_ms
+
+    async def _discovery_sweep(self):
+        """
+        One pass of the windowed discovery: collects answers and timeouts,
+        then sends the next burst when it is due or the window got room.
+        """
+        if self.discovery_started_ms is None:
+            self._discovery_reset()
+        now = millis()
+        sweep_pending = self.discovery_unresolved > 0
+        retired = self._discovery_collect(now)
+        wake_ms = self.discovery_wake_ms
+        if retired or wake_ms is None or time.ticks_diff(wake_ms, now) <= 0:
+            self.discovery_wake_ms = await self._discovery_burst(now)
+        if sweep_pending and self.discovery_unresolved == 0:
+            await self.logger.log(VerbosityLevel["INFO"], {
+                "device_id": 0,
+                "timestamp_ms": millis(),
+                "info": "discovery sweep done",
+                "discovery": self.get_discovery_stats()})
+
+    def get_discovery_stats(self):
+        """Progress and timing of the current discovery sweep."""
+        return {
+            "active": self.discovery_active,
+            "id_range": [self.afe_id_min, self.afe_id_max],
+            "found": self.afe_registry.online_count,
+            "unresolved": self.discovery_unresolved,
+            "outstanding": len(self.discovery_outstanding),
+            "probes": self.discovery_probes,
+            "answers": self.discovery_answers,
+            "timeouts": self.discovery_timeouts,
+            "sweep_ms": self.discovery_sweep_ms,
+            "last_found_ms": self.discovery_last_found_ms,
+        }
+
     async def start_discovery(self):  # Changed to async def
         """ Start the device discovery process. """
+        self.discovery_started_ms = None  # the next pass starts a new sweep
         self.discovery_active = True
 
     async def stop_discovery(self):  # Changed to async def
@@ -302,14 +911,6 @@ class HUBDevice:
         self.discovery_active = False
         await p.print("STOP DISCOVERY")
 
-    def get_afe_by_id(self, afe_id) -> AFEDevice:
-        if len(self.afe_devices) == 0:
-            return None
-        for afe in self.afe_devices:
-            if afe.device_id == afe_id:
-                return afe
-        return None
-
     # # Changed to async def
     # async def get_configuration_from_files(self, afe_id, callibration_data_file_csv="dane_kalibracyjne.csv", TempLoop_file_csv="TempLoop.csv", UID=None):
     #     return await get_configuration_from_files(afe_id, callibration_data_file_csv, TempLoop_file_csv, UID)
@@ -659,9 +1260,9 @@ class HUBDevice:
         return None
 
     async def reset(self, afe_id=35):  # Changed to async def
-        for afe in self.afe_devices:
-            if afe.device_id == afe_id:
-                await afe.enqueue_command(0x03)
+        afe = self.get_afe_by_id(afe_id)
+        if afe is not None:
+            await afe.enqueue_command(0x03)
 
     async def test1(self, afe_id=35, command=0xF8):  # Changed to async def
         afe = self.get_afe_by_id(afe_id)
@@ -723,7 +1324,7 @@ class HUBDevice:
         if afe is None:
             return
 
-        configuration = await get_configuration_from_files(afe_id)
+        configuration = await self.calibration_store.get_configuration(afe_id)
         afe.configuration = configuration.copy()
         await afe.logger.log(VerbosityLevel["INFO"],
                              {
@@ -740,6 +1341,11 @@ class HUBDevice:
         if kwargs:
             commandKwargs.update(kwargs)
 
+        if self.use_config_plans:
+            for frame in self.get_configuration_plan(afe):
+                await afe.enqueue_frame(frame, **commandKwargs)
+            return
+
         for g in ["M", "S"]:
             ch_id = None
             avg_number = 256
@@ -848,6 +1454,96 @@ class HUBDevice:
         await afe.enqueue_u32_for_channel(AFECommand.startADC,
             0xFF, int(250), **commandKwargs) # for all channels (0xFF) (not implemented yet), every 500 ms
 
+    def _parse_configuration_key(self, k):
+        """Splits a calibration column like "V_opt [mV]" into ("V_opt", "mV"), cached."""
+        parsed = self._config_key_cache.get(k)
+        if parsed is None:
+            parts = k.split(" ")
+            unit = None
+            if len(parts) > 1:
+                units = extract_bracketed(parts[1])
+                if len(units):
+                    unit = units[0]
+            parsed = (parts[0], unit)
+            self._config_key_cache[k] = parsed
+        return parsed
+
+    @staticmethod
+    def _configuration_hash(configuration):
+        h = 0
+        for g in ("M", "S"):
+            for k, v in configuration[g].items():
+                h = (h * 31 + hash(k)) & 0x3FFFFFFF
+                h = (h * 31 + hash(v)) & 0x3FFFFFFF
+        return h
+
+    @staticmethod
+    def _pack_frame(command, channel, fmt, value):
+        frame = bytearray(3 + struct.calcsize(fmt))
+        frame[0] = command
+        frame[1] = 0x11  # chunk 1 of 1, as AFEDevice.prepare_command
+        frame[2] = channel
+        struct.pack_into(fmt, frame, 3, value)
+        return bytes(frame)
+
+    def compile_configuration(self, configuration):
+        """
+        Turns a configuration from get_configuration_from_files() into the
+        frames default_procedure sends, in the same order: the set commands
+        of the "M" and then the "S" calibration, each followed by the
+        averaging window and temperature loop period, and startADC last.
+
+        Returns:
+            list: bytes frames for AFEDevice.enqueue_frame().
+        """
+        frames = []
+        pack = self._pack_frame
+        for side, g in enumerate(("M", "S")):
+            avg_number = 256
+            time_sample_ms = 1000
+            general = CONFIGURATION_CHANNELS["general"][side]
+            for k, v in configuration[g].items():
+                ks, unit = self._parse_configuration_key(k)
+                if unit:
+                    v = convert_to_si(v, unit)
+                entry = CONFIGURATION_COMMANDS.get(ks)
+                if entry is not None:
+                    command, selector, fmt = entry
+                    frames.append(pack(command, CONFIGURATION_CHANNELS[selector][side], fmt,
+                                       int(v) if fmt == "<B" else v))
+                elif ks == "avg_number":  # Maximum nuber of samples used in averaging
+                    avg_number = int(round(v)) if v else 256
+                elif ks == "avg_mode":
+                    frames.append(bytes([AFECommand.setAveragingMode_byMask, 0x11,
+                                         CONFIGURATION_CHANNELS["subdevice"][side],
+                                         AFECommandAverage[v if v else "NONE"]]))
+                elif ks == "avg_alpha":  # Average parameter, usually weight
+                    frames.append(pack(AFECommand.setAveragingAlpha_byMask, general, "<f",
+                                       v if v else 1.0/(10000*100.0)))
+                elif ks == "time_sample":  # time sample
+                    time_sample_ms = int(round(v*1000)) if v else 1000
+                    frames.append(pack(AFECommand.setChannel_dt_ms_byMask, general, "<I", time_sample_ms))
+            frames.append(pack(AFECommand.setAveraging_max_dt_ms_byMask, general, "<I",
+                               int(round(time_sample_ms * avg_number))))
+            frames.append(pack(AFECommand.setTemperatureLoop_loop_every_ms, general, "<I", 100))
+        frames.append(pack(AFECommand.startADC, 0xFF, "<I", 250))
+        return frames
+
+    def get_configuration_plan(self, afe: AFEDevice):
+        """
+        Returns the frames of afe.configuration, compiling them only when the
+        AFE, its UID or the configuration changed since the last call.
+        """
+        key = (afe.device_id, afe.unique_id_str, self._configuration_hash(afe.configuration))
+        cached = self.config_plans.get(afe.device_id)
+        if cached is not None and cached[0] == key:
+            self.config_plan_hits += 1
+            return cached[1]
+        frames = self.compile_configuration(afe.configuration)
+        self.config_plans[afe.device_id] = (key, frames)
+        self.config_plan_builds += 1
+        return frames
+
     async def parse(self, msg):  # Changed to async def
         await p.print("Parsed: {}".format(msg))
 
@@ -873,32 +1569,269 @@ class HUBDevice:
     #     await afe.start_periodic_measurement_by_config()
 
 
+    def _discovery_probing(self):
+        """True while discovery probes may still get answers from unknown AFEs."""
+        if not self.discovery_active:
+            return False
+        if self.use_discovery_window:
+            return len(self.discovery_outstanding) > 0
+        return not is_timeout(self.last_tx_time, self.discovery_probe_timeout_ms)
+
+    def update_can_filters(self, accept_all_afes=None):
+        """
+        Keeps the CAN acceptance filters in line with afe_devices. While
+        discovery probes are outstanding every AFE frame is accepted so new
+        AFEs can answer; between bursts and sweeps only the known AFEs pass.
+        The discovery opens the filters itself before it sends a probe.
+        """
+        if not self.use_can_filters:
+            return
+        if accept_all_afes is None:
+            accept_all_afes = self._discovery_probing()
+        afes = self.afe_devices
+        key = self._can_filter_key
+        if key is not None and key[1] == accept_all_afes and len(key[0]) == len(afes):
+            ids = key[0]
+            for i in range(len(ids)):  # Compared in place, this runs every main_process pass
+                if ids[i] != afes[i].device_id:
+                    break
+            else:
+                return
+        ids = tuple(afe.device_id for afe in afes)
+        self._can_filter_key = (ids, accept_all_afes)
+        self.can_interface.set_afe_filters(ids, accept_all_afes=accept_all_afes)
+
+    def _on_afe_added(self, afe):
+        afe.schedule_callback = self._afe_ready
+        afe.manage_requested = False
+        afe.request_manage()
+
+    def _afe_ready(self, afe):
+        """AFEDevice.request_manage() callback: run manage_state() on the next pass."""
+        self.afe_ready.append(afe)
+        self.can_interface.wake()
+
+    def _sched_key(self, due_ms):
+        key = time.ticks_diff(due_ms, self._sched_epoch_ms)
+        if key > (1 << 28):
+            # Rebase before the keys get near the ticks_ms wrap
+            self._sched_epoch_ms = millis()
+            for entry in self.afe_deadlines:
+                entry[0] = time.ticks_diff(entry[2], self._sched_epoch_ms)
+            heapq.heapify(self.afe_deadlines)
+            key = time.ticks_diff(due_ms, self._sched_epoch_ms)
+        return key
+
+    def _schedule_afe(self, afe):
+        """Queues the next deadline reported by afe.next_due_ms(), if any."""
+        due_in_ms = afe.next_due_ms()
+        self._sched_seq += 1
+        afe.schedule_seq = self._sched_seq  # older heap entries of this AFE become stale
+        if due_in_ms is None:
+            return
+        if due_in_ms < 0:
+            due_in_ms = 0
+        due_ms = time.ticks_add(millis(), due_in_ms)
+        heapq.heappush(self.afe_deadlines, [self._sched_key(due_ms), self._sched_seq, due_ms, afe])
+
+    def _drop_stale_deadlines(self):
+        heap = self.afe_deadlines
+        while heap and (heap[0][1] != heap[0][3].schedule_seq or heap[0][3] not in self.afe_registry):
+            heapq.heappop(heap)
+
+    async def _manage_afe(self, afe):
+        self.afe_manage_runs += 1
+        await afe.manage_state()
+        if self.use_automatic_restart:
+            if not afe.is_configuration_started:
+                if self.use_config_tasks:
+                    self.queue_configuration(afe)
+                else:
+                    await self.default_full(afe_id=afe.device_id)
+            if afe.configuration.get("M", {}).get("automatic_restart"):
+                if afe.is_configured and afe.periodic_measurement_download_is_enabled is False:
+                    afe.periodic_measurement_download_is_enabled = True
+                    await afe.start_periodic_measurement_by_config()
+
+    async def _run_due_afes(self):
+        """Runs manage_state() only for AFEs that asked for it or whose deadline passed."""
+        ready = self.afe_ready
+        n = len(ready)
+        for i in range(n):
+            afe = ready[i]
+            afe.manage_requested = False
+            if afe in self.afe_registry:
+                await self._manage_afe(afe)
+                self._schedule_afe(afe)
+        del ready[:n]
+        heap = self.afe_deadlines
+        now_key = time.ticks_diff(millis(), self._sched_epoch_ms)
+        while heap and heap[0][0] <= now_key:
+            entry = heapq.heappop(heap)
+            afe = entry[3]
+            if entry[1] != afe.schedule_seq or afe not in self.afe_registry:
+                continue  # Stale: rescheduled or removed meanwhile
+            await self._manage_afe(afe)
+            self._schedule_afe(afe)
+
+    def queue_configuration(self, afe):
+        """
+        Queues default_full() for afe, started as its own task once one of
+        config_concurrency slots is free. Does nothing while the AFE is
+        already queued or configuring.
+        """
+        progress = self.config_progress.get(afe.device_id)
+        if progress is not None and progress["state"] in ("queued", "configuring"):
+            return
+        now = millis()
+        if self.fleet_bringup_start_ms is None:
+            self.fleet_bringup_start_ms = now
+        self.config_progress[afe.device_id] = {
+            "state": "queued",
+            "queued_ms": now,
+            "started_ms": None,
+            "done_ms": None,
+            "commands_total": 0,
+            "commands_left": 0,
+        }
+        self.config_queue.append(afe)
+        self._start_configurations()
+
+    def _start_configurations(self):
+        while self.config_queue and self.config_running < self.config_concurrency:
+            afe = self.config_queue.pop(0)
+            self.config_running += 1
+            uasyncio.create_task(self._configuration_task(afe))
+
+    async def _configuration_task(self, afe):
+        """Runs default_full() and waits until the AFE reports configured, fails or is removed."""
+        progress = self.config_progress[afe.device_id]
+        progress["state"] = "configuring"
+        progress["started_ms"] = millis()
+        try:
+            await self.default_full(afe_id=afe.device_id)
+            progress["commands_total"] = len(afe.to_execute) + len(afe.in_flight) + (afe.executing is not None)
+            while afe.is_configuration_started and not afe.is_configured and afe in self.afe_registry:
+                progress["commands_left"] = len(afe.to_execute) + len(afe.in_flight) + (afe.executing is not None)
+                await uasyncio.sleep_ms(self.config_poll_ms)
+            progress["state"] = "configured" if afe.is_configured else "failed"
+        except Exception as e:
+            progress["state"] = "failed"
+            await self.logger.log(VerbosityLevel["ERROR"], {
+                "device_id": afe.device_id,
+                "timestamp_ms": millis(),
+                "error": "configuration failed: {}".format(e)})
+        finally:
+            progress["done_ms"] = millis()
+            progress["commands_left"] = 0
+            self.config_running -= 1
+            self._start_configurations()
+        if self.config_running == 0 and self.fleet_bringup_start_ms is not None:
+            self.fleet_bringup_ms = time.ticks_diff(millis(), self.fleet_bringup_start_ms)
+            self.fleet_bringup_start_ms = None
+            await self.logger.log(VerbosityLevel["INFO"], {
+                "device_id": 0,
+                "timestamp_ms": millis(),
+                "info": "fleet configured",
+                "fleet": self.get_fleet_status(with_afes=False)})
+
+    def get_fleet_status(self, with_afes=True):
+        """Counts of configured, failed and pending AFEs and the bring-up time."""
+        counts = {"queued": 0, "configuring": 0, "configured": 0, "failed": 0}
+        for progress in self.config_progress.values():
+            counts[progress["state"]] += 1
+        status = {
+            "concurrency": self.config_concurrency,
+            "counts": counts,
+            "bringup_running_ms": time.ticks_diff(millis(), self.fleet_bringup_start_ms) if self.fleet_bringup_start_ms is not None else None,
+            "bringup_ms": self.fleet_bringup_ms,
+        }
+        if with_afes:
+            status["afes"] = {str(afe_id): progress for afe_id, progress in self.config_progress.items()}
+        return status
+
+    async def query_afes(self, command, data=None, afe_ids=None, timeout_ms=1000):
+        """
+        Sends the same command to every AFE (or those in afe_ids) at once and
+        waits for all replies, without a task or callback per AFE.
+        Returns {afe_id: retval dict, or {"error": ...} if it timed out}.
+        """
+        afes = [afe for afe in self.afe_devices if afe_ids is None or afe.device_id in afe_ids]
+        futures = []
+        for afe in afes:
+            futures.append(await afe.enqueue_command(command, data, timeout_ms=timeout_ms, future=True))
+        results = await wait_all(futures)
+        return {afe.device_id: (retval if not isinstance(retval, Exception) else {"error": str(retval)})
+                for afe, retval in zip(afes, results)}
+
     async def main_process(self, timer=None):
-        # Ensure message is dequeued before processing
-        await self._dequeue_message_copy(0)
+        self.update_can_filters()
         await self.discover_devices_async()  # Changed to async version
-        await self.process_received_messages(0)
+        await self.process_received_batch()
         if self.afe_manage_active:
-            for afe in self.afe_devices:
-                await afe.manage_state()
-                if self.use_automatic_restart:
-                    if not afe.is_configuration_started:
-                        await self.default_full(afe_id=afe.device_id)
-                    if afe.configuration["M"].get("automatic_restart"):
-                        if afe.is_configured and afe.periodic_measurement_download_is_enabled is False:
-                            afe.periodic_measurement_download_is_enabled = True
-                            await afe.start_periodic_measurement_by_config()
+            if self.use_afe_scheduler:
+                await self._run_due_afes()
+            else:
+                for afe in self.afe_devices:
+                    await self._manage_afe(afe)
+
+        if self.can_stats_log_every_ms and is_timeout(self.can_stats_log_timestamp_ms, self.can_stats_log_every_ms):
+            self.can_stats_log_timestamp_ms = millis()
+            await self.logger.log(VerbosityLevel["INFO"], {
+                "device_id": 0,
+                "timestamp_ms": millis(),
+                "can_stats": self.can_interface.get_stats().copy()})
 
         if self.curent_function is not None:  # check if function is running
             if is_timeout(self.curent_function_timestamp_ms, self.curent_function_timeout_ms):
                 self.curent_function = None
                 self.curent_function_retval = "timeout"
 
+    def _next_wakeup_ms(self):
+        """
+        Milliseconds until main_process has timed work to do (discovery probe
+        or the earliest AFE deadline). Received frames and AFEs asking to be
+        managed wake the loop through the RX flag.
+        """
+        wait_ms = self.main_loop_idle_ms
+        now = millis()
+        if self.discovery_active and self.use_discovery_window:
+            if self.discovery_started_ms is None:
+                wait_ms = 0
+            elif self.discovery_wake_ms is not None:
+                remaining = time.ticks_diff(self.discovery_wake_ms, now)
+                if remaining < wait_ms:
+                    wait_ms = remaining
+        elif self.discovery_active:
+            remaining = self.tx_delay_ms - time.ticks_diff(now, self.last_tx_time) if self.use_tx_delay else 0
+            if remaining < wait_ms:
+                wait_ms = remaining
+        if self.afe_manage_active and self.use_afe_scheduler:
+            if self.afe_ready:
+                wait_ms = 0
+            self._drop_stale_deadlines()
+            if self.afe_deadlines:
+                remaining = time.ticks_diff(self.afe_deadlines[0][2], now)
+                if remaining < wait_ms:
+                    wait_ms = remaining
+        elif self.afe_manage_active:
+            for afe in self.afe_devices:
+                if afe.to_execute and afe.executing is None:
+                    remaining = afe.tx_timeout_ms - time.ticks_diff(now, afe.execute_timestamp) if afe.use_tx_delay else 0
+                    if remaining < wait_ms:
+                        wait_ms = remaining
+        if wait_ms < self.main_loop_yield_ms:
+            wait_ms = self.main_loop_yield_ms
+        return wait_ms
+
     async def main_loop(self):
         while self.run:
             await self.main_process()
             wdt.feed()
-            await uasyncio.sleep_ms(self.main_loop_yield_ms)
+            if self.use_rx_event:
+                await self.can_interface.wait_rx(self._next_wakeup_ms())
+            else:
+                await uasyncio.sleep_ms(self.main_loop_yield_ms)
 
 
 # Changed to async def
@@ -101,6 +101,9 @@ class PybModule:
         SILENT_LOOPBACK = 3
         STOPPED = 1 # Example value, check real MicroPython for pyb.CAN.STOPPED
         MASK16 = 1 # Example value
+        LIST16 = 2
+        MASK32 = 3
+        LIST32 = 4
         # Add other states like WARNING, ERROR_PASSIVE, BUS_OFF if needed by logic
 
         def __init__(self, bus_id, **kwargs):
@@ -118,6 +121,9 @@ class PybModule:
         def setfilter(self, bank, mode, fifo, params, **kwargs):
             print(f"SIM: pyb.CAN({self.bus_id}).setfilter(bank={bank}, mode={mode}, fifo={fifo}, params={params})")
 
+        def clearfilter(self, bank):
+            print(f"SIM: pyb.CAN({self.bus_id}).clearfilter(bank={bank})")
+
         def send(self, data, id, timeout=0, rtr=False):
             data_bytes = bytes(data)
             print(f"SIM: pyb.CAN({self.bus_id}).send(data={data_bytes}, id={id}, timeout={timeout}, rtr={rtr})")
@@ -217,10 +223,57 @@ class PybModule:
             self._state = PybModule.CAN.NORMAL # Simulate successful restart
             self._rx_buffer.clear() # Clear buffer on restart
 
+    class ADC:
+        def __init__(self, pin):
+            self.pin = pin
+            self._value = 2048 # Mid-scale of the 12-bit converter
+
+        def read(self):
+            return self._value
+
+        @staticmethod
+        def read_timed_multi(adcs, bufs, timer):
+            # Blocks like the real one: len(buf) samples at the timer rate
+            for adc, buf in zip(adcs, bufs):
+                for i in range(len(buf)):
+                    buf[i] = adc._value
+            utime_compat.sleep_us(int(len(bufs[0]) * 1000000 / timer.freq()))
+            return True
+
+    class Timer:
+        def __init__(self, timer_id, freq=1000):
+            self.timer_id = timer_id
+            self._freq = freq
+
+        def freq(self):
+            return self._freq
+
+        def callback(self, fn):
+            # Ticks from the event loop at the timer rate instead of an IRQ
+            self._callback = fn
+            handle = getattr(self, "_handle", None)
+            if handle is not None:
+                handle.cancel()
+                self._handle = None
+            if fn is not None:
+                self._handle = asyncio.get_event_loop().call_later(1.0 / self._freq, self._tick)
+
+        def _tick(self):
+            self._handle = None
+            fn = getattr(self, "_callback", None)
+            if fn is not None:
+                fn(self)
+                if self._callback is fn and self._handle is None:
+                    self._handle = asyncio.get_event_loop().call_later(1.0 / self._freq, self._tick)
+
+        def deinit(self):
+            self.callback(None)
+
     def millis(self):
         # print("SIM: pyb.millis() called") # Can be too verbose
         return utime_compat.ticks_ms()
 
+PybModule.Pin.cpu = PybModule.cpu # pyb.Pin.cpu.E12 style access
 pyb = PybModule()
 
 
@@ -267,6 +320,34 @@ class UasyncioShim:
     def run(self, coro): # For uasyncio.run(main())
         return asyncio.run(coro)
 
+    # Synchronisation primitives used by the application
+    Event = asyncio.Event
+    TimeoutError = asyncio.TimeoutError
+
+    class ThreadSafeFlag:
+        """uasyncio.ThreadSafeFlag: set() may be called from scheduled callbacks, wait() clears it."""
+        def __init__(self):
+            self._event = asyncio.Event()
+
+        def set(self):
+            self._event.set()
+
+        def clear(self):
+            self._event.clear()
+
+        async def wait(self):
+            await self._event.wait()
+            self._event.clear()
+
+    async def wait_for(self, aw, timeout):
+        return await asyncio.wait_for(aw, timeout)
+
+    async def wait_for_ms(self, aw, timeout_ms):
+        return await asyncio.wait_for(aw, timeout_ms / 1000.0)
+
+    async def gather(self, *aws, return_exceptions=False):
+        return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+
 uasyncio = UasyncioShim()
 
 # --- Mock _thread module ---
@@ -467,12 +548,20 @@ def _setup_mocks():
     my_utilities_module.CommandStatus = actual_my_utilities.CommandStatus
     my_utilities_module.ResetReason = actual_my_utilities.ResetReason
     my_utilities_module.SensorChannel = actual_my_utilities.SensorChannel
+    my_utilities_module.MeasurementStore = actual_my_utilities.MeasurementStore
+    my_utilities_module.MeasurementRollups = actual_my_utilities.MeasurementRollups
+    my_utilities_module.CHANNEL_MASK_TABLE = actual_my_utilities.CHANNEL_MASK_TABLE
+    my_utilities_module.LatencyHistogram = actual_my_utilities.LatencyHistogram
+    my_utilities_module.ClockModel = actual_my_utilities.ClockModel
     my_utilities_module.extract_bracketed = actual_my_utilities.extract_bracketed
     my_utilities_module.read_callibration_csv = actual_my_utilities.read_callibration_csv
     my_utilities_module.channel_name_xxx = actual_my_utilities.channel_name_xxx
     my_utilities_module.e_ADC_CHANNEL = actual_my_utilities.e_ADC_CHANNEL
     my_utilities_module.get_e_ADC_CHANNEL = actual_my_utilities.get_e_ADC_CHANNEL
     my_utilities_module.rtc_synced = actual_my_utilities.rtc_synced # Global var from my_utilities
+    my_utilities_module.convert_to_si = actual_my_utilities.convert_to_si
+    my_utilities_module.get_configuration_from_files = actual_my_utilities.get_configuration_from_files
+    my_utilities_module.CalibrationStore = actual_my_utilities.CalibrationStore
 
     sys.modules['my_utilities'] = my_utilities_module
 
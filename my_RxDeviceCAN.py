@@ -1,3 +1,7 @@
+import os
+import time
+import struct
+from array import array
 try:
     import pyb
     import micropython
@@ -9,10 +13,233 @@ from my_utilities import p
 from my_utilities import millis
 from my_utilities import is_timeout
 from my_utilities import is_delay
+from my_utilities import AFECommand
+
+CAN_ID_SLAVE_BIT = 1 << 10  # set in every frame sent by an AFE
+CAN_ID_AFE_MASK = 0xFF << 2  # AFE ID field of the 11-bit identifier
+
+# Capture file: CAPTURE_HEADER, then fixed CAPTURE_RECORD_SIZE records of
+# ticks_us (u32), CAN id (u16), dlc (u8), flags (u8), data (8 bytes)
+CAPTURE_HEADER = b"CANCAP\x01\x10"
+CAPTURE_RECORD_FORMAT = "<IHBB"
+CAPTURE_RECORD_SIZE = 16
+CAPTURE_FLAG_TX = 0x01
+
+class RxFrame:
+    """
+    Pre-decoded view of one slot of the RxDeviceCAN ring buffer.
+
+    Objects are allocated once per slot and reused; the fields are refreshed
+    by decode() when the slot is borrowed. The payload memoryview points into
+    the slot buffer, so it is only valid until RxDeviceCAN.release().
+    """
+
+    def __init__(self, slot, raw):
+        self.slot = slot  # [id, is_extended, fmi, memoryview] as filled by pyb.CAN.recv
+        self.raw = raw  # 8-byte bytearray behind the slot memoryview
+        # One preallocated view per possible payload length (0..6 bytes),
+        # so selecting the payload does not allocate.
+        self.payload_views = [memoryview(raw)[2:2 + n] for n in range(7)]
+        self.data = memoryview(raw)[0:0]
+        self.payload = self.payload_views[0]
+        self.can_id = 0
+        self.dlc = 0
+        self.afe_id = 0
+        self.from_slave = 0
+        self.command = None
+        self.chunk_id = 0
+        self.max_chunks = 0
+        self.timestamp_us = 0  # time.ticks_us() when the frame left the hardware FIFO
+
+    def decode(self):
+        can_id = self.slot[0]
+        dlc = len(self.slot[3])
+        self.can_id = can_id
+        self.dlc = dlc
+        self.data = self.slot[3]
+        self.afe_id = (can_id >> 2) & 0xFF
+        self.from_slave = (can_id >> 10) & 0x001
+        if dlc >= 2:
+            self.command = self.raw[0]
+            self.chunk_id = self.raw[1] & 0x0F
+            self.max_chunks = (self.raw[1] >> 4) & 0x0F
+            self.payload = self.payload_views[dlc - 2]
+        else:
+            self.command = None
+            self.chunk_id = 0
+            self.max_chunks = 0
+            self.payload = self.payload_views[0]
+        return self
+
+    # Fixed-offset decoding of the frame data (offset 0 is the command byte,
+    # 2 the first payload byte). struct.unpack_from reads the slot buffer in
+    # place; None when the frame is too short for the value.
+    def u16_at(self, offset):
+        if self.dlc < offset + 2:
+            return None
+        return struct.unpack_from("<H", self.raw, offset)[0]
+
+    def u32_at(self, offset):
+        if self.dlc < offset + 4:
+            return None
+        return struct.unpack_from("<I", self.raw, offset)[0]
+
+    def float_at(self, offset):
+        if self.dlc < offset + 4:
+            return None
+        return struct.unpack_from("<f", self.raw, offset)[0]
+
+    @staticmethod
+    def from_message(message):
+        """Builds a standalone (allocating) frame from a get()-style [id, ext, fmi, data] message."""
+        data = bytes(message[3])
+        raw = bytearray(8)
+        raw[:len(data)] = data
+        frame = RxFrame([message[0], message[1], message[2], memoryview(raw)[:len(data)]], raw)
+        frame.timestamp_us = time.ticks_us()
+        return frame.decode()
+
+
+class RxQueue:
+    """
+    Small preallocated FIFO of frame copies owned by one consumer (one AFE).
+
+    RxDeviceCAN.dispatch() copies frames out of the shared ring into the
+    queue of their AFE, the AFE task takes them with borrow()/release()
+    and sleeps in wait() while the queue is empty. When the queue is full
+    the oldest telemetry frame (command marked in telemetry) is dropped, so
+    command replies are kept; with no telemetry frame queued the new frame
+    is dropped.
+    """
+
+    def __init__(self, size=16, key=None, telemetry=None):
+        self.size = size
+        self.key = key  # JSON object key of this queue in RxDeviceCAN.get_stats()
+        self.telemetry = telemetry  # bytearray(256), non-zero for telemetry command bytes
+        self.head = 0
+        self.tail = 0
+        self.frames = []
+        self.views = []  # per frame, one view of each length 0..8 over its buffer
+        for _ in range(size):
+            raw = bytearray(8)
+            self.frames.append(RxFrame([0, 0, 0, memoryview(raw)[0:0]], raw))
+            self.views.append([memoryview(raw)[:n] for n in range(9)])
+        self.borrowed_index = -1
+        self.flag = uasyncio.ThreadSafeFlag()
+        self.frames_total = 0
+        self.dropped = 0
+        self.reply_dropped = 0  # the part of dropped that were not telemetry frames
+        self.peak = 0
+
+    def pending(self):
+        n = self.head - self.tail
+        if n < 0:
+            n += self.size
+        return n
+
+    def is_telemetry(self, frame):
+        return self.telemetry is not None and frame.command is not None and self.telemetry[frame.command]
+
+    def _evict_telemetry(self):
+        """
+        Removes the oldest queued telemetry frame, except the borrowed one,
+        by rotating it to the last queued position and moving head back
+        onto it. Returns False when only replies are queued.
+        """
+        size = self.size
+        frames = self.frames
+        index = self.tail
+        while index != self.head:
+            if index != self.borrowed_index and self.is_telemetry(frames[index]):
+                break
+            index += 1
+            if index >= size:
+                index = 0
+        else:
+            return False
+        views = self.views
+        while True:
+            nxt = index + 1
+            if nxt >= size:
+                nxt = 0
+            if nxt == self.head:
+                break
+            frames[index], frames[nxt] = frames[nxt], frames[index]
+            views[index], views[nxt] = views[nxt], views[index]
+            index = nxt
+        self.head = index
+        return True
+
+    def put(self, frame):
+        """Copies a borrowed frame into the queue and wakes up the consumer."""
+        head = self.head + 1
+        if head >= self.size:
+            head = 0
+        if head == self.tail:  # Full
+            self.dropped += 1
+            if not self._evict_telemetry():
+                if not self.is_telemetry(frame):
+                    self.reply_dropped += 1
+                return
+        head = self.head
+        if head == self.borrowed_index:
+            self.dropped += 1  # Never overwrite the frame being processed
+            if not self.is_telemetry(frame):
+                self.reply_dropped += 1
+            return
+        dst = self.frames[head]
+        raw = dst.raw
+        data = frame.data
+        n = frame.dlc
+        for k in range(n):
+            raw[k] = data[k]
+        slot = dst.slot
+        slot[0] = frame.can_id
+        slot[3] = self.views[head][n]
+        dst.decode()
+        dst.timestamp_us = frame.timestamp_us
+        head += 1
+        if head >= self.size:
+            head = 0
+        self.head = head
+        self.frames_total += 1
+        n = self.pending()
+        if n > self.peak:
+            self.peak = n
+        self.flag.set()
+
+    def borrow(self):
+        """Returns the oldest queued frame, or None; the same frame until release()."""
+        if self.borrowed_index >= 0:
+            return self.frames[self.borrowed_index]
+        if self.head == self.tail:
+            return None
+        self.borrowed_index = self.tail
+        return self.frames[self.tail]
+
+    def release(self):
+        index = self.borrowed_index
+        if index < 0:
+            return
+        self.borrowed_index = -1
+        if self.tail == index:
+            self.tail += 1
+            if self.tail >= self.size:
+                self.tail = 0
+
+    async def wait(self):
+        """Waits until put() queues a frame (or wake() is called)."""
+        if self.head != self.tail:
+            return
+        await self.flag.wait()
+
+    def wake(self):
+        self.flag.set()
+
 
 class RxDeviceCAN:
     def __init__(self, can_bus, use_rxcallback=True):
-        self._send_ref = self._send
+        self._drain_tx_ref = self._drain_tx
         self.handle_can_rx_ref = self.handle_can_rx
         self.can_bus: pyb.CAN = can_bus
         self.use_rxcallback = use_rxcallback
@@ -20,89 +247,587 @@ class RxDeviceCAN:
         self.rx_message_buffer_max_len = 32
         self.rx_message_buffer_head = 0
         self.rx_message_buffer_tail = 0
-        self.rx_message_buffer = [
-            [0, 0, 0, memoryview(bytearray(8))]
-            for _ in range(self.rx_message_buffer_max_len)
-        ]
+        self.rx_message_buffer = []
+        self.rx_frames = []  # RxFrame per slot, used by borrow()/release()
+        for _ in range(self.rx_message_buffer_max_len):
+            raw = bytearray(8)
+            slot = [0, 0, 0, memoryview(raw)]
+            self.rx_message_buffer.append(slot)
+            self.rx_frames.append(RxFrame(slot, raw))
+        self.rx_borrowed_index = -1  # slot lent out by borrow(), -1 if none
+
+        # Second ring for periodic telemetry, so a telemetry flood can neither
+        # delay nor overwrite command replies. Frames are received into the
+        # reply ring and their slot is swapped into this ring when the command
+        # byte is marked in rx_telemetry_commands.
+        self.use_rx_priority = True
+        self.rx_telemetry_commands = bytearray(256)
+        self.rx_telemetry_commands[AFECommand.getSensorDataSi_periodic] = 1
+        self.rx_telemetry_buffer_max_len = 32
+        self.rx_telemetry_buffer_head = 0
+        self.rx_telemetry_buffer_tail = 0
+        self.rx_telemetry_buffer = []
+        self.rx_telemetry_frames = []
+        for _ in range(self.rx_telemetry_buffer_max_len):
+            raw = bytearray(8)
+            slot = [0, 0, 0, memoryview(raw)]
+            self.rx_telemetry_buffer.append(slot)
+            self.rx_telemetry_frames.append(RxFrame(slot, raw))
+        self.rx_telemetry_borrowed_index = -1
+
+        # Per-AFE queues filled by dispatch(), see register_afe()
+        self.afe_queues = {}
+        self.afe_queue_size = 16
+        self.afe_queues_dropped = 0  # frames dropped by queues that were unregistered since
+        self.afe_queues_reply_dropped = 0  # the replies among them
+
+        # Preallocated TX ring drained by a single scheduled callback. It holds
+        # a whole configuration burst (default_procedure is about 40 frames)
+        # of 8 AFEs; frames are 8-byte records in one buffer, 19 bytes
+        # per slot with the arrays below.
+        self.tx_buffer_max_len = 8 * 40 + 1  # one slot stays free to tell full from empty
+        self.tx_buffer_head = 0
+        self.tx_buffer_tail = 0
+        self.tx_buffer = bytearray(8 * self.tx_buffer_max_len)
+        # One buffer per possible frame length (0..8 bytes): a frame is copied
+        # into the one of its length for can.send, so the drain does not allocate
+        self.tx_staging = [bytearray(n) for n in range(9)]
+        self.tx_len = bytearray(self.tx_buffer_max_len)
+        self.tx_address = array('H', [0] * self.tx_buffer_max_len)
+        self.tx_timestamp_ms = array('I', [0] * self.tx_buffer_max_len)
+        self.tx_timeout_ms = array('I', [0] * self.tx_buffer_max_len)
+        self.tx_drain_scheduled = False
+        self.tx_draining = False
+        self.tx_retry_ms = 1  # main_loop period while frames wait for a free mailbox
+        self.tx_last_seq = 0  # sequence number of the last frame queued by send()
+        self.tx_done_seq = 0  # sequence number of the last frame sent or dropped
+        # Sequence numbers of the last frames dropped on timeout, see is_tx_failed()
+        self.tx_failed_seqs = [0] * 16
+        self.tx_failed_index = 0
+
+        # Frame capture, see start_capture(). Records are packed into this ring
+        # by the RX/TX handlers and written to capture_file by main_loop.
+        self.capture_records = 256
+        self.capture_buffer = bytearray(self.capture_records * CAPTURE_RECORD_SIZE)
+        self.capture_view = memoryview(self.capture_buffer)
+        self.capture_head = 0
+        self.capture_tail = 0
+        self.capture_file = None
+        self.capture_path = None
+        self.capture_frames = 0  # records written to capture_file
+        self.capture_dropped = 0  # records lost because main_loop did not write them out in time
+
+        # Hardware acceptance filters, programmed by set_afe_filters()
+        self.use_afe_filters = True
+        self.filter_fifo = 0
+        self.filter_bank_first = 0
+        self.filter_banks_max = 7  # MASK16 banks, two AFE IDs each; more AFEs fall back to the slave-bit filter
+        self.filter_banks_used = 1  # initialize_can_hub programs bank 0 to accept everything
+        self.filter_afe_ids = None  # tuple of AFE IDs in the filters, None: every AFE frame (slave bit) accepted
+        self.filter_programmed = False
+        self.filter_updates = 0
 
         self.running = True
         self.yielld_ms = 10
         self.error_yielld_ms = 100
+        self.backup_poll_ms = 100  # FIFO poll period when the RX interrupt is in use
         self.irq_flag = False
+        # Set by handle_can_rx() when frames were queued and by wake(); consumers await wait_rx()
+        self.rx_flag = uasyncio.ThreadSafeFlag()
+
+        # Instrumentation counters, plain ints so the IRQ and scheduled handlers do not allocate
+        self.rx_frames_total = 0  # frames moved from the hardware FIFO into the ring
+        self.rx_frames_overwritten = 0  # oldest frames dropped because the ring was full
+        self.rx_telemetry_total = 0  # frames routed to the telemetry ring
+        self.rx_telemetry_overwritten = 0  # telemetry frames dropped because the telemetry ring was full
+        self.rx_peak_occupancy = 0  # high-water mark of the ring
+        self.rx_fifo_full = 0  # rxcallback reason 1: hardware FIFO full
+        self.rx_fifo_overflow = 0  # rxcallback reason 2: hardware FIFO overflow, frame lost
+        self.rx_schedule_rejected = 0  # micropython.schedule queue full on the RX path
+        self.tx_schedule_rejected = 0  # micropython.schedule queue full on the TX path
+        self.tx_frames_sent = 0  # frames accepted by a hardware mailbox
+        self.tx_frames_failed = 0  # frames dropped after their timeout_ms without a free mailbox
+        self.tx_mailbox_full = 0  # drain passes stopped because all mailboxes were busy
+        self.tx_queue_full = 0  # send() calls that had to wait for a free ring slot
+        self.tx_peak_depth = 0  # high-water mark of the TX ring
+        self.stats_interval_ms = 1000  # period of the rate snapshot
+        self.stats_timestamp_ms = millis()
+        self._stats_last_rx_frames = 0
+        self._stats_last_overwritten = 0
+        self._stats_last_tx_frames = 0
+        self.stats = {
+            "rx_frames": 0,
+            "rx_overwritten": 0,
+            "rx_pending": 0,
+            "rx_telemetry_frames": 0,
+            "rx_telemetry_overwritten": 0,
+            "rx_telemetry_pending": 0,
+            "rx_telemetry_capacity": self.rx_telemetry_buffer_max_len,
+            "rx_peak_occupancy": 0,
+            "rx_capacity": self.rx_message_buffer_max_len,
+            "rx_fifo_full": 0,
+            "rx_fifo_overflow": 0,
+            "rx_schedule_rejected": 0,
+            "tx_schedule_rejected": 0,
+            "rx_frames_per_s": 0,
+            "rx_overwritten_per_s": 0,
+            "tx_frames": 0,
+            "tx_failed": 0,
+            "tx_pending": 0,
+            "tx_peak_depth": 0,
+            "tx_capacity": self.tx_buffer_max_len,
+            "tx_mailbox_full": 0,
+            "tx_queue_full": 0,
+            "tx_frames_per_s": 0,
+            "filter_afe_ids": None,
+            "filter_updates": 0,
+            "afe_rx_backlog": {},
+            "afe_rx_peak": {},
+            "afe_rx_dropped": 0,
+            "afe_rx_reply_dropped": 0,
+            "capture_path": None,
+            "capture_frames": 0,
+            "capture_dropped": 0,
+        }
  
         if self.use_rxcallback:
             # Register CAN RX interrupt, call safe ISR wrapper
             self.can_bus.rxcallback(0, self.handle_can_rx_irq)
-    def _send(self, args_tuple):
+    def set_afe_filters(self, afe_ids, accept_all_afes=False):
+        """
+        Programs the STM32 filter banks so filter_fifo only receives frames
+        sent by the AFEs in afe_ids (slave bit set, matching AFE ID field).
+        With accept_all_afes, an empty afe_ids or more IDs than the banks hold,
+        every frame with the slave bit is accepted instead, so discovery still
+        sees replies from AFEs that are not known yet.
+        Returns True if the filters were reprogrammed.
+        """
+        if not self.use_afe_filters:
+            return False
+        if accept_all_afes or len(afe_ids) == 0 or (len(afe_ids) + 1) // 2 > self.filter_banks_max:
+            ids = None
+        else:
+            ids = tuple(sorted(afe_ids))
+        if self.filter_programmed and ids == self.filter_afe_ids:
+            return False
+        can_bus = self.can_bus
+        bank = self.filter_bank_first
+        mask = CAN_ID_SLAVE_BIT | CAN_ID_AFE_MASK
+        if ids is None:
+            can_bus.setfilter(bank, can_bus.MASK16, self.filter_fifo,
+                              (CAN_ID_SLAVE_BIT, CAN_ID_SLAVE_BIT, CAN_ID_SLAVE_BIT, CAN_ID_SLAVE_BIT))
+            used = 1
+        else:
+            used = 0
+            for k in range(0, len(ids), 2):
+                id1 = CAN_ID_SLAVE_BIT | (ids[k] << 2)
+                id2 = CAN_ID_SLAVE_BIT | (ids[k + 1] << 2) if k + 1 < len(ids) else id1
+                can_bus.setfilter(bank + used, can_bus.MASK16, self.filter_fifo, (id1, mask, id2, mask))
+                used += 1
+        for unused in range(bank + used, bank + self.filter_banks_used):
+            can_bus.clearfilter(unused)
+        self.filter_banks_used = used
+        self.filter_afe_ids = ids
+        self.filter_programmed = True
+        self.filter_updates += 1
+        return True
+
+    def register_afe(self, afe_id):
+        """Creates (or returns) the RxQueue that dispatch() fills with frames from afe_id."""
+        queue = self.afe_queues.get(afe_id)
+        if queue is None:
+            queue = RxQueue(self.afe_queue_size, str(afe_id), self.rx_telemetry_commands)
+            self.afe_queues[afe_id] = queue
+        return queue
+
+    def unregister_afe(self, afe_id):
+        queue = self.afe_queues.pop(afe_id, None)
+        if queue is None:
+            return
+        self.afe_queues_dropped += queue.dropped
+        self.afe_queues_reply_dropped += queue.reply_dropped
+        self.stats["afe_rx_backlog"].pop(queue.key, None)
+        self.stats["afe_rx_peak"].pop(queue.key, None)
+        queue.wake()
+
+    def dispatch(self, frame):
         """
-        Internal method to perform the CAN send operation.
-        This is called by micropython.schedule.
-        args_tuple is expected to be (toSend, can_address, bus_timeout_ms).
+        Copies a borrowed frame into the queue of its AFE. Returns False if
+        no queue is registered for frame.afe_id, the caller handles it then.
         """
-        toSend, can_address, bus_timeout_ms = args_tuple
+        queue = self.afe_queues.get(frame.afe_id)
+        if queue is None:
+            return False
+        queue.put(frame)
+        return True
+
+    def start_capture(self, path="/sd/can_capture.bin"):
+        """
+        Starts appending every received and sent frame to path as fixed-size
+        binary records (see CAPTURE_HEADER). A new file gets the header first.
+        """
+        if self.capture_file is not None:
+            self.stop_capture()
         try:
-            self.can_bus.send(toSend, can_address, timeout=bus_timeout_ms)
-        except Exception as e:
-            p.print("Error in RxDeviceCAN._send (scheduled for {}): {}".format(can_address, e))
+            new_file = os.stat(path)[6] == 0
+        except OSError:
+            new_file = True
+        self.capture_file = open(path, "ab")
+        if new_file:
+            self.capture_file.write(CAPTURE_HEADER)
+        self.capture_path = path
+        self.capture_head = 0
+        self.capture_tail = 0
+
+    def stop_capture(self):
+        """Writes out the pending records and closes the capture file."""
+        if self.capture_file is None:
+            return
+        self.write_capture()
+        capture_file = self.capture_file
+        self.capture_file = None
+        capture_file.close()
 
-    async def send(self, toSend: bytearray, can_address, timeout_ms):
+    def _capture(self, timestamp_us, can_id, data, flags):
+        head = self.capture_head + 1
+        if head >= self.capture_records:
+            head = 0
+        if head == self.capture_tail:
+            self.capture_dropped += 1
+            return
+        offset = self.capture_head * CAPTURE_RECORD_SIZE
+        n = len(data)
+        struct.pack_into(CAPTURE_RECORD_FORMAT, self.capture_buffer, offset,
+                         timestamp_us & 0xFFFFFFFF, can_id, n, flags)
+        offset += 8
+        buf = self.capture_buffer
+        for k in range(n):
+            buf[offset + k] = data[k]
+        for k in range(n, 8):
+            buf[offset + k] = 0
+        self.capture_head = head
+
+    def write_capture(self):
+        """Writes the records packed since the last call to capture_file."""
+        capture_file = self.capture_file
+        if capture_file is None:
+            return
+        head = self.capture_head
+        tail = self.capture_tail
+        if head == tail:
+            return
+        if head > tail:
+            capture_file.write(self.capture_view[tail * CAPTURE_RECORD_SIZE:head * CAPTURE_RECORD_SIZE])
+            self.capture_frames += head - tail
+        else:
+            capture_file.write(self.capture_view[tail * CAPTURE_RECORD_SIZE:])
+            capture_file.write(self.capture_view[:head * CAPTURE_RECORD_SIZE])
+            self.capture_frames += self.capture_records - tail + head
+        self.capture_tail = head
+        capture_file.flush()
+
+    def tx_pending(self):
+        """Returns the number of frames waiting in the TX ring buffer."""
+        n = self.tx_buffer_head - self.tx_buffer_tail
+        if n < 0:
+            n += self.tx_buffer_max_len
+        return n
+
+    def _tx_enqueue(self, toSend, can_address, timeout_ms, length=None):
+        head = self.tx_buffer_head + 1
+        if head >= self.tx_buffer_max_len:
+            head = 0
+        if head == self.tx_buffer_tail:
+            return False  # Ring is full
+        i = self.tx_buffer_head
+        n = len(toSend) if length is None else length
+        if n > 8:
+            n = 8
+        buf = self.tx_buffer
+        offset = i * 8
+        for k in range(n):
+            buf[offset + k] = toSend[k]
+        self.tx_len[i] = n
+        self.tx_address[i] = can_address
+        self.tx_timestamp_ms[i] = millis()
+        self.tx_timeout_ms[i] = timeout_ms
+        self.tx_buffer_head = head
+        self.tx_last_seq += 1
+        depth = self.tx_pending()
+        if depth > self.tx_peak_depth:
+            self.tx_peak_depth = depth
+        return True
+
+    def _drain_tx(self, _=None):
+        """
+        Sends queued frames until the hardware mailboxes are full.
+        Runs from micropython.schedule; frames left over are retried by
+        main_loop every tx_retry_ms and by the next send().
+        """
+        self.tx_drain_scheduled = False
+        if self.tx_draining:
+            return
+        self.tx_draining = True
+        try:
+            buf = self.tx_buffer
+            while self.tx_buffer_tail != self.tx_buffer_head:
+                i = self.tx_buffer_tail
+                n = self.tx_len[i]
+                frame = self.tx_staging[n]
+                offset = i * 8
+                for k in range(n):
+                    frame[k] = buf[offset + k]
+                try:
+                    self.can_bus.send(frame, self.tx_address[i], timeout=0)
+                    self.tx_frames_sent += 1
+                    if self.capture_file is not None:
+                        self._capture(time.ticks_us(), self.tx_address[i], frame, CAPTURE_FLAG_TX)
+                except Exception:
+                    if not is_timeout(self.tx_timestamp_ms[i], self.tx_timeout_ms[i]):
+                        self.tx_mailbox_full += 1
+                        break  # All mailboxes busy, keep the frame queued
+                    self.tx_frames_failed += 1  # Give up on this frame
+                    self.tx_failed_seqs[self.tx_failed_index] = self.tx_done_seq + 1
+                    self.tx_failed_index = (self.tx_failed_index + 1) % len(self.tx_failed_seqs)
+                self.tx_done_seq += 1
+                self.tx_buffer_tail += 1
+                if self.tx_buffer_tail >= self.tx_buffer_max_len:
+                    self.tx_buffer_tail = 0
+        finally:
+            self.tx_draining = False
+
+    def _kick_tx(self):
+        """Schedules _drain_tx() unless it is already scheduled or there is nothing to send."""
+        if self.tx_drain_scheduled or self.tx_buffer_head == self.tx_buffer_tail:
+            return
+        try:
+            micropython.schedule(self._drain_tx_ref, 0)
+            self.tx_drain_scheduled = True
+        except RuntimeError:  # micropython.schedule queue is full, main_loop retries
+            self.tx_schedule_rejected += 1
+
+    def is_tx_done(self, seq):
+        """True once the frame with sequence number seq (see tx_last_seq) was sent or dropped."""
+        return seq <= self.tx_done_seq
+
+    def is_tx_failed(self, seq):
         """
-        Asynchronously schedules a CAN message send.
-        timeout_ms is used for both the scheduling attempt loop and the CAN bus operation itself.
-        Returns None on successful scheduling, -1 on scheduling timeout.
+        True when the frame with sequence number seq was dropped because no
+        mailbox got free within its timeout. Only the last len(tx_failed_seqs)
+        drops are remembered, check soon after is_tx_done(seq).
+        """
+        return seq in self.tx_failed_seqs
+
+    async def send(self, toSend: bytearray, can_address, timeout_ms, length=None):
+        """
+        Asynchronously queues a CAN message in the TX ring and schedules the drain.
+        timeout_ms bounds both the wait for a free ring slot and the time the frame
+        may wait for a free hardware mailbox. The frame is copied, so toSend may be
+        reused right away; its sequence number is available in tx_last_seq.
+        length sends only the first bytes of a larger buffer.
+        Returns None on successful queueing, -1 on timeout.
         """
         timestamp_ms = millis()
-        while True:
-            try:
-                micropython.schedule(self._send_ref, (toSend, can_address, timeout_ms))
-                return None  # Successful scheduling
-            except RuntimeError:  # micropython.schedule queue is full
-                pass  # Will retry after a short sleep
-            except Exception as e: # Other unexpected error during scheduling
-                p.print("Error during micropython.schedule in RxDeviceCAN.send: {}".format(e))
-                pass # Will retry
+        while not self._tx_enqueue(toSend, can_address, timeout_ms, length):
+            self.tx_queue_full += 1
+            self._kick_tx()
             if is_timeout(timestamp_ms, timeout_ms):
-                p.print("Timeout: RxDeviceCAN failed to schedule send to {} within {}ms".format(can_address, timeout_ms))
-                return -1  # Scheduling failed due to timeout
-            await uasyncio.sleep_ms(1) # Yield before retrying schedule
+                await p.print("Timeout: RxDeviceCAN failed to queue send to {} within {}ms".format(can_address, timeout_ms))
+                return -1  # Queueing failed due to timeout
+            await uasyncio.sleep_ms(1) # Yield before retrying
+        self._kick_tx()
+        return None
+
+    async def flush_tx(self, timeout_ms=1000):
+        """Waits until the TX ring is empty. Returns None on success, -1 on timeout."""
+        timestamp_ms = millis()
+        while self.tx_buffer_head != self.tx_buffer_tail:
+            self._kick_tx()
+            if is_timeout(timestamp_ms, timeout_ms):
+                return -1
+            await uasyncio.sleep_ms(self.tx_retry_ms)
+        return None
 
 
     async def get(self):
-        if self.rx_message_buffer_head == self.rx_message_buffer_tail:
+        frame = self.borrow()
+        if frame is None:
             return None
-        tmp = [self.rx_message_buffer[self.rx_message_buffer_tail][0],
-            self.rx_message_buffer[self.rx_message_buffer_tail][1],
-            self.rx_message_buffer[self.rx_message_buffer_tail][2],
-            bytearray(self.rx_message_buffer[self.rx_message_buffer_tail][3])]
-        self.rx_message_buffer_tail += 1
-        if self.rx_message_buffer_tail >= self.rx_message_buffer_max_len:
-            self.rx_message_buffer_tail = 0
+        slot = frame.slot
+        tmp = [slot[0], slot[1], slot[2], bytearray(slot[3])]
+        self.release()
         return tmp
-    
+
+    def borrow(self):
+        """
+        Returns the oldest pending frame as a pre-decoded RxFrame without
+        copying it out of the ring buffer, or None if the rings are empty.
+        Command replies are handed out before periodic telemetry.
+        The slot stays reserved until release() is called; calling borrow()
+        again before release() returns the same frame.
+        """
+        if self.rx_borrowed_index >= 0:
+            return self.rx_frames[self.rx_borrowed_index]
+        if self.rx_telemetry_borrowed_index >= 0:
+            return self.rx_telemetry_frames[self.rx_telemetry_borrowed_index]
+        if self.rx_message_buffer_head != self.rx_message_buffer_tail:
+            index = self.rx_message_buffer_tail
+            self.rx_borrowed_index = index
+            return self.rx_frames[index].decode()
+        if self.rx_telemetry_buffer_head != self.rx_telemetry_buffer_tail:
+            index = self.rx_telemetry_buffer_tail
+            self.rx_telemetry_borrowed_index = index
+            return self.rx_telemetry_frames[index].decode()
+        return None
+
+    def release(self):
+        """Returns the slot handed out by borrow() to its ring buffer."""
+        # The tail may already have moved on if the ring overflowed meanwhile
+        index = self.rx_borrowed_index
+        if index >= 0:
+            self.rx_borrowed_index = -1
+            if self.rx_message_buffer_tail == index:
+                self.rx_message_buffer_tail += 1
+                if self.rx_message_buffer_tail >= self.rx_message_buffer_max_len:
+                    self.rx_message_buffer_tail = 0
+            return
+        index = self.rx_telemetry_borrowed_index
+        if index >= 0:
+            self.rx_telemetry_borrowed_index = -1
+            if self.rx_telemetry_buffer_tail == index:
+                self.rx_telemetry_buffer_tail += 1
+                if self.rx_telemetry_buffer_tail >= self.rx_telemetry_buffer_max_len:
+                    self.rx_telemetry_buffer_tail = 0
+
+    def pending(self):
+        """Returns the number of frames waiting in the RX ring buffers."""
+        n = self.rx_message_buffer_head - self.rx_message_buffer_tail
+        if n < 0:
+            n += self.rx_message_buffer_max_len
+        return n + self.telemetry_pending()
+
+    def telemetry_pending(self):
+        """Returns the number of frames waiting in the telemetry ring buffer."""
+        n = self.rx_telemetry_buffer_head - self.rx_telemetry_buffer_tail
+        if n < 0:
+            n += self.rx_telemetry_buffer_max_len
+        return n
+
+    async def get_batch(self, max_n=None):
+        """
+        Dequeues up to max_n frames from the RX ring buffer in one call.
+        max_n=None drains everything that is currently pending.
+        Returns a (possibly empty) list of frames in the same format as get().
+        """
+        batch = []
+        if max_n is None:
+            max_n = self.rx_message_buffer_max_len
+        while len(batch) < max_n:
+            msg = await self.get()
+            if msg is None:
+                break
+            batch.append(msg)
+        return batch
+
+    # Drain mode: `async for msg in rxDeviceCAN:` yields frames until the ring is empty
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        msg = await self.get()
+        if msg is None:
+            raise StopAsyncIteration
+        return msg
+
 
     def handle_can_rx(self,_=None):
+        received = self.rx_frames_total
         try:
             while self.can_bus.any(0):
-                self.can_bus.recv(0, self.rx_message_buffer[self.rx_message_buffer_head], timeout=self.rx_timeout_ms)
-                self.rx_message_buffer_head += 1
-                if self.rx_message_buffer_head >= self.rx_message_buffer_max_len:
-                    self.rx_message_buffer_head = 0
-                if self.rx_message_buffer_head == self.rx_message_buffer_tail:
-                    self.rx_message_buffer_tail += 1
-                    if self.rx_message_buffer_tail >= self.rx_message_buffer_max_len:
-                        self.rx_message_buffer_tail = 0
+                if self.rx_message_buffer_head == self.rx_borrowed_index:
+                    # Never overwrite a borrowed slot, leave the rest in the hardware FIFO
+                    break
+                slot = self.rx_message_buffer[self.rx_message_buffer_head]
+                self.can_bus.recv(0, slot, timeout=self.rx_timeout_ms)
+                timestamp_us = time.ticks_us()
+                self.rx_frames[self.rx_message_buffer_head].timestamp_us = timestamp_us
+                self.rx_frames_total += 1
+                payload = slot[3]
+                if self.capture_file is not None:
+                    self._capture(timestamp_us, slot[0], payload, 0)
+                if self.use_rx_priority and len(payload) and self.rx_telemetry_commands[payload[0]]:
+                    self._route_to_telemetry(self.rx_message_buffer_head)
+                else:
+                    self.rx_message_buffer_head += 1
+                    if self.rx_message_buffer_head >= self.rx_message_buffer_max_len:
+                        self.rx_message_buffer_head = 0
+                    if self.rx_message_buffer_head == self.rx_message_buffer_tail:
+                        self.rx_frames_overwritten += 1
+                        self.rx_message_buffer_tail += 1
+                        if self.rx_message_buffer_tail >= self.rx_message_buffer_max_len:
+                            self.rx_message_buffer_tail = 0
+                occupancy = self.pending()
+                if occupancy > self.rx_peak_occupancy:
+                    self.rx_peak_occupancy = occupancy
         except Exception as e:
             p.print("handle_can_rx: {}",e)
             pass
+        if self.rx_frames_total != received:
+            self.rx_flag.set()
+
+    def _route_to_telemetry(self, index):
+        """Moves the frame just received into reply slot index to the telemetry ring by swapping the slots."""
+        head = self.rx_telemetry_buffer_head
+        if head == self.rx_telemetry_borrowed_index:
+            # Never overwrite a borrowed slot, drop the new frame instead
+            self.rx_telemetry_overwritten += 1
+            return
+        slot = self.rx_telemetry_buffer[head]
+        frame = self.rx_telemetry_frames[head]
+        self.rx_telemetry_buffer[head] = self.rx_message_buffer[index]
+        self.rx_telemetry_frames[head] = self.rx_frames[index]
+        self.rx_message_buffer[index] = slot
+        self.rx_frames[index] = frame
+        self.rx_telemetry_total += 1
+        head += 1
+        if head >= self.rx_telemetry_buffer_max_len:
+            head = 0
+        self.rx_telemetry_buffer_head = head
+        if head == self.rx_telemetry_buffer_tail:
+            self.rx_telemetry_overwritten += 1
+            self.rx_telemetry_buffer_tail += 1
+            if self.rx_telemetry_buffer_tail >= self.rx_telemetry_buffer_max_len:
+                self.rx_telemetry_buffer_tail = 0
+
+    def wake(self):
+        """Wakes up a task blocked in wait_rx(), e.g. after a command was enqueued."""
+        self.rx_flag.set()
+
+    async def wait_rx(self, timeout_ms):
+        """
+        Waits until handle_can_rx() queues frames, wake() is called or
+        timeout_ms elapses. Only yields if frames are already pending.
+        """
+        if timeout_ms <= 0 or self.pending():
+            await uasyncio.sleep_ms(0)
+            return
+        try:
+            await uasyncio.wait_for_ms(self.rx_flag.wait(), timeout_ms)
+        except uasyncio.TimeoutError:
+            pass
 
     # ISR → only schedules processing
     def handle_can_rx_irq(self, bus, reason=None):
+        if reason == 1:
+            self.rx_fifo_full += 1
+        elif reason == 2:
+            self.rx_fifo_overflow += 1
         try:
             micropython.schedule(self.handle_can_rx_ref, 0)
         except RuntimeError:
             # This can happen if the schedule queue is full.
-            # Depending on the application, you might want to log this or take other action.
-            pass # Silently ignore if queue is full, as the task will be picked up by polling or next IRQ.
+            # The frames stay in the FIFO and are picked up by polling or the next IRQ.
+            self.rx_schedule_rejected += 1
 
     async def _poll_and_schedule_rx(self):
         """Helper async method to poll for CAN messages and schedule handler."""
@@ -115,7 +840,7 @@ class RxDeviceCAN:
             except RuntimeError:
                 # Schedule queue is full. Message will hopefully be picked up
                 # by a subsequent IRQ or this poll's next attempt.
-                pass # pragma: no cover
+                self.rx_schedule_rejected += 1 # pragma: no cover
             except Exception as e_sched:
                 p.print("RxDeviceCAN._poll_and_schedule_rx: Error scheduling handle_can_rx: {}".format(e_sched)) # pragma: no cover
 
@@ -135,10 +860,104 @@ class RxDeviceCAN:
             # This acts as a primary mechanism if use_rxcallback is False,
             # or as a backup/general check if use_rxcallback is True.
             await self._poll_and_schedule_rx() # Call the simplified polling method
+            self._kick_tx() # Retry frames that found all mailboxes busy
+            self.write_capture()
+            self.update_stats()
 
             # except Exception as e:
             #     p.print("RxDeviceCAN.main_loop: Exception: {}".format(e)) # pragma: no cover
-            await uasyncio.sleep_ms(self.yielld_ms) # This controls the polling frequency
+            # This controls the polling frequency; with the RX interrupt polling is only a backup
+            if self.tx_buffer_head != self.tx_buffer_tail:
+                await uasyncio.sleep_ms(self.tx_retry_ms)
+            else:
+                await uasyncio.sleep_ms(self.backup_poll_ms if self.use_rxcallback else self.yielld_ms)
+
+    def update_stats(self, force=False):
+        """
+        Refreshes the per-second rates once every stats_interval_ms.
+        Called from main_loop; cheap enough to call on every pass.
+        """
+        if not force and not is_timeout(self.stats_timestamp_ms, self.stats_interval_ms):
+            return
+        now = millis()
+        elapsed_ms = time.ticks_diff(now, self.stats_timestamp_ms)
+        if elapsed_ms > 0:
+            self.stats["rx_frames_per_s"] = (self.rx_frames_total - self._stats_last_rx_frames) * 1000 // elapsed_ms
+            self.stats["rx_overwritten_per_s"] = (self.rx_frames_overwritten - self._stats_last_overwritten) * 1000 // elapsed_ms
+            self.stats["tx_frames_per_s"] = (self.tx_frames_sent - self._stats_last_tx_frames) * 1000 // elapsed_ms
+        self._stats_last_rx_frames = self.rx_frames_total
+        self._stats_last_overwritten = self.rx_frames_overwritten
+        self._stats_last_tx_frames = self.tx_frames_sent
+        self.stats_timestamp_ms = now
+
+    def get_stats(self):
+        """
+        Returns the RX/TX instrumentation as a dict. The dict is reused between
+        calls; copy it if it has to outlive the next call.
+        """
+        stats = self.stats
+        stats["rx_frames"] = self.rx_frames_total
+        stats["rx_overwritten"] = self.rx_frames_overwritten
+        stats["rx_pending"] = self.pending()
+        stats["rx_telemetry_frames"] = self.rx_telemetry_total
+        stats["rx_telemetry_overwritten"] = self.rx_telemetry_overwritten
+        stats["rx_telemetry_pending"] = self.telemetry_pending()
+        stats["rx_peak_occupancy"] = self.rx_peak_occupancy
+        stats["rx_fifo_full"] = self.rx_fifo_full
+        stats["rx_fifo_overflow"] = self.rx_fifo_overflow
+        stats["rx_schedule_rejected"] = self.rx_schedule_rejected
+        stats["tx_schedule_rejected"] = self.tx_schedule_rejected
+        stats["tx_frames"] = self.tx_frames_sent
+        stats["tx_failed"] = self.tx_frames_failed
+        stats["tx_pending"] = self.tx_pending()
+        stats["tx_peak_depth"] = self.tx_peak_depth
+        stats["tx_mailbox_full"] = self.tx_mailbox_full
+        stats["tx_queue_full"] = self.tx_queue_full
+        stats["filter_afe_ids"] = self.filter_afe_ids
+        stats["filter_updates"] = self.filter_updates
+        backlog = stats["afe_rx_backlog"]
+        peak = stats["afe_rx_peak"]
+        dropped = self.afe_queues_dropped
+        reply_dropped = self.afe_queues_reply_dropped
+        for queue in self.afe_queues.values():
+            key = queue.key
+            backlog[key] = queue.pending()
+            peak[key] = queue.peak
+            dropped += queue.dropped
+            reply_dropped += queue.reply_dropped
+        stats["afe_rx_dropped"] = dropped
+        stats["afe_rx_reply_dropped"] = reply_dropped
+        stats["capture_path"] = self.capture_path if self.capture_file is not None else None
+        stats["capture_frames"] = self.capture_frames
+        stats["capture_dropped"] = self.capture_dropped
+        return stats
+
+    def reset_stats(self):
+        """Clears all counters and the peak occupancy."""
+        self.rx_frames_total = 0
+        self.rx_frames_overwritten = 0
+        self.rx_telemetry_total = 0
+        self.rx_telemetry_overwritten = 0
+        self.rx_peak_occupancy = 0
+        self.rx_fifo_full = 0
+        self.rx_fifo_overflow = 0
+        self.rx_schedule_rejected = 0
+        self.tx_schedule_rejected = 0
+        self.tx_frames_sent = 0
+        self.tx_frames_failed = 0
+        self.tx_mailbox_full = 0
+        self.tx_queue_full = 0
+        self.tx_peak_depth = 0
+        self.afe_queues_dropped = 0
+        self.afe_queues_reply_dropped = 0
+        for queue in self.afe_queues.values():
+            queue.dropped = 0
+            queue.reply_dropped = 0
+            queue.peak = queue.pending()
+        self._stats_last_rx_frames = 0
+        self._stats_last_overwritten = 0
+        self._stats_last_tx_frames = 0
+        self.update_stats(force=True)
 
     def state(self):
         """Returns the current state of the CAN bus."""
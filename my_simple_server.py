@@ -13,7 +13,7 @@ from my_utilities import wdt
 from my_utilities import millis, is_timeout, is_delay
 from my_utilities import p, VerbosityLevel
 from my_utilities import rtc, rtc_synced, rtc_datetime_pretty, rtc_unix_timestamp
-from my_utilities import AFECommand, AFECommandSubdevice
+from my_utilities import AFECommand, AFECommandSubdevice, MeasurementStore
 from my_utilities import dump_json_sorted
 
 import uasyncio as asyncio
@@ -259,6 +259,49 @@ class AsyncWebServer:
 
             return None
     
+        elif procedure == "get_rollups":
+            # {"procedure": "get_rollups", "afe_id": 35, "resolution_s": 60,
+            #  "start": unix s, "end": unix s, "channels": ["U_SIPM_MEAS0", ...]}
+            # streams {"afe_id", "resolution_s", "columns", "channels": {name: [row, ...]}}
+            afe_device = self.hub.get_afe_by_id(request_json.get("afe_id", None))
+            if afe_device is None or afe_device.rollups is None:
+                return ujson.dumps({"status": "ERROR", "info": "No rollups for AFE {}".format(
+                    request_json.get("afe_id", None))}).encode()
+            # Convert every parameter before the header goes out, a bad
+            # value has to give an ERROR reply instead of a truncated one
+            try:
+                resolution_s = int(request_json.get("resolution_s", 60))
+                start_s = request_json.get("start", None)
+                end_s = request_json.get("end", None)
+                start_s = None if start_s is None else int(start_s)
+                end_s = None if end_s is None else int(end_s)
+            except (ValueError, TypeError):
+                return ujson.dumps({"status": "ERROR", "info": "Invalid resolution_s, start or end"}).encode()
+            if afe_device.rollups.level(resolution_s) is None:
+                return ujson.dumps({"status": "ERROR", "info": "Unknown resolution_s {}, have {}".format(
+                    resolution_s, afe_device.rollups.get_stats()["resolutions_s"])}).encode()
+            names = request_json.get("channels", None)
+            await writer.awrite(ujson.dumps({"afe_id": afe_device.device_id, "resolution_s": resolution_s})[:-1].encode())
+            await writer.awrite(b',"columns":["start","count","min","max","mean"],"channels":{')
+            first_channel = True
+            for ch in afe_device.channels:
+                if names is not None and ch.name not in names:
+                    continue
+                if not first_channel:
+                    await writer.awrite(b",")
+                first_channel = False
+                await writer.awrite(ujson.dumps(ch.name).encode() + b":[")
+                first_row = True
+                for row in afe_device.get_rollup_rows(ch.channel_id, resolution_s, start_s, end_s):
+                    if not first_row:
+                        await writer.awrite(b",")
+                    first_row = False
+                    await writer.awrite(ujson.dumps(row).encode())
+                await writer.awrite(b"]")
+            await writer.awrite(b"}}\r\n")
+
+            return None
+
         elif procedure == "get_all_latest_status":
             await writer.awrite(b"{")
 
@@ -272,7 +315,7 @@ class AsyncWebServer:
                 key_str = '"' + str(afe_device.device_id) + '":'
                 await writer.awrite(key_str.encode())
 
-                await write_json_dict(writer, afe_device.latest_status)
+                await write_json_dict(writer, afe_device.get_latest_status())
 
             await writer.awrite(b"}\r\n")
 
@@ -288,6 +331,98 @@ class AsyncWebServer:
                 await writer.awrite(str(afe_device.device_id).encode())
             await writer.awrite(b"]}\r\n")
 
+        elif procedure == "get_can_stats":
+            return ujson.dumps(self.hub.can_interface.get_stats()).encode()
+
+        elif procedure == "get_fleet_status":
+            return ujson.dumps(self.hub.get_fleet_status()).encode()
+
+        elif procedure == "query_afes":
+            command = getattr(AFECommand, str(request_json.get("command", "")), None)
+            if not isinstance(command, int):
+                return ujson.dumps({"status": "ERROR", "info": "Unknown command"}).encode()
+            # Validate before anything is sent, a bad value gives an ERROR reply
+            afe_ids = request_json.get("afe_ids", None)
+            try:
+                timeout_ms = int(request_json.get("timeout_ms", 1000))
+                if afe_ids is not None:
+                    if not isinstance(afe_ids, list):
+                        raise TypeError("afe_ids")
+                    afe_ids = [int(afe_id) for afe_id in afe_ids]
+            except (ValueError, TypeError):
+                return ujson.dumps({"status": "ERROR", "info": "Invalid afe_ids or timeout_ms"}).encode()
+            if timeout_ms <= 0:
+                return ujson.dumps({"status": "ERROR", "info": "Invalid afe_ids or timeout_ms"}).encode()
+            result = await self.hub.query_afes(command, afe_ids=afe_ids, timeout_ms=timeout_ms)
+            return ujson.dumps({"status": "OK", "result": {str(k): v for k, v in result.items()}}).encode()
+
+        elif procedure == "get_hub_adc":
+            sampler = self.hub.adc_sampler
+            return ujson.dumps({
+                "latest": sampler.latest(),
+                "mean_10s": sampler.mean(10000),
+                "stats": sampler.get_stats()}).encode()
+
+        elif procedure == "get_hub_adc_history":
+            try:
+                last = int(request_json.get("last", 100))
+            except (ValueError, TypeError):
+                return ujson.dumps({"status": "ERROR", "info": "Invalid last"}).encode()
+            if last < 0:
+                return ujson.dumps({"status": "ERROR", "info": "Invalid last"}).encode()
+            return ujson.dumps(self.hub.adc_sampler.history(last)).encode()
+
+        elif procedure == "get_discovery_stats":
+            return ujson.dumps(self.hub.get_discovery_stats()).encode()
+
+        elif procedure == "get_measurement_history":
+            afe_id = request_json.get("afe_id", None)
+            afe_device = self.hub.get_afe_by_id(afe_id)
+            if afe_device is None:
+                return ujson.dumps({"status": "ERROR", "info": "No AFE {}".format(afe_id)}).encode()
+            kind = request_json.get("kind", "last")
+            if kind not in MeasurementStore.KINDS:
+                return ujson.dumps({"status": "ERROR", "info": "Unknown kind {}".format(kind)}).encode()
+            last = request_json.get("last", None)
+            try:
+                last = None if last is None else int(last)
+            except (ValueError, TypeError):
+                return ujson.dumps({"status": "ERROR", "info": "Invalid last"}).encode()
+            if last is not None and last < 0:
+                return ujson.dumps({"status": "ERROR", "info": "Invalid last"}).encode()
+            result = {}
+            for ch in afe_device.channels:
+                result[ch.name] = afe_device.get_measurement_history(ch.channel_id, kind, last)
+            return ujson.dumps(result).encode()
+
+        elif procedure == "get_clock_models":
+            afe_id = request_json.get("afe_id", None)
+            result = {}
+            for afe_device in self.hub.afe_devices:
+                if afe_id is None or afe_device.device_id == afe_id:
+                    result[str(afe_device.device_id)] = afe_device.get_clock_stats()
+            return ujson.dumps(result).encode()
+
+        elif procedure == "can_capture_start":
+            path = request_json.get("path", "/sd/can_capture.bin")
+            try:
+                self.hub.can_interface.start_capture(path)
+            except OSError as e:
+                return ujson.dumps({"status": "ERROR", "info": "Cannot open {}: {}".format(path, e)}).encode()
+            return ujson.dumps({"status": "OK", "path": path}).encode()
+
+        elif procedure == "can_capture_stop":
+            self.hub.can_interface.stop_capture()
+            return ujson.dumps({"status": "OK", "frames": self.hub.can_interface.capture_frames}).encode()
+
+        elif procedure == "get_latency_histograms":
+            afe_id = request_json.get("afe_id", None)
+            result = {}
+            for afe_device in self.hub.afe_devices:
+                if afe_id is None or afe_device.device_id == afe_id:
+                    result[str(afe_device.device_id)] = afe_device.get_latency_stats()
+            return ujson.dumps(result).encode()
+
         elif procedure == "hub_close_all":
             await self.hub.close_all()
             return ujson.dumps({"status": "OK"}).encode()
@@ -451,10 +586,7 @@ class AsyncWebServer:
                 <div id="channels-afe-{}" class="afe-channels collapsible-content">
                 """.format(afe.device_id, afe.device_id))
                 for ch in afe.channels:
-                    # Formatting complex objects like ch.last_recieved_data directly
-                    # might still be an issue if they are very large.
-                    # For now, let's assume ujson.dumps is efficient enough for them.
-                    channel_data_str = ujson.dumps(ch.last_recieved_data)
+                    channel_data_str = ujson.dumps(afe.get_channel_data(ch.channel_id))
                     await writer.awrite("""
                     <div class="afe-channel">
                         <h5>Channel {}:</h5>
@@ -4,6 +4,7 @@ except:
     pass
 import json
 import os
+from array import array
 
 try:
     class DummyLock:
@@ -482,12 +483,478 @@ def dump_json_sorted(data):
 # Channel structure
 
 
+# Channels of every 8-bit channel mask, shared tuples
+CHANNEL_MASK_TABLE = tuple(tuple(ch for ch in range(8) if (mask >> ch) & 0x01) for mask in range(256))
+
+
 class SensorChannel:
     def __init__(self, channel_id):
         self.channel_id = channel_id
         self.config = {}
         self.name = e_ADC_CHANNEL[channel_id]
-        self.last_recieved_data = {"last": {}, "average": {}}
+
+
+class MeasurementStore:
+    """
+    Periodic measurements of one AFE. For every kind (last, average, bytes)
+    and channel a ring of `depth` values in an array('f') and their AFE
+    timestamps (ms) in an array('I'); ring r = kind * channels + channel
+    occupies [r * depth, (r + 1) * depth) of both arrays.
+
+    Values of a set arrive before their timestamp, so the decoder stage()s
+    them into the next slot of their ring and commit() adds the timestamp
+    and advances the staged rings of a kind. Nothing allocates on that
+    path; the dict views below are built only when asked for.
+    """
+    KIND_LAST = 0
+    KIND_AVERAGE = 1
+    KIND_BYTES = 2
+    KINDS = ("last", "average", "bytes")
+
+    def __init__(self, channels=8, depth=8):
+        self.channels = channels
+        self.depth = depth
+        rings = len(self.KINDS) * channels
+        self.values = array('f', [0.0] * (rings * depth))
+        self.timestamps = array('I', [0] * (rings * depth))
+        self.heads = array('H', [0] * rings)  # next slot per ring
+        self.counts = array('H', [0] * rings)
+        self.staged_masks = bytearray(len(self.KINDS))  # channel bit mask per kind
+        self.names = tuple(e_ADC_CHANNEL[ch] for ch in range(channels))
+        self.commits = 0
+
+    def clear_staged(self):
+        for kind in range(len(self.KINDS)):
+            self.staged_masks[kind] = 0
+
+    def stage(self, kind, mask, value):
+        """Stages value for every channel of the 8-bit channel mask."""
+        depth = self.depth
+        base = kind * self.channels
+        values = self.values
+        heads = self.heads
+        for ch in CHANNEL_MASK_TABLE[mask]:
+            ring = base + ch
+            values[ring * depth + heads[ring]] = value
+        self.staged_masks[kind] |= mask
+
+    def commit(self, kind, timestamp_ms):
+        """
+        Timestamps the staged values of kind and makes them the newest
+        entries. Returns the channel mask of the committed values.
+        """
+        mask = self.staged_masks[kind]
+        if mask == 0:
+            return 0
+        self.staged_masks[kind] = 0
+        depth = self.depth
+        base = kind * self.channels
+        timestamp_ms &= 0xFFFFFFFF
+        timestamps = self.timestamps
+        heads = self.heads
+        counts = self.counts
+        for ch in CHANNEL_MASK_TABLE[mask]:
+            ring = base + ch
+            head = heads[ring]
+            timestamps[ring * depth + head] = timestamp_ms
+            head += 1
+            heads[ring] = 0 if head == depth else head
+            if counts[ring] < depth:
+                counts[ring] += 1
+        self.commits += 1
+        return mask
+
+    def newest_value(self, kind, channel):
+        """Value of the newest entry (check latest() or commit()'s mask for presence)."""
+        ring = kind * self.channels + channel
+        return self.values[ring * self.depth + (self.heads[ring] - 1) % self.depth]
+
+    def latest(self, kind, channel):
+        """(timestamp_ms, value) of the newest entry, None if there is none."""
+        ring = kind * self.channels + channel
+        if self.counts[ring] == 0:
+            return None
+        index = ring * self.depth + (self.heads[ring] - 1) % self.depth
+        return self.timestamps[index], self.values[index]
+
+    def newest_into(self, kind, keys, target):
+        """
+        Stores the newest value of every channel of kind into target[keys[channel]]
+        and returns the newest timestamp among them (None when kind is empty).
+        """
+        depth = self.depth
+        base = kind * self.channels
+        newest_ms = None
+        for ch in range(self.channels):
+            ring = base + ch
+            if self.counts[ring]:
+                index = ring * depth + (self.heads[ring] - 1) % depth
+                target[keys[ch]] = self.values[index]
+                timestamp_ms = self.timestamps[index]
+                if newest_ms is None or timestamp_ms > newest_ms:
+                    newest_ms = timestamp_ms
+        return newest_ms
+
+    def history(self, kind, channel, last=None):
+        """[{"timestamp_ms": ..., "value": ...}, ...] oldest first; at most `last` entries."""
+        ring = kind * self.channels + channel
+        count = self.counts[ring]
+        n = count if last is None else min(last, count)
+        base = ring * self.depth
+        start = self.heads[ring] - n
+        retval = []
+        for k in range(n):
+            index = base + (start + k) % self.depth
+            retval.append({"timestamp_ms": self.timestamps[index], "value": self.values[index]})
+        return retval
+
+    def kind_view(self, kind, suffix=""):
+        """{channel name + suffix: {"timestamp_ms": ..., "value": ...}} of the newest entries of kind."""
+        retval = {}
+        for ch in range(self.channels):
+            entry = self.latest(kind, ch)
+            if entry is not None:
+                retval[self.names[ch] + suffix] = {"timestamp_ms": entry[0], "value": entry[1]}
+        return retval
+
+    def channel_view(self, channel):
+        """Newest entries of one channel as {"last": {value, bytes, timestamp_ms}, "average": {value, timestamp_ms}}."""
+        retval = {"last": {}, "average": {}}
+        last = self.latest(self.KIND_LAST, channel)
+        if last is not None:
+            retval["last"] = {"value": last[1], "timestamp_ms": last[0]}
+            raw = self.latest(self.KIND_BYTES, channel)
+            if raw is not None:
+                retval["last"]["bytes"] = raw[1]
+        average = self.latest(self.KIND_AVERAGE, channel)
+        if average is not None:
+            retval["average"] = {"value": average[1], "timestamp_ms": average[0]}
+        return retval
+
+    def get_stats(self):
+        return {
+            "channels": self.channels,
+            "depth": self.depth,
+            "commits": self.commits,
+            "bytes": len(self.values) * 4 + len(self.timestamps) * 4,
+        }
+
+
+class RollupLevel:
+    """
+    One resolution of MeasurementRollups: a ring of the newest `buckets`
+    buckets of resolution_s seconds, shared by all channels. Per bucket and
+    channel the count (array('I')) and min, max and running mean (array('f'))
+    of the values added while it was current; a float32 sum of a busy bucket
+    would lose the small values. A bucket is opened by the first value of
+    its interval, so intervals without data take no place. When the RTC
+    steps back, the buckets starting at or after the new one are dropped,
+    so the ring stays in time order.
+    """
+
+    def __init__(self, channels, resolution_s, buckets):
+        self.channels = channels
+        self.resolution_s = resolution_s
+        self.buckets = buckets
+        n = buckets * channels
+        self.starts = array('I', [0] * buckets)  # unix s of each bucket
+        self.counts = array('I', [0] * n)  # bucket b, channel ch at b * channels + ch
+        self.mins = array('f', [0.0] * n)
+        self.maxs = array('f', [0.0] * n)
+        self.means = array('f', [0.0] * n)
+        self.head = 0  # current bucket
+        self.used = 0
+        self.current_start = -1
+
+    def _open(self, start_s):
+        if start_s < self.current_start:  # RTC stepped back
+            while self.used and self.starts[self.head] >= start_s:
+                self.used -= 1
+                if self.used:
+                    self.head = self.head - 1 if self.head else self.buckets - 1
+        head = self.head
+        if self.used:
+            head += 1
+            if head == self.buckets:
+                head = 0
+        self.head = head
+        self.starts[head] = start_s
+        base = head * self.channels
+        for i in range(base, base + self.channels):
+            self.counts[i] = 0
+        self.current_start = start_s
+        if self.used < self.buckets:
+            self.used += 1
+
+    def add(self, channel, value, timestamp_s):
+        start_s = timestamp_s - timestamp_s % self.resolution_s
+        if start_s != self.current_start:
+            self._open(start_s)
+        i = self.head * self.channels + channel
+        count = self.counts[i]
+        if count == 0:
+            self.mins[i] = value
+            self.maxs[i] = value
+            self.means[i] = value
+        else:
+            if value < self.mins[i]:
+                self.mins[i] = value
+            elif value > self.maxs[i]:
+                self.maxs[i] = value
+            self.means[i] += (value - self.means[i]) / (count + 1)
+        self.counts[i] = count + 1
+
+    def rows(self, channel, start_s=None, end_s=None):
+        """Yields (start_s, count, min, max, mean) of the channel's buckets starting in [start_s, end_s), oldest first."""
+        channels = self.channels
+        index = self.head - self.used + 1
+        for _ in range(self.used):
+            b = index % self.buckets
+            index += 1
+            bucket_start = self.starts[b]
+            if start_s is not None and bucket_start < start_s:
+                continue
+            if end_s is not None and bucket_start >= end_s:
+                continue
+            i = b * channels + channel
+            count = self.counts[i]
+            if count:
+                yield bucket_start, count, self.mins[i], self.maxs[i], self.means[i]
+
+
+class MeasurementRollups:
+    """
+    Fixed-memory trend of every channel of one AFE at several resolutions,
+    updated value by value with add(). RESOLUTIONS are (bucket seconds,
+    buckets): 1 s for the last minute, 1 min for the last hour, 1 h for the
+    last day, 16 bytes per bucket and channel.
+    """
+    RESOLUTIONS = ((1, 60), (60, 60), (3600, 24))
+
+    def __init__(self, channels=8, resolutions=None):
+        if resolutions is None:
+            resolutions = self.RESOLUTIONS
+        self.channels = channels
+        self.levels = [RollupLevel(channels, resolution_s, buckets) for resolution_s, buckets in resolutions]
+        self.values = 0
+
+    def add(self, channel, value, timestamp_s):
+        timestamp_s = int(timestamp_s)
+        for level in self.levels:
+            level.add(channel, value, timestamp_s)
+        self.values += 1
+
+    def level(self, resolution_s):
+        """RollupLevel of resolution_s seconds, None if there is none."""
+        for level in self.levels:
+            if level.resolution_s == resolution_s:
+                return level
+        return None
+
+    def get_stats(self):
+        return {
+            "resolutions_s": [level.resolution_s for level in self.levels],
+            "buckets": [level.used for level in self.levels],
+            "values": self.values,
+            "bytes": sum(level.buckets * (4 + level.channels * 16) for level in self.levels),
+        }
+
+
+class LatencyHistogram:
+    """
+    Fixed-bucket histogram of latencies in microseconds. Counts are plain
+    ints in a preallocated list, so record() does not allocate.
+    Bucket i counts values <= bounds_us[i], the last bucket everything above.
+    The average is kept as mean_us plus a remainder (sum = mean_us * count +
+    mean_rem, 0 <= mean_rem < count) instead of a sum that would outgrow
+    the small int range.
+    """
+    bounds_us = (250, 500, 1000, 2000, 5000, 10000, 20000, 50000,
+                 100000, 200000, 500000, 1000000, 2000000, 5000000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.bounds_us) + 1)
+        self.count = 0
+        self.mean_us = 0
+        self.mean_rem = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def record(self, value_us):
+        bounds = self.bounds_us
+        i = 0
+        n = len(bounds)
+        while i < n and value_us > bounds[i]:
+            i += 1
+        self.counts[i] += 1
+        count = self.count + 1
+        self.count = count
+        rem = self.mean_rem + value_us - self.mean_us
+        q = rem // count
+        self.mean_us += q
+        self.mean_rem = rem - q * count
+        if self.min_us is None or value_us < self.min_us:
+            self.min_us = value_us
+        if value_us > self.max_us:
+            self.max_us = value_us
+
+    def percentile_us(self, percent):
+        """Upper bound of the bucket holding the given percentile (None above the last bound)."""
+        if self.count == 0:
+            return None
+        rank = self.count * percent / 100.0
+        seen = 0
+        for i, c in enumerate(self.counts):
+            seen += c
+            if seen >= rank:
+                return self.bounds_us[i] if i < len(self.bounds_us) else None
+        return None
+
+    def reset(self):
+        for i in range(len(self.counts)):
+            self.counts[i] = 0
+        self.count = 0
+        self.mean_us = 0
+        self.mean_rem = 0
+        self.min_us = None
+        self.max_us = 0
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "avg_us": self.mean_us if self.count else None,
+            "min_us": self.min_us,
+            "max_us": self.max_us,
+            "p50_us": self.percentile_us(50),
+            "p99_us": self.percentile_us(99),
+            "bounds_us": self.bounds_us,
+            "counts": self.counts,
+        }
+
+
+class ClockModel:
+    """
+    AFE clock (u32 ms) against HUB ticks_ms, fitted by least squares over
+    the last `window` sync pairs as hub = afe + offset + drift * afe.
+    Values are taken relative to the newest pair, so the floats stay small
+    and both counters may wrap. poll_interval_ms doubles from poll_min_ms up
+    to poll_max_ms while each new pair lands within tolerance_ms of the
+    prediction and drops back to poll_min_ms when one does not.
+    """
+
+    def __init__(self, window=16, min_samples=4, tolerance_ms=10, reset_ms=1000,
+                 poll_min_ms=500, poll_max_ms=60000):
+        self.window = window
+        self.min_samples = min_samples
+        self.tolerance_ms = tolerance_ms
+        self.reset_ms = reset_ms  # a larger jump means the AFE restarted
+        self.poll_min_ms = poll_min_ms
+        self.poll_max_ms = poll_max_ms
+        self.hub_ms = [0] * window
+        self.afe_ms = [0] * window
+        self.syncs = 0
+        self.resets = 0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.head = 0  # slot of the next pair
+        self.ref_hub_ms = None
+        self.ref_afe_ms = None
+        self.offset_ms = 0.0
+        self.drift = 0.0
+        self.rms_ms = None
+        self.last_error_ms = None
+        self.poll_interval_ms = self.poll_min_ms
+
+    @staticmethod
+    def _afe_diff(a, b):
+        d = (a - b) & 0xFFFFFFFF
+        return d - 0x100000000 if d & 0x80000000 else d
+
+    def is_fitted(self):
+        return self.count >= 2
+
+    def is_certain(self):
+        return self.count >= self.min_samples and self.rms_ms is not None and self.rms_ms <= self.tolerance_ms
+
+    def add(self, hub_ms, afe_ms):
+        """Adds a sync pair, refits and adapts poll_interval_ms."""
+        self.syncs += 1
+        error_ms = None
+        if self.is_fitted():
+            error_ms = time.ticks_diff(hub_ms, self.to_hub_ms(afe_ms))
+            if abs(error_ms) > self.reset_ms:
+                self.resets += 1
+                self.reset()
+                error_ms = None
+        self.last_error_ms = error_ms
+        self.hub_ms[self.head] = hub_ms
+        self.afe_ms[self.head] = afe_ms
+        self.head = (self.head + 1) % self.window
+        if self.count < self.window:
+            self.count += 1
+        self._fit(hub_ms, afe_ms)
+        if error_ms is not None and abs(error_ms) <= self.tolerance_ms and self.is_certain():
+            self.poll_interval_ms = min(self.poll_interval_ms * 2, self.poll_max_ms)
+        else:
+            self.poll_interval_ms = self.poll_min_ms
+
+    def _fit(self, ref_hub_ms, ref_afe_ms):
+        n = self.count
+        xs = [self._afe_diff(self.afe_ms[i], ref_afe_ms) for i in range(n)]
+        ds = [time.ticks_diff(self.hub_ms[i], ref_hub_ms) - xs[i] for i in range(n)]
+        mx = sum(xs) / n
+        md = sum(ds) / n
+        sxx = 0.0
+        sxd = 0.0
+        for i in range(n):
+            dx = xs[i] - mx
+            sxx += dx * dx
+            sxd += dx * (ds[i] - md)
+        drift = sxd / sxx if sxx > 0 else 0.0
+        offset = md - drift * mx
+        sse = 0.0
+        for i in range(n):
+            r = ds[i] - offset - drift * xs[i]
+            sse += r * r
+        self.ref_hub_ms = ref_hub_ms
+        self.ref_afe_ms = ref_afe_ms
+        self.offset_ms = offset
+        self.drift = drift
+        self.rms_ms = (sse / n) ** 0.5 if n >= 3 else None
+
+    def to_hub_ms(self, afe_ms):
+        """HUB ticks_ms at which the AFE clock showed afe_ms, None before the first pair."""
+        if self.ref_afe_ms is None:
+            return None
+        x = self._afe_diff(afe_ms, self.ref_afe_ms)
+        return time.ticks_add(self.ref_hub_ms, int(round(x + self.offset_ms + self.drift * x)))
+
+    def to_unix(self, afe_ms, now_ms=None, now_unix=None):
+        """RTC unix time (s, float) of afe_ms, through HUB ticks and the RTC now."""
+        hub_ms = self.to_hub_ms(afe_ms)
+        if hub_ms is None:
+            return None
+        if now_ms is None:
+            now_ms = time.ticks_ms()
+        if now_unix is None:
+            now_unix = rtc_unix_timestamp()
+        return now_unix - time.ticks_diff(now_ms, hub_ms) / 1000.0
+
+    def to_dict(self):
+        return {
+            "samples": self.count,
+            "certain": self.is_certain(),
+            "afe_ms": self.ref_afe_ms,  # newest pair, as fitted
+            "hub_ms": self.to_hub_ms(self.ref_afe_ms) if self.ref_afe_ms is not None else None,
+            "drift_ppm": -self.drift * 1e6,  # > 0: the AFE clock runs fast
+            "rms_ms": self.rms_ms,
+            "last_error_ms": self.last_error_ms,
+            "poll_interval_ms": self.poll_interval_ms,
+            "syncs": self.syncs,
+            "resets": self.resets,
+        }
 
 
 class JSONLogger:
@@ -1285,4 +1752,74 @@ async def get_configuration_from_files(afe_id, callibration_data_file_csv="dane_
                     #     VerbosityLevel["WARNING"], "Calibration data: AFE {}: No value {}, set to {}".format(afe_id, k, v))
                     callibration[g][k] = v  # set default value
             await uasyncio.sleep_ms(0)
-    return callibration
\ No newline at end of file
+    return callibration
+
+class CalibrationStore:
+    """
+    Calibration CSV files parsed once, with their rows indexed by ID and by
+    SN_AFE and the M/S means kept as defaults. get_configuration() returns
+    the same dict as get_configuration_from_files(); a file is parsed again
+    only when its size or mtime changes.
+    """
+
+    def __init__(self, callibration_data_file_csv="dane_kalibracyjne.csv", TempLoop_file_csv="TempLoop.csv"):
+        # Rows of the calibration file are applied before the TempLoop rows
+        self.files = (callibration_data_file_csv, TempLoop_file_csv)
+        self.stamps = {}  # path -> (size, mtime) of the parsed file
+        self.by_id = {}  # path -> {ID: [row, ...]}
+        self.by_uid = {}  # path -> {SN_AFE: [row, ...]}
+        self.means = {}  # path -> {"M": {...}, "S": {...}}
+        self.parses = 0  # CSV files parsed since boot
+        self.lookups = 0
+
+    @staticmethod
+    def _stamp(path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        return (st[6], st[8])  # st_size, st_mtime
+
+    async def load(self):
+        """Parses the files that are new or changed since the last call."""
+        for path in self.files:
+            stamp = self._stamp(path)
+            if path in self.stamps and self.stamps[path] == stamp:
+                continue
+            rows, means = await read_callibration_csv(path)
+            by_id = {}
+            by_uid = {}
+            for row in rows:
+                by_id.setdefault(row['ID'], []).append(row)
+                uid = row.get('SN_AFE')
+                if uid is not None:
+                    by_uid.setdefault(uid, []).append(row)
+            self.by_id[path] = by_id
+            self.by_uid[path] = by_uid
+            self.means[path] = means
+            self.stamps[path] = stamp
+            self.parses += 1
+
+    async def get_configuration(self, afe_id, UID=None):
+        """Calibration of one AFE, see get_configuration_from_files()."""
+        await self.load()
+        self.lookups += 1
+        callibration = {'ID': afe_id}
+        for path in self.files:
+            if UID is not None:
+                rows = [c for c in self.by_uid[path].get(UID, ()) if c['ID'] == afe_id]
+            else:
+                rows = self.by_id[path].get(afe_id, ())
+            for c in rows:
+                g = c['M/S']
+                if g not in callibration:
+                    callibration[g] = {}
+                callibration[g].update(c)
+        for path in self.files:
+            for g in ['M', 'S']:
+                for k, v in self.means[path][g].items():
+                    if k not in callibration[g]:  # no key
+                        callibration[g][k] = ''
+                    elif len(str(callibration[g][k])) == 0:  # empty string:
+                        callibration[g][k] = v  # set default value
+        return callibration
@@ -0,0 +1,1547 @@
+# run_benchmark.py
+import time as host_time  # host clock for CPU usage, before the sim replaces 'time'
+import micropython_sim  # This import initializes and injects all the mocks
+import struct
+import sys
+import gc
+import random
+import tracemalloc
+import time  # utime_compat after micropython_sim is imported
+import uasyncio
+
+from my_utilities import AFECommand, VerbosityLevel
+from my_RxDeviceCAN import RxDeviceCAN, RxFrame
+from AFE import AFEDevice, REPLY_DECODERS, REPLY_CHANNEL_CONFIG
+from HUB import HUBDevice, HubADCSampler
+import pyb
+from my_utilities import get_configuration_from_files, CalibrationStore, ClockModel, MeasurementRollups
+from my_utilities import e_ADC_CHANNEL
+
+print("BENCH: Mocks initialized.")
+
+
+class BenchCAN:
+    """
+    Quiet in-memory replacement for pyb.CAN used by the benchmarks.
+    Frames added with inject() are returned by recv() in FIFO order,
+    the memoryview in the receive list is resized to the frame length
+    the same way the pyboard port does it.
+    """
+
+    MASK16 = 1
+
+    def __init__(self, mailboxes=None):
+        self.rx = []
+        self.sent = 0
+        self.mailboxes = mailboxes  # None: every send() succeeds
+        self.in_flight = 0
+        self.responder = None  # called with (data, id) for every frame sent, may inject replies
+
+    def inject(self, can_id, data):
+        self.rx.append((can_id, data))
+
+    def rxcallback(self, fifo, func):
+        pass
+
+    def any(self, fifo):
+        return len(self.rx) > 0
+
+    def recv(self, fifo, list_or_buf=None, timeout=5000):
+        can_id, data = self.rx.pop(0)
+        buf = list_or_buf[3].obj
+        buf[:len(data)] = data
+        list_or_buf[0] = can_id
+        list_or_buf[1] = False
+        list_or_buf[2] = 0
+        list_or_buf[3] = memoryview(buf)[:len(data)]
+
+    def send(self, data, id, timeout=0, rtr=False):
+        if self.mailboxes is not None:
+            if self.in_flight >= self.mailboxes:
+                raise OSError(110)  # ETIMEDOUT, as pyb.CAN with no free mailbox
+            self.in_flight += 1
+        self.sent += 1
+        if self.responder is not None:
+            self.responder(data, id)
+
+    def bus_tick(self, frames):
+        """Lets `frames` frames leave the mailboxes (bus time passing)."""
+        self.in_flight = max(0, self.in_flight - frames)
+
+    def setfilter(self, bank, mode, fifo, params, **kwargs):
+        pass
+
+    def clearfilter(self, bank):
+        pass
+
+    def state(self):
+        return 0
+
+    def restart(self):
+        pass
+
+
+class BenchLogger:
+    """Logger which drops every entry, so the benchmarks measure only the decode path."""
+
+    def __init__(self):
+        self.verbosity_level = VerbosityLevel["INFO"]
+
+    async def log(self, level, message):
+        pass
+
+    async def sync(self):
+        pass
+
+
+def periodic_frames(afe_id, value=1.0):
+    """One getSensorDataSi_periodic set (5 chunks) as sent by an AFE."""
+    can_id = (afe_id << 2) | (1 << 10)
+    max_chunks = 4
+    frames = []
+    for chunk_id in range(max_chunks + 1):
+        if chunk_id in (2, 4):
+            payload = struct.pack('<BI', 0xFF, 1000 * chunk_id)
+        else:
+            payload = struct.pack('<Bf', 0xFF, value)
+        frames.append((can_id, bytes([AFECommand.getSensorDataSi_periodic,
+                                      (max_chunks << 4) | chunk_id]) + payload))
+    return frames
+
+
+def make_hub(n_afe, use_afe_rx_tasks=True):
+    can_bus = BenchCAN()
+    rx = RxDeviceCAN(can_bus, use_rxcallback=False)
+    hub = HUBDevice(can_bus, logger=BenchLogger(), rxDeviceCAN=rx)
+    hub.rx_process_active = True
+    hub.use_afe_rx_tasks = use_afe_rx_tasks
+    for afe_id in range(1, n_afe + 1):
+        afe = AFEDevice(rx, afe_id, logger=hub.logger)
+        hub.afe_devices.append(afe)
+        if use_afe_rx_tasks:
+            afe.start_rx_task()
+    return can_bus, rx, hub
+
+
+def stop_hub(hub):
+    for afe in hub.afe_devices:
+        afe.stop_rx_task()
+
+
+async def bench_rx_throughput(rx_batch_max, n_afe=32, burst=8, duration_ms=1000):
+    """
+    Offers `burst` frames every millisecond (as the CAN ISR would) and lets the
+    HUB consume them the same way HUBDevice.main_loop does.
+    """
+    can_bus, rx, hub = make_hub(n_afe)
+    hub.rx_batch_max = rx_batch_max
+    traffic = []
+    for afe_id in range(1, n_afe + 1):
+        traffic.extend(periodic_frames(afe_id))
+    stats = {"offered": 0, "processed": 0}
+    running = [True]
+
+    async def producer():
+        i = 0
+        while running[0]:
+            for _ in range(burst):
+                can_id, data = traffic[i % len(traffic)]
+                can_bus.inject(can_id, data)
+                i += 1
+            stats["offered"] += burst
+            rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    async def consumer():
+        while running[0]:
+            stats["processed"] += await hub.process_received_batch()
+            await uasyncio.sleep_ms(hub.main_loop_yield_ms)
+
+    tasks = [uasyncio.create_task(producer()), uasyncio.create_task(consumer())]
+    start = time.ticks_ms()
+    await uasyncio.sleep_ms(duration_ms)
+    running[0] = False
+    await uasyncio.sleep_ms(5)
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), start)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    stats["lost"] = stats["offered"] - stats["processed"] - rx.pending() + rx.get_stats()["afe_rx_dropped"]
+    stats["frames_per_s"] = int(stats["processed"] * 1000 / elapsed_ms)
+    return stats
+
+
+async def bench_idle_and_latency(use_rx_event, n_frames=100, period_ms=7):
+    """
+    Runs HUBDevice.main_loop with sparse traffic. Reports CPU time used by
+    the process while idle and the delay between a frame entering the ring
+    (handle_can_rx) and the HUB processing it.
+    """
+    can_bus, rx, hub = make_hub(4)
+    hub.use_rx_event = use_rx_event
+    passes = [0]
+    latencies_us = []
+    injected_us = [0]
+
+    main_process = hub.main_process
+    async def counting_main_process(timer=None):
+        passes[0] += 1
+        await main_process(timer)
+    hub.main_process = counting_main_process
+
+    process_received_frame = hub.process_received_frame
+    async def timed_process_received_frame(frame):
+        latencies_us.append(time.ticks_diff(time.ticks_us(), injected_us[0]))
+        await process_received_frame(frame)
+    hub.process_received_frame = timed_process_received_frame
+
+    loop_task = uasyncio.create_task(hub.main_loop())
+
+    # Idle: no traffic at all
+    await uasyncio.sleep_ms(50)
+    passes[0] = 0
+    cpu_start = host_time.process_time()
+    await uasyncio.sleep_ms(1000)
+    idle_cpu_percent = (host_time.process_time() - cpu_start) * 100.0
+    idle_passes = passes[0]
+
+    # Sparse traffic: one frame every period_ms
+    frame = periodic_frames(1)[0]
+    for _ in range(n_frames):
+        can_bus.inject(*frame)
+        injected_us[0] = time.ticks_us()
+        rx.handle_can_rx()
+        await uasyncio.sleep_ms(period_ms)
+
+    hub.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    loop_task.cancel()
+    stop_hub(hub)
+    latencies_us.sort()
+    return {
+        "idle_passes_per_s": idle_passes,
+        "idle_cpu_percent": idle_cpu_percent,
+        "latency_avg_us": sum(latencies_us) // len(latencies_us),
+        "latency_max_us": latencies_us[-1],
+    }
+
+
+async def bench_tx_burst(n_afe=8, frames_per_afe=40, mailboxes=3, frames_per_ms=4):
+    """
+    Every AFE queues its configuration burst at once through RxDeviceCAN.send
+    while the bus empties the hardware mailboxes at a 500 kbit/s-like rate.
+    """
+    can_bus = BenchCAN(mailboxes=mailboxes)
+    rx = RxDeviceCAN(can_bus, use_rxcallback=False)
+    loop_task = uasyncio.create_task(rx.main_loop())
+    running = [True]
+
+    async def bus():
+        while running[0]:
+            can_bus.bus_tick(frames_per_ms)
+            await uasyncio.sleep_ms(1)
+
+    send_us = []
+
+    async def afe_burst(afe_id):
+        frame = bytearray(8)
+        for i in range(frames_per_afe):
+            frame[0] = i
+            t0 = time.ticks_us()
+            await rx.send(frame, afe_id << 2, timeout_ms=1000)
+            send_us.append(time.ticks_diff(time.ticks_us(), t0))
+
+    bus_task = uasyncio.create_task(bus())
+    start = time.ticks_ms()
+    await uasyncio.gather(*[afe_burst(afe_id) for afe_id in range(1, n_afe + 1)])
+    flushed = await rx.flush_tx(timeout_ms=5000)
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), start)
+    running[0] = False
+    rx.run = False
+    await uasyncio.sleep_ms(5)
+    bus_task.cancel()
+    loop_task.cancel()
+    stats = rx.get_stats()
+    send_us.sort()
+    return {
+        "frames": n_afe * frames_per_afe,
+        "elapsed_ms": elapsed_ms,
+        "flushed": flushed is None,
+        "send_max_us": send_us[-1],
+        "tx_frames": stats["tx_frames"],
+        "tx_failed": stats["tx_failed"],
+        "tx_peak_depth": stats["tx_peak_depth"],
+        "tx_mailbox_full": stats["tx_mailbox_full"],
+        "tx_queue_full": stats["tx_queue_full"],
+    }
+
+
+async def bench_reply_under_telemetry(use_rx_priority, n_afe=8, burst=2, n_commands=50, timeout_ms=150,
+                                      stall_every_ms=100, stall_ms=40):
+    """
+    Streams periodic telemetry from every AFE while AFE 1 executes getVersion
+    commands one after another. Every stall_every_ms the HUB stops reading the
+    ring for stall_ms (as during a log file sync to the SD card), so telemetry
+    piles up behind, or on top of, the pending reply. Counts commands that
+    completed and those that hit their timeout_ms in AFEDevice.manage_state.
+    """
+    can_bus, rx, hub = make_hub(n_afe)
+    rx.use_rx_priority = use_rx_priority
+    hub.afe_manage_active = True
+    for afe in hub.afe_devices:
+        afe.use_afe_can_watchdog = False
+    afe = hub.afe_devices[0]
+    afe.pipeline_depth = 1  # stop-and-wait with tx_timeout_ms pacing, as when this case was written
+    reply = ((afe.device_id << 2) | (1 << 10), bytes([AFECommand.getVersion, 0x00, 1, 2]))
+
+    def responder(data, can_id):
+        if can_id == afe.can_address and data[0] == AFECommand.getVersion:
+            can_bus.inject(*reply)
+    can_bus.responder = responder
+
+    traffic = []
+    for afe_id in range(1, n_afe + 1):
+        traffic.extend(periodic_frames(afe_id))
+    running = [True]
+
+    async def producer():
+        i = 0
+        while running[0]:
+            for _ in range(burst):
+                can_bus.inject(*traffic[i % len(traffic)])
+                i += 1
+            rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    result = {"done": 0, "timeouts": 0}
+    latencies_ms = []
+
+    async def on_done(executing):
+        result["done"] += 1
+        latencies_ms.append(time.ticks_diff(time.ticks_ms(), afe.execute_timestamp))
+
+    async def on_error(kwargs):
+        result["timeouts"] += 1
+
+    main_process = hub.main_process
+    last_stall_ms = [time.ticks_ms()]
+    async def stalling_main_process(timer=None):
+        await main_process(timer)
+        if time.ticks_diff(time.ticks_ms(), last_stall_ms[0]) >= stall_every_ms:
+            await uasyncio.sleep_ms(stall_ms)
+            last_stall_ms[0] = time.ticks_ms()
+    hub.main_process = stalling_main_process
+
+    tasks = [uasyncio.create_task(producer()), uasyncio.create_task(hub.main_loop())]
+    for _ in range(n_commands):
+        await afe.enqueue_command(AFECommand.getVersion, timeout_ms=timeout_ms,
+                                  callback=on_done, callback_error=on_error)
+        while not afe.is_idle():
+            await uasyncio.sleep_ms(1)
+    running[0] = False
+    hub.run = False
+    await uasyncio.sleep_ms(5)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    latencies_ms.sort()
+    stats = rx.get_stats()
+    result["latency_max_ms"] = latencies_ms[-1] if latencies_ms else None
+    result["rx_overwritten"] = stats["rx_overwritten"]
+    result["rx_telemetry_overwritten"] = stats["rx_telemetry_overwritten"]
+    rtt = afe.get_latency_stats()["rtt"].get("0x{:02X}".format(AFECommand.getVersion))
+    result["rtt"] = rtt
+    return result
+
+
+async def bench_slow_afe(use_afe_rx_tasks, n_afe=8, slow_ms=20, n_sets=20, period_ms=10):
+    """
+    AFE 1 needs slow_ms for every frame (e.g. a blocked log write). Every
+    period_ms each AFE sends one telemetry set; measures how long the frames
+    of the other AFEs take from handle_can_rx() to being decoded.
+    """
+    can_bus, rx, hub = make_hub(n_afe, use_afe_rx_tasks)
+    slow_afe = hub.afe_devices[0]
+    process_slow = slow_afe.process_received_frame
+    async def slow_process_received_frame(frame):
+        await uasyncio.sleep_ms(slow_ms)
+        await process_slow(frame)
+    slow_afe.process_received_frame = slow_process_received_frame
+
+    latencies_us = []
+    injected_us = [0]
+    for afe in hub.afe_devices[1:]:
+        def timed(frame, process=afe.process_received_frame):
+            latencies_us.append(time.ticks_diff(time.ticks_us(), injected_us[0]))
+            return process(frame)
+        afe.process_received_frame = timed
+
+    loop_task = uasyncio.create_task(hub.main_loop())
+    for _ in range(n_sets):
+        for afe_id in range(1, n_afe + 1):
+            can_bus.inject(*periodic_frames(afe_id)[0])
+        injected_us[0] = time.ticks_us()
+        rx.handle_can_rx()
+        await uasyncio.sleep_ms(period_ms)
+    await uasyncio.sleep_ms(slow_ms * n_sets)
+    hub.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    loop_task.cancel()
+    stop_hub(hub)
+    latencies_us.sort()
+    return {
+        "frames": len(latencies_us),
+        "latency_avg_us": sum(latencies_us) // len(latencies_us),
+        "latency_max_us": latencies_us[-1],
+    }
+
+
+async def bench_manage_scheduler(use_afe_scheduler, n_afe, duration_ms=5000):
+    """
+    HUB with afe_manage_active and the CAN watchdog poll of every AFE, no
+    other traffic. Counts manage_state() calls and main_loop passes and the
+    host CPU used.
+    """
+    can_bus, rx, hub = make_hub(n_afe)
+    hub.afe_manage_active = True
+    hub.use_afe_scheduler = use_afe_scheduler
+    hub.use_rx_event = use_afe_scheduler
+    passes = [0]
+    main_process = hub.main_process
+    async def counting_main_process(timer=None):
+        passes[0] += 1
+        await main_process(timer)
+    hub.main_process = counting_main_process
+
+    loop_task = uasyncio.create_task(hub.main_loop())
+    await uasyncio.sleep_ms(100)
+    passes[0] = 0
+    hub.afe_manage_runs = 0
+    cpu_start = host_time.process_time()
+    await uasyncio.sleep_ms(duration_ms)
+    cpu_percent = (host_time.process_time() - cpu_start) * 100000.0 / duration_ms
+    result = {
+        "manage_per_s": hub.afe_manage_runs * 1000 // duration_ms,
+        "passes_per_s": passes[0] * 1000 // duration_ms,
+        "cpu_percent": cpu_percent,
+    }
+    hub.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    loop_task.cancel()
+    stop_hub(hub)
+    return result
+
+
+def bench_afe_lookup(n_afe, rounds=20):
+    """
+    Cost of finding the AFE of a frame and of the discovery "already online?"
+    check, with the former linear scans and with AFERegistry.
+    """
+    can_bus, rx, hub = make_hub(n_afe, use_afe_rx_tasks=False)
+    afe_list = list(hub.afe_devices)
+    for afe in afe_list[::2]:
+        afe.is_online = True
+    ids = [afe_id for afe_id in range(1, n_afe + 1)] * rounds
+
+    def linear_get_afe_by_id(afe_id):
+        for afe in afe_list:
+            if afe.device_id == afe_id:
+                return afe
+        return None
+
+    def timed(func):
+        start = host_time.perf_counter()
+        for afe_id in ids:
+            func(afe_id)
+        return (host_time.perf_counter() - start) * 1e9 / len(ids)
+
+    return {
+        "lookup_linear_ns": timed(linear_get_afe_by_id),
+        "lookup_registry_ns": timed(hub.get_afe_by_id),
+        "online_linear_ns": timed(lambda afe_id: any(afe.is_online and afe.device_id == afe_id for afe in afe_list)),
+        "online_registry_ns": timed(hub.afe_registry.is_online),
+    }
+
+
+async def bench_discovery(use_discovery_window, tx_delay_ms=1, id_max=99, present=(3, 17, 18, 42, 64, 77, 98, 99),
+                          reply_delay_ms=2, duration_ms=5000):
+    """
+    Discovery of the AFEs in `present` on a bus of IDs 1..id_max. Every probe
+    is answered by the 3 getSerialNumber chunks reply_delay_ms later, the bus
+    moves one frame per millisecond. Measures the time until all of them are
+    online and the probes sent in duration_ms.
+    """
+    can_bus, rx, hub = make_hub(0)
+    can_bus.mailboxes = 3
+    hub.use_discovery_window = use_discovery_window
+    hub.tx_delay_ms = tx_delay_ms
+    hub.afe_id_max = id_max
+    hub.afe_devices_max = 255
+    replies = []
+    probes = [0]
+
+    def responder(data, can_id):
+        if data[0] != AFECommand.getSerialNumber:
+            return
+        probes[0] += 1
+        afe_id = can_id >> 2
+        if afe_id in present:
+            due_ms = time.ticks_add(time.ticks_ms(), reply_delay_ms)
+            for chunk_id in range(3):
+                replies.append((due_ms, (afe_id << 2) | (1 << 10),
+                                bytes([AFECommand.getSerialNumber, (2 << 4) | chunk_id]) + struct.pack('<I', afe_id + chunk_id)))
+    can_bus.responder = responder
+
+    running = [True]
+
+    async def bus():
+        while running[0]:
+            can_bus.bus_tick(1)
+            now = time.ticks_ms()
+            while replies and time.ticks_diff(now, replies[0][0]) >= 0:
+                can_bus.inject(*replies.pop(0)[1:])
+            if can_bus.rx:
+                rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    tasks = [uasyncio.create_task(bus()), uasyncio.create_task(rx.main_loop()), uasyncio.create_task(hub.main_loop())]
+    await hub.start_discovery()
+    start = time.ticks_ms()
+    found_ms = None
+    while time.ticks_diff(time.ticks_ms(), start) < duration_ms:
+        if found_ms is None and hub.afe_registry.online_count == len(present):
+            found_ms = time.ticks_diff(time.ticks_ms(), start)
+        await uasyncio.sleep_ms(1)
+    running[0] = False
+    hub.run = False
+    rx.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    return {
+        "found_ms": found_ms,
+        "found": hub.afe_registry.online_count,
+        "probes": probes[0],
+        "sweep_ms": hub.discovery_sweep_ms if use_discovery_window else None,
+    }
+
+
+async def bench_config_plan(mode, afe_ids=(32, 34, 35, 36), rounds=20):
+    """
+    Host time of default_procedure per AFE with the calibration already
+    loaded: "legacy" runs the elif chain, "compile" builds a new plan every
+    time, "cached" replays the plan of an unchanged configuration.
+    """
+    can_bus, rx, hub = make_hub(0, use_afe_rx_tasks=False)
+    hub.use_config_plans = mode != "legacy"
+    await hub.calibration_store.load()
+    afes = []
+    for afe_id in afe_ids:
+        afe = AFEDevice(rx, afe_id, logger=hub.logger)
+        hub.afe_devices.append(afe)
+        afes.append(afe)
+    elapsed = 0.0
+    frames = 0
+    for _ in range(rounds):
+        if mode == "compile":
+            hub.config_plans = {}
+        for afe in afes:
+            afe.clear_commands()
+            start = host_time.perf_counter()
+            await hub.default_procedure(afe.device_id)
+            elapsed += host_time.perf_counter() - start
+            frames += len(afe.to_execute)
+    n = rounds * len(afes)
+    return {
+        "us_per_afe": elapsed * 1e6 / n,
+        "frames_per_afe": frames // n,
+        "builds": hub.config_plan_builds,
+        "hits": hub.config_plan_hits,
+    }
+
+
+async def bench_calibration_load(use_store, n_afe=60):
+    """
+    Host time to get the calibration of n_afe AFEs (the IDs of the
+    calibration file, repeated) with get_configuration_from_files() and
+    with a CalibrationStore loaded once beforehand.
+    """
+    store = CalibrationStore()
+    await store.load()
+    ids = sorted(store.by_id[store.files[0]])
+    afe_ids = [ids[i % len(ids)] for i in range(n_afe)]
+    parses = store.parses
+    start = host_time.perf_counter()
+    for afe_id in afe_ids:
+        if use_store:
+            await store.get_configuration(afe_id)
+        else:
+            await get_configuration_from_files(afe_id)
+    elapsed_ms = (host_time.perf_counter() - start) * 1000
+    return {
+        "elapsed_ms": elapsed_ms,
+        "csv_parses": 2 * n_afe if not use_store else store.parses - parses,
+    }
+
+
+async def bench_configure_pipeline(pipeline_depth, afe_id=35, reply_delay_ms=5, frames_per_ms=1):
+    """
+    default_procedure of one AFE which answers every command with a
+    1-frame echo reply_delay_ms after the command left the HUB; the bus
+    moves frames_per_ms frames per millisecond. Measures the time until
+    every command completed.
+    """
+    can_bus, rx, hub = make_hub(0)
+    can_bus.mailboxes = 3
+    afe = AFEDevice(rx, afe_id, logger=hub.logger)
+    afe.use_afe_can_watchdog = False
+    afe.pipeline_depth = pipeline_depth
+    hub.afe_devices.append(afe)
+    afe.start_rx_task()
+    hub.afe_manage_active = True
+    await hub.calibration_store.load()
+    replies = []
+
+    def responder(data, can_id):
+        due_ms = time.ticks_add(time.ticks_ms(), reply_delay_ms)
+        payload = bytes(data[2:])
+        if data[0] == AFECommand.setAD8402Value_byte_byMask:
+            payload += b"\x00"  # no error bits
+        replies.append((due_ms, can_id | (1 << 10), bytes([data[0], 0x00]) + payload))
+    can_bus.responder = responder
+
+    running = [True]
+
+    async def bus():
+        while running[0]:
+            can_bus.bus_tick(frames_per_ms)
+            now = time.ticks_ms()
+            while replies and time.ticks_diff(now, replies[0][0]) >= 0:
+                can_bus.inject(*replies.pop(0)[1:])
+            if can_bus.rx:
+                rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    errors = [0]
+
+    async def on_error(kwargs):
+        errors[0] += 1
+
+    tasks = [uasyncio.create_task(bus()), uasyncio.create_task(rx.main_loop()), uasyncio.create_task(hub.main_loop())]
+    await uasyncio.sleep_ms(10)
+    start = time.ticks_ms()
+    await hub.default_procedure(afe_id, callback_error=on_error)
+    commands = len(afe.to_execute)
+    while not afe.is_idle():
+        await uasyncio.sleep_ms(1)
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), start)
+    running[0] = False
+    hub.run = False
+    rx.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    return {"commands": commands, "elapsed_ms": elapsed_ms, "errors": errors[0]}
+
+
+def afe_echo_replies(replies, reply_delay_ms):
+    """
+    BenchCAN responder of AFEs that answer every command reply_delay_ms
+    later: getSerialNumber with its 3 UID chunks, timestamps with a value,
+    any other command with an echo of its payload.
+    """
+    def responder(data, can_id):
+        due_ms = time.ticks_add(time.ticks_ms(), reply_delay_ms)
+        reply_id = can_id | (1 << 10)
+        command = data[0]
+        if command == AFECommand.getSerialNumber:
+            for chunk_id in range(3):
+                replies.append((due_ms, reply_id, bytes([command, (2 << 4) | chunk_id]) + struct.pack('<I', can_id + chunk_id)))
+            return
+        if command in (AFECommand.getTimestamp, AFECommand.getSyncTimestamp):
+            payload = struct.pack('<BI', 0, time.ticks_ms())
+        else:
+            payload = bytes(data[2:])
+            if command == AFECommand.setAD8402Value_byte_byMask:
+                payload += b"\x00"  # no error bits
+        replies.append((due_ms, reply_id, bytes([command, 0x00]) + payload))
+    return responder
+
+
+async def bench_fleet_bringup(use_config_tasks, config_concurrency=4, afe_ids=(32, 34, 35, 36, 41, 42, 43, 44),
+                              reply_delay_ms=5, frames_per_ms=1, slow_afe_ids=(), slow_reply_delay_ms=200):
+    """
+    Automatic configuration of a fleet after power-on: every AFE runs
+    default_full and answers its commands, the ones in slow_afe_ids only
+    after slow_reply_delay_ms. Measures when the first, the median and the
+    last of the other AFEs are configured and the longest main_process
+    pass, which delays RX and the management of every AFE.
+    """
+    can_bus, rx, hub = make_hub(0)
+    can_bus.mailboxes = 3
+    hub.use_automatic_restart = True
+    hub.use_config_tasks = use_config_tasks
+    hub.config_concurrency = config_concurrency
+    hub.afe_devices_max = len(afe_ids)
+    hub.afe_manage_active = True
+    await hub.calibration_store.load()
+    replies = []
+    slow_replies = []  # apart, so their later due times do not hold back the others
+    responder = afe_echo_replies(replies, reply_delay_ms)
+    slow_responder = afe_echo_replies(slow_replies, slow_reply_delay_ms)
+    can_bus.responder = lambda data, can_id: (
+        slow_responder if (can_id >> 2) & 0xFF in slow_afe_ids else responder)(data, can_id)
+    running = [True]
+
+    async def bus():
+        while running[0]:
+            can_bus.bus_tick(frames_per_ms)
+            now = time.ticks_ms()
+            for queue in (replies, slow_replies):
+                while queue and time.ticks_diff(now, queue[0][0]) >= 0:
+                    can_bus.inject(*queue.pop(0)[1:])
+            if can_bus.rx:
+                rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    pass_max_ms = [0.0]
+    main_process = hub.main_process
+    async def timed_main_process(timer=None):
+        start = host_time.perf_counter()
+        await main_process(timer)
+        pass_max_ms[0] = max(pass_max_ms[0], (host_time.perf_counter() - start) * 1000)
+    hub.main_process = timed_main_process
+
+    for afe_id in afe_ids:
+        afe = AFEDevice(rx, afe_id, logger=hub.logger)
+        afe.use_afe_can_watchdog = False
+        afe.pipeline_depth = 4
+        hub.afe_devices.append(afe)
+        afe.start_rx_task()
+    tasks = [uasyncio.create_task(bus()), uasyncio.create_task(rx.main_loop()), uasyncio.create_task(hub.main_loop())]
+    start = time.ticks_ms()
+    elapsed_ms = None
+    configured_ms = {}  # afe_id -> ms from start, other AFEs only
+    while time.ticks_diff(time.ticks_ms(), start) < 20000:
+        now_ms = time.ticks_diff(time.ticks_ms(), start)
+        for afe in hub.afe_devices:
+            if afe.is_configured and afe.device_id not in slow_afe_ids and afe.device_id not in configured_ms:
+                configured_ms[afe.device_id] = now_ms
+        if all(afe.is_configured for afe in hub.afe_devices):
+            elapsed_ms = now_ms
+            break
+        await uasyncio.sleep_ms(5)
+    running[0] = False
+    hub.run = False
+    rx.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    times = sorted(configured_ms.values())
+    return {
+        "elapsed_ms": elapsed_ms,
+        "configured": sum(1 for afe in hub.afe_devices if afe.is_configured),
+        "first_ms": times[0] if times else None,
+        "median_ms": times[len(times) // 2] if times else None,
+        "last_ms": times[-1] if times else None,
+        "pass_max_ms": pass_max_ms[0],
+    }
+
+
+async def bench_query_afes(use_futures, n_afe=16, command=AFECommand.getSerialNumber, reply_delay_ms=5, frames_per_ms=1):
+    """
+    The same query sent to n_afe AFEs at once and waited for: with a
+    callback and an Event per AFE (how the web server waits) or with
+    HUBDevice.query_afes futures. Counts the tasks created meanwhile.
+    """
+    can_bus, rx, hub = make_hub(0)
+    can_bus.mailboxes = 3
+    replies = []
+    can_bus.responder = afe_echo_replies(replies, reply_delay_ms)
+    running = [True]
+
+    async def bus():
+        while running[0]:
+            can_bus.bus_tick(frames_per_ms)
+            now = time.ticks_ms()
+            while replies and time.ticks_diff(now, replies[0][0]) >= 0:
+                can_bus.inject(*replies.pop(0)[1:])
+            if can_bus.rx:
+                rx.handle_can_rx()
+            await uasyncio.sleep_ms(1)
+
+    for afe_id in range(1, n_afe + 1):
+        afe = AFEDevice(rx, afe_id, logger=hub.logger)
+        afe.use_afe_can_watchdog = False
+        afe.pipeline_depth = 4
+        hub.afe_devices.append(afe)
+        afe.start_rx_task()
+    hub.afe_manage_active = True
+    tasks = [uasyncio.create_task(bus()), uasyncio.create_task(rx.main_loop()), uasyncio.create_task(hub.main_loop())]
+    await uasyncio.sleep_ms(10)
+
+    created = [0]
+    create_task = uasyncio.create_task
+    def counting_create_task(coro):
+        created[0] += 1
+        return create_task(coro)
+    uasyncio.create_task = counting_create_task
+    start = time.ticks_ms()
+    if use_futures:
+        result = await hub.query_afes(command)
+    else:
+        result = {}
+        events = {}
+        async def on_reply(executing):
+            result[executing["device_id"]] = executing.get("retval")
+            events[executing["device_id"]].set()
+        for afe in hub.afe_devices:
+            events[afe.device_id] = uasyncio.Event()
+            await afe.enqueue_command(command, None, preserve=True, callback=on_reply)
+        for event in events.values():
+            await event.wait()
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), start)
+    uasyncio.create_task = create_task
+
+    running[0] = False
+    hub.run = False
+    rx.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    for t in tasks:
+        t.cancel()
+    stop_hub(hub)
+    return {
+        "elapsed_ms": elapsed_ms,
+        "answered": sum(1 for retval in result.values() if retval and "error" not in retval),
+        "tasks": created[0],
+    }
+
+
+def bench_clock_model(use_clock_model, hours=1, drift_ppm=80, jitter_ms=3, sample_every_ms=1000,
+                      watchdog_timeout_ms=20000, seed=1):
+    """
+    Simulated AFE clock running drift_ppm fast, with its counter and the
+    HUB ticks starting near their wrap; each sync reply reaches the HUB
+    0..jitter_ms late. Every sample_every_ms an AFE timestamp is converted
+    to HUB ticks, either from the last sync pair (before) or from the
+    ClockModel. Counts syncs and the conversion error against the truth.
+    """
+    rng = random.Random(seed)
+    hub0 = (1 << 30) - 5000
+    afe0 = 0xFFFFFFFF - 2000
+    model = ClockModel(poll_max_ms=watchdog_timeout_ms // 4)
+    last_pair = None
+    syncs = 0
+    errors = []
+    fit_us = 0.0
+    next_sync_ms = 0
+    end_ms = int(hours * 3600 * 1000)
+    for t_ms in range(0, end_ms, 100):
+        afe_ms = (afe0 + int(t_ms * (1 + drift_ppm * 1e-6))) & 0xFFFFFFFF
+        if t_ms >= next_sync_ms:
+            syncs += 1
+            hub_ms = time.ticks_add(hub0, t_ms + rng.randint(0, jitter_ms))
+            if use_clock_model:
+                start = host_time.perf_counter()
+                model.add(hub_ms, afe_ms)
+                fit_us += (host_time.perf_counter() - start) * 1e6
+                next_sync_ms = t_ms + min(model.poll_interval_ms, watchdog_timeout_ms // 4)
+            else:
+                last_pair = (hub_ms, afe_ms)
+                next_sync_ms = t_ms + int(round(watchdog_timeout_ms / 10.0))
+        if t_ms % sample_every_ms == 0 and syncs:
+            if use_clock_model:
+                hub_est = model.to_hub_ms(afe_ms)
+            else:
+                hub_est = time.ticks_add(last_pair[0], ClockModel._afe_diff(afe_ms, last_pair[1]))
+            errors.append(time.ticks_diff(hub_est, time.ticks_add(hub0, t_ms)))
+    settled = errors[len(errors) // 10:]  # after the first 10% of the run
+    return {
+        "syncs": syncs,
+        "max_error_ms": max(abs(e) for e in settled),
+        "rms_error_ms": (sum(e * e for e in settled) / len(settled)) ** 0.5,
+        "fit_us": fit_us / syncs if use_clock_model else None,
+        "drift_ppm": model.to_dict()["drift_ppm"] if use_clock_model else None,
+    }
+
+
+def bench_clock_decode_delay(use_capture_time, syncs=40, max_delay_ms=20, afe_id=35, seed=1):
+    """
+    syncs getTimestamp replies through AFEDevice._reply_getTimestamp, each
+    decoded 0..max_delay_ms after the RX IRQ captured it (the HUB busy with
+    other frames). The HUB side of the clock sample is the capture time
+    (after), or the decode time, as when it was millis() in the decoder
+    (before). The AFE clock is the HUB ticks plus a fixed offset, so the
+    ideal model has zero error.
+    """
+    rng = random.Random(seed)
+    can_bus, rx, hub = make_hub(0)
+    afe = AFEDevice(rx, afe_id, logger=hub.logger)
+    afe.use_clock_model = True
+    afe_offset_ms = 123456
+    errors = []
+    for _ in range(syncs):
+        afe_ms = (time.ticks_ms() + afe_offset_ms) & 0xFFFFFFFF
+        data = bytes([AFECommand.getTimestamp, 0, 0]) + struct.pack('<I', afe_ms)
+        frame = RxFrame.from_message([(afe_id << 2) | (1 << 10), False, 0, data])
+        time.sleep_ms(rng.randint(0, max_delay_ms))
+        if not use_capture_time:
+            frame.timestamp_us = time.ticks_us()
+        afe._reply_getTimestamp(frame, {})
+        now_ms = time.ticks_ms()
+        if afe.clock.is_fitted():
+            errors.append(time.ticks_diff(afe.clock.to_hub_ms((now_ms + afe_offset_ms) & 0xFFFFFFFF), now_ms))
+    return {
+        "max_error_ms": max(abs(e) for e in errors),
+        "rms_ms": afe.clock.rms_ms,
+        "drift_ppm": afe.clock.to_dict()["drift_ppm"],
+        "certain": afe.clock.is_certain(),
+    }
+
+
+class BenchADC(pyb.ADC):
+    """pyb.ADC whose every reading is 2048 counts plus gaussian noise of noise_counts."""
+
+    def __init__(self, pin, rng, noise_counts=8):
+        super().__init__(pin)
+        self.rng = rng
+        self.noise_counts = noise_counts
+
+    @property
+    def _value(self):
+        return int(round(self.rng.gauss(2048, self.noise_counts)))
+
+    @_value.setter
+    def _value(self, value):
+        pass
+
+
+def bench_hub_adc(use_sampler, entries=200, seed=1):
+    """
+    entries readings of U_SIPM_MEAS: single ADC.read() calls as in the old
+    hub_adc_read, or HubADCSampler bursts. Reports the spread of the
+    readings (8 counts of noise per sample), host CPU and wall time per
+    reading of all three channels.
+    """
+    rng = random.Random(seed)
+    adcs = [BenchADC(pin, rng) for pin in ("C2", "A3", "C3")]
+    gain = 3.3 / 4095 * 34
+    values = []
+    cpu_start = host_time.process_time()
+    wall_start = host_time.perf_counter()
+    if use_sampler:
+        sampler = HubADCSampler(adcs, (1.0, gain, 3.3 / 4095 * 5.3))
+        for _ in range(entries):
+            sampler.sample()
+            values.append(sampler.latest()["U_SIPM_MEAS"])
+    else:
+        for _ in range(entries):
+            readings = [adc.read() for adc in adcs]
+            values.append(readings[1] * gain)
+    cpu_us = (host_time.process_time() - cpu_start) * 1e6 / entries
+    wall_us = (host_time.perf_counter() - wall_start) * 1e6 / entries
+    mean = sum(values) / len(values)
+    return {
+        "std_mv": (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5 * 1000,
+        "cpu_us": cpu_us,
+        "wall_us": wall_us,
+    }
+
+
+async def bench_hub_adc_stall(use_timer_irq, bursts=50, seed=1):
+    """
+    bursts HubADCSampler bursts (16 samples at 10 kHz) next to a task that
+    only yields, as main_loop takes them: read_timed_multi, which holds the
+    CPU for the whole burst, or readings from the timer callback. Reports
+    the longest gap that task saw, the longest the sampler held the CPU per
+    burst and the U_SIPM_MEAS spread.
+    """
+    rng = random.Random(seed)
+    adcs = [BenchADC(pin, rng) for pin in ("C2", "A3", "C3")]
+    sampler = HubADCSampler(adcs, (1.0, 3.3 / 4095 * 34, 3.3 / 4095 * 5.3))
+    sampler.use_timer_irq = use_timer_irq
+    gap_max = [0.0]
+    running = [True]
+
+    async def other_task():
+        last = host_time.perf_counter()
+        while running[0]:
+            await uasyncio.sleep_ms(0)
+            now = host_time.perf_counter()
+            gap_max[0] = max(gap_max[0], now - last)
+            last = now
+
+    task = uasyncio.create_task(other_task())
+    await uasyncio.sleep_ms(0)
+    values = []
+    for _ in range(bursts):
+        if use_timer_irq:
+            await sampler.sample_irq()
+        else:
+            sampler.sample()
+        values.append(sampler.latest()["U_SIPM_MEAS"])
+        await uasyncio.sleep_ms(0)
+    running[0] = False
+    await task
+    sampler.timer.deinit()
+    mean = sum(values) / len(values)
+    return {
+        "gap_max_us": gap_max[0] * 1e6,
+        "burst_us_max": sampler.burst_us_max,
+        "std_mv": (sum((v - mean) ** 2 for v in values) / len(values)) ** 0.5 * 1000,
+    }
+
+
+async def bench_command_queue(use_ring, rounds=30, depth=100, commands=500, drain_every_ms=5):
+    """
+    before: the former list of command dicts, consumed with pop(0), and a
+    1 ms polling loop while more than `depth` are queued; after: the
+    CommandQueue ring of reused CommandRecords of AFEDevice.
+    Host time per enqueue+dequeue with the queue filled to depth and
+    drained, rounds times; then a producer enqueuing `commands` while a
+    consumer takes one every drain_every_ms: how often the producer woke
+    up while the queue was full.
+    """
+    can_bus, rx, hub = make_hub(0)
+    afe = AFEDevice(rx, 35, logger=hub.logger)
+    queue = []
+    polls = [0]
+
+    def prepare_dict(command, data=None, chunk=1, max_chunks=1, timeout_ms=None, preserve=False,
+                     can_timeout_ms=None, callback=None, callback_error=None, **kwargs):
+        if data is None:
+            data = []
+        chunk_info = (max_chunks << 4) | chunk
+        timestamp_ms = time.ticks_ms()
+        return {
+            "command": command, "frame": bytearray([command, chunk_info] + data[:6]),
+            "device_id": afe.device_id, "can_address": afe.can_address,
+            "timeout_ms": afe.default_command_timeout_ms if timeout_ms is None else timeout_ms,
+            "timestamp_ms": timestamp_ms, "timestamp_ms_enqueued": timestamp_ms,
+            "can_timeout_ms": afe.default_can_timeout_ms if can_timeout_ms is None else can_timeout_ms,
+            "status": 0, "preserve": preserve, "timeout_start_on_send_ms": None, "timestamp_us_sent": None,
+            "retval": None, "callback": callback, "callback_error": callback_error}
+
+    async def enqueue_list(command, data=None, **kwargs):
+        while len(queue) > depth:
+            polls[0] += 1
+            await uasyncio.sleep_ms(1)
+        queue.append(prepare_dict(command, data, **kwargs))
+        afe.request_manage()
+        afe.can_interface.wake()
+
+    async def enqueue():
+        if use_ring:
+            await afe._enqueue_command(AFECommand.getTimestamp)
+        else:
+            await enqueue_list(AFECommand.getTimestamp)
+
+    def dequeue():
+        if use_ring:
+            cmd = afe.to_execute.pop()
+            if cmd is None:
+                return False
+            afe._release_record(cmd)
+            return True
+        if queue:
+            queue.pop(0)
+            return True
+        return False
+
+    elapsed = 0.0
+    blocks = 0
+    for _ in range(rounds):
+        blocks_before = sys.getallocatedblocks()
+        start = host_time.perf_counter()
+        for _ in range(depth):
+            await enqueue()
+        elapsed += host_time.perf_counter() - start
+        blocks += sys.getallocatedblocks() - blocks_before
+        start = host_time.perf_counter()
+        while dequeue():
+            pass
+        elapsed += host_time.perf_counter() - start
+    us_per_command = elapsed * 1e6 / (rounds * depth)
+
+    async def producer():
+        for _ in range(commands):
+            await enqueue()
+
+    task = uasyncio.create_task(producer())
+    done = 0
+    while done < commands:
+        await uasyncio.sleep_ms(drain_every_ms)
+        if dequeue():
+            done += 1
+    await task
+    stop_hub(hub)
+    stats = afe.get_queue_stats()
+    return {
+        "us_per_command": us_per_command,
+        "blocks_per_command": blocks / (rounds * depth),
+        "producer_wakeups": stats["waits"] if use_ring else polls[0],
+        "wait_ms_max": stats["wait_ms_max"] if use_ring else None,
+        "depth_max": stats["depth_max"] if use_ring else None,
+    }
+
+
+async def bench_reply_decoder(rounds=200, afe_id=35):
+    """
+    Decoding cost of AFEDevice.process_received_frame over a recorded mix
+    of replies: the echoes of the 39 default_procedure commands (as
+    afe_echo_replies answers them), 8 getSensorDataSi_periodic sets and 4
+    getTimestamp replies. No command waits for them, so only the decode
+    and store path runs. Returns us per frame, overall and per command.
+    """
+    can_bus, rx, hub = make_hub(0)
+    afe = AFEDevice(rx, afe_id, logger=hub.logger)
+    hub.afe_devices.append(afe)
+    afe.configuration = {"M": {}, "S": {}}
+    await hub.calibration_store.load()
+    await hub.default_procedure(afe_id)
+    replies = []
+    responder = afe_echo_replies(replies, 0)
+    cmd = afe.to_execute.pop()
+    while cmd is not None:
+        responder(bytes(cmd.frame[:cmd.frame_len]), afe.can_address)
+        cmd = afe.to_execute.pop()
+    for value in range(8):
+        replies += [(0,) + frame for frame in periodic_frames(afe_id, float(value))]
+    for _ in range(4):
+        responder(bytes([AFECommand.getTimestamp, 0x11]), afe.can_address)
+    frames = [RxFrame.from_message([can_id, False, 0, data]) for _, can_id, data in replies]
+    per_command = {}
+    start_all = host_time.perf_counter()
+    for _ in range(rounds):
+        for frame in frames:
+            start = host_time.perf_counter()
+            await afe.process_received_frame(frame)
+            elapsed = host_time.perf_counter() - start
+            entry = per_command.setdefault(frame.command, [0, 0.0])
+            entry[0] += 1
+            entry[1] += elapsed
+    total_s = host_time.perf_counter() - start_all
+    stop_hub(hub)
+    return {
+        "frames": len(frames),
+        "us_per_frame": total_s * 1e6 / (rounds * len(frames)),
+        "per_command_us": {command: entry[1] * 1e6 / entry[0] for command, entry in per_command.items()},
+    }
+
+
+def heap_mark():
+    """
+    Start of an allocation measurement: gc.mem_alloc() with the collector
+    off on the pyboard; on the host tracemalloc, whose peak counts the
+    temporaries that CPython frees right away.
+    """
+    if hasattr(gc, "mem_alloc"):
+        gc.collect()
+        gc.disable()
+        return gc.mem_alloc()
+    tracemalloc.reset_peak()
+    return tracemalloc.get_traced_memory()[0]
+
+
+def heap_allocated(mark):
+    """Bytes allocated since heap_mark()."""
+    if hasattr(gc, "mem_alloc"):
+        allocated = gc.mem_alloc() - mark
+        gc.enable()
+        return allocated
+    return tracemalloc.get_traced_memory()[1] - mark
+
+
+def bench_decode_alloc(rounds=200, afe_id=35):
+    """
+    Heap bytes and time per decoded value of the sync reply decoders, over
+    frames that carry one value each: the echoes of the 12 *_byMask setters,
+    getSensorDataSi_last_byMask values and timestamp, and chunks 1..4 of a
+    getSensorDataSi_periodic set (chunk 0 starts a new set and allocates
+    its dicts by design). Every frame is decoded once before measuring so
+    the parsed_data keys exist.
+    """
+    can_bus, rx, hub = make_hub(0)
+    afe = AFEDevice(rx, afe_id, logger=hub.logger)
+    can_id = (afe_id << 2) | (1 << 10)
+    messages = []
+    for command in (AFECommand.setAveragingAlpha_byMask, AFECommand.setChannel_a_byMask,
+                    AFECommand.setChannel_b_byMask, AFECommand.setRegulator_T_opt_byMask,
+                    AFECommand.setRegulator_dT_byMask, AFECommand.setRegulator_a_dac_byMask,
+                    AFECommand.setRegulator_b_dac_byMask, AFECommand.setRegulator_dV_dT_byMask,
+                    AFECommand.setRegulator_V_opt_byMask, AFECommand.setRegulator_V_offset_byMask):
+        messages.append(bytes([command, 0x00]) + struct.pack("<Bf", 0x03, 1.25))
+    for command in (AFECommand.setChannel_dt_ms_byMask, AFECommand.setChannel_period_ms_byMask):
+        messages.append(bytes([command, 0x00]) + struct.pack("<BI", 0x03, 1000))
+    messages.append(bytes([AFECommand.getSensorDataSi_last_byMask, 0x10]) + struct.pack("<Bf", 0xFF, 2.5))
+    messages.append(bytes([AFECommand.getSensorDataSi_last_byMask, 0x11]) + struct.pack("<BI", 0xFF, 123456))
+    messages += [data for _, data in periodic_frames(afe_id, 3.5)]
+    frames = [RxFrame.from_message([can_id, False, 0, data]) for data in messages]
+    decoders = []
+    for frame in frames:
+        decoder = REPLY_DECODERS[frame.command]
+        if decoder[0] == REPLY_CHANNEL_CONFIG:
+            decoders.append((frame, lambda frame, decoder=decoder: afe._reply_channel_config(
+                frame, decoder[1], decoder[2], decoder[3])))
+        else:
+            decoders.append((frame, lambda frame, method=decoder[1]: method(afe, frame, afe.parsed_data)))
+    for frame, decode in decoders:
+        decode(frame)
+    measured = [(frame, decode) for frame, decode in decoders
+                if not (frame.command == AFECommand.getSensorDataSi_periodic and frame.chunk_id == 0)]
+
+    tracemalloc.start()
+    overhead = 0  # of heap_mark() / heap_allocated() themselves
+    for _ in range(rounds):
+        mark = heap_mark()
+        overhead += heap_allocated(mark)
+    allocated = 0
+    for _ in range(rounds):
+        for frame, decode in measured:
+            mark = heap_mark()
+            decode(frame)
+            allocated += heap_allocated(mark)
+    tracemalloc.stop()
+    allocated -= overhead * len(measured)
+    start = host_time.perf_counter()
+    for _ in range(rounds):
+        for frame, decode in measured:
+            decode(frame)
+    elapsed_s = host_time.perf_counter() - start
+    stop_hub(hub)
+    return {
+        "values": len(measured),
+        "bytes_per_value": allocated / (rounds * len(measured)),
+        "us_per_value": elapsed_s * 1e6 / (rounds * len(measured)),
+    }
+
+
+async def bench_periodic_store(sets=500, afe_id=35):
+    """
+    Cost of one getSensorDataSi_periodic set (5 frames, 8 channels) through
+    process_received_frame, with (True) and without (False) the measurement
+    log entry of every set: median us and mean heap bytes per set (see
+    heap_mark()), then the cost of building the web views of the newest
+    values. The two AFEs are timed set by set in turn, so host noise and
+    warm-up hit both alike.
+    """
+    can_bus, rx, hub = make_hub(0)
+    afes = {}
+    for save_periodic_data in (True, False):
+        afe = AFEDevice(rx, afe_id, logger=hub.logger)
+        afe.save_periodic_data = save_periodic_data
+        afes[save_periodic_data] = afe
+    frame_sets = []
+    for k in range(16):
+        frame_sets.append([RxFrame.from_message([can_id, False, 0, data])
+                           for can_id, data in periodic_frames(afe_id, 0.5 + k)])
+    for afe in afes.values():
+        for frames in frame_sets:
+            for frame in frames:
+                await afe.process_received_frame(frame)
+
+    allocated = {True: 0, False: 0}
+    tracemalloc.start()
+    for k in range(sets):
+        for save_periodic_data, afe in afes.items():
+            mark = heap_mark()
+            for frame in frame_sets[k % len(frame_sets)]:
+                await afe.process_received_frame(frame)
+            allocated[save_periodic_data] += heap_allocated(mark)
+    tracemalloc.stop()
+    set_us = {True: [], False: []}
+    for k in range(sets):
+        for save_periodic_data, afe in afes.items():
+            start = host_time.perf_counter()
+            for frame in frame_sets[k % len(frame_sets)]:
+                await afe.process_received_frame(frame)
+            set_us[save_periodic_data].append((host_time.perf_counter() - start) * 1e6)
+
+    view_us = None
+    afe = afes[False]
+    if hasattr(afe, "get_latest_status"):
+        start = host_time.perf_counter()
+        for _ in range(100):
+            afe.get_latest_status()
+            for ch in afe.channels:
+                afe.get_channel_data(ch.channel_id)
+        view_us = (host_time.perf_counter() - start) * 1e4
+    stop_hub(hub)
+    result = {}
+    for save_periodic_data in (True, False):
+        times = sorted(set_us[save_periodic_data])
+        result[save_periodic_data] = {
+            "us_per_set": times[sets // 2],  # median, the host timer is noisy
+            "bytes_per_set": allocated[save_periodic_data] / sets,
+        }
+    result["view_us"] = view_us
+    return result
+
+
+async def bench_rollups(use_rollups, hours=1, period_s=1, afe_id=35):
+    """
+    One AFE sends a getSensorDataSi_periodic set every period_s for `hours`
+    (RTC time is simulated). Median us per set through
+    process_received_frame, with or without MeasurementRollups. Then a 1 min
+    trend of the last hour for all 8 channels, from the rollups (after) or
+    by scanning the measurement log lines of the same sets (before).
+    """
+    import AFE
+    import json
+    can_bus, rx, hub = make_hub(0)
+    afe = AFEDevice(rx, afe_id, logger=hub.logger,
+                    rollup_resolutions=MeasurementRollups.RESOLUTIONS if use_rollups else None)
+    rtc_unix_timestamp = AFE.rtc_unix_timestamp
+    now_s = [1700000000]
+    AFE.rtc_unix_timestamp = lambda: now_s[0]
+    rng = random.Random(1)
+    frame_sets = [[RxFrame.from_message([can_id, False, 0, data])
+                   for can_id, data in periodic_frames(afe_id, 54.0 + rng.random())] for _ in range(64)]
+    log_lines = []
+    set_us = []
+    for k in range(int(hours * 3600 / period_s)):
+        start = host_time.perf_counter()
+        for frame in frame_sets[k % len(frame_sets)]:
+            await afe.process_received_frame(frame)
+        set_us.append((host_time.perf_counter() - start) * 1e6)
+        if not use_rollups:
+            log_lines.append(json.dumps({"command": AFECommand.getSensorDataSi_periodic,
+                                         "rtc_timestamp": now_s[0], "retval": afe.get_periodic_data()}))
+        now_s[0] += period_s
+    AFE.rtc_unix_timestamp = rtc_unix_timestamp
+    set_us.sort()
+
+    start = host_time.perf_counter()
+    if use_rollups:
+        trend = {ch.name: list(afe.get_rollup_rows(ch.channel_id, 60)) for ch in afe.channels}
+    else:
+        buckets = {}
+        for line in log_lines:
+            entry = json.loads(line)
+            bucket = buckets.setdefault(entry["rtc_timestamp"] // 60 * 60, {})
+            for name, value in entry["retval"]["last_data"].items():
+                if name in e_ADC_CHANNEL.values():
+                    row = bucket.get(name)
+                    if row is None:
+                        bucket[name] = [1, value, value, value]
+                    else:
+                        row[0] += 1
+                        row[1] = min(row[1], value)
+                        row[2] = max(row[2], value)
+                        row[3] += value
+        trend = {name: [(t, row[0], row[1], row[2], row[3] / row[0])
+                        for t, bucket in sorted(buckets.items()) for n, row in bucket.items() if n == name]
+                 for name in e_ADC_CHANNEL.values()}
+    query_ms = (host_time.perf_counter() - start) * 1e3
+    stop_hub(hub)
+    return {
+        "us_per_set": set_us[len(set_us) // 2],
+        "query_ms": query_ms,
+        "rows": sum(len(rows) for rows in trend.values()),
+        "bytes": afe.rollups.get_stats()["bytes"] if use_rollups else sum(len(line) for line in log_lines),
+    }
+
+
+async def main():
+    burst = 8
+    print("BENCH: RX throughput, {} frames offered per ms".format(burst))
+    for label, rx_batch_max in (("single frame per pass (before)", 1),
+                                ("batch of 16 per pass (after)", 16)):
+        stats = await bench_rx_throughput(rx_batch_max, burst=burst)
+        print("BENCH:   {:32s} {:6d} frames/s, processed {}, lost {}".format(
+            label, stats["frames_per_s"], stats["processed"], stats["lost"]))
+
+    print("BENCH: HUB main_loop idle cost and RX-to-process latency")
+    for label, use_rx_event in (("poll every 1 ms (before)", False),
+                                ("wake on RX flag (after)", True)):
+        stats = await bench_idle_and_latency(use_rx_event)
+        print("BENCH:   {:32s} idle {:4d} passes/s {:5.1f}% CPU, latency avg {} us max {} us".format(
+            label, stats["idle_passes_per_s"], stats["idle_cpu_percent"],
+            stats["latency_avg_us"], stats["latency_max_us"]))
+
+
+    print("BENCH: TX configuration burst through the TX ring")
+    stats = await bench_tx_burst()
+    print("BENCH:   {} frames in {} ms (flushed {}), sent {}, failed {}, peak depth {}, "
+          "mailbox full {}, ring full {}, slowest send() {} us".format(
+              stats["frames"], stats["elapsed_ms"], stats["flushed"], stats["tx_frames"],
+              stats["tx_failed"], stats["tx_peak_depth"], stats["tx_mailbox_full"],
+              stats["tx_queue_full"], stats["send_max_us"]))
+
+
+    print("BENCH: getVersion replies under telemetry (2 frames/ms, 8 AFEs, HUB stalls 40 ms every 100 ms)")
+    for label, use_rx_priority in (("single RX ring (before)", False),
+                                   ("reply ring drained first (after)", True)):
+        stats = await bench_reply_under_telemetry(use_rx_priority)
+        print("BENCH:   {:32s} done {}, timeouts {}, slowest reply {} ms, dropped from reply ring {} telemetry ring {}".format(
+            label, stats["done"], stats["timeouts"], stats["latency_max_ms"],
+            stats["rx_overwritten"], stats["rx_telemetry_overwritten"]))
+        rtt = stats["rtt"]
+        print("BENCH:   {:32s} getVersion RTT histogram: n {}, avg {} us, p50 <= {} us, p99 <= {} us, max {} us".format(
+            "", rtt["count"], rtt["avg_us"], rtt["p50_us"], rtt["p99_us"], rtt["max_us"]))
+
+
+    print("BENCH: frames of 7 AFEs while AFE 1 needs 20 ms per frame")
+    for label, use_afe_rx_tasks in (("HUB decodes every frame (before)", False),
+                                    ("task and queue per AFE (after)", True)):
+        stats = await bench_slow_afe(use_afe_rx_tasks)
+        print("BENCH:   {:32s} {} frames, latency avg {} us max {} us".format(
+            label, stats["frames"], stats["latency_avg_us"], stats["latency_max_us"]))
+
+
+    print("BENCH: AFE lookup per frame and discovery online check (ns per call)")
+    for n_afe in (8, 64, 255):
+        stats = bench_afe_lookup(n_afe)
+        print("BENCH:   {:3d} AFEs  get_afe_by_id linear {:8.0f} registry {:5.0f}   online check linear {:8.0f} bitset {:5.0f}".format(
+            n_afe, stats["lookup_linear_ns"], stats["lookup_registry_ns"],
+            stats["online_linear_ns"], stats["online_registry_ns"]))
+
+
+    print("BENCH: manage_state scheduling, watchdog poll only (per second over 5 s)")
+    for n_afe in (8, 64):
+        for label, use_afe_scheduler in (("every AFE every pass (before)", False),
+                                         ("deadline heap (after)", True)):
+            stats = await bench_manage_scheduler(use_afe_scheduler, n_afe)
+            print("BENCH:   {:3d} AFEs {:30s} manage_state {:6d}/s, passes {:4d}/s, {:5.1f}% CPU".format(
+                n_afe, label, stats["manage_per_s"], stats["passes_per_s"], stats["cpu_percent"]))
+
+
+    print("BENCH: discovery of 8 AFEs among IDs 1..99, 1 frame/ms on the bus, probes over 5 s")
+    for label, use_discovery_window, tx_delay_ms in (("one probe per 100 ms (before)", False, 100),
+                                                    ("one probe per 1 ms (before)", False, 1),
+                                                    ("windowed bursts (after)", True, 1)):
+        stats = await bench_discovery(use_discovery_window, tx_delay_ms)
+        print("BENCH:   {:32s} found {}/8, all found after {} ms, sweep done after {} ms, probes sent {}".format(
+            label, stats["found"], stats["found_ms"] if stats["found_ms"] is not None else "-",
+            stats["sweep_ms"] if stats["sweep_ms"] is not None else "-", stats["probes"]))
+
+
+    print("BENCH: calibration of 60 AFEs")
+    for label, use_store in (("CSV files parsed per AFE (before)", False),
+                             ("CalibrationStore (after)", True)):
+        stats = await bench_calibration_load(use_store)
+        print("BENCH:   {:34s} {:7.1f} ms, CSV files parsed {}".format(
+            label, stats["elapsed_ms"], stats["csv_parses"]))
+
+    print("BENCH: default_procedure planning per AFE (configuration already loaded)")
+    for label, mode in (("elif chain per key (before)", "legacy"),
+                        ("compile plan every time", "compile"),
+                        ("cached plan replayed (after)", "cached")):
+        stats = await bench_config_plan(mode)
+        print("BENCH:   {:32s} {:7.0f} us/AFE, {} frames/AFE, plans built {}, reused {}".format(
+            label, stats["us_per_afe"], stats["frames_per_afe"], stats["builds"], stats["hits"]))
+
+
+    print("BENCH: default_procedure of one AFE, echo reply after 5 ms, HUB sends 1 frame/ms")
+    for label, pipeline_depth in (("stop-and-wait (before)", 1),
+                                  ("2 commands in flight", 2),
+                                  ("4 commands in flight (after)", 4),
+                                  ("8 commands in flight", 8)):
+        stats = await bench_configure_pipeline(pipeline_depth)
+        print("BENCH:   {:32s} {} commands in {} ms, errors {}".format(
+            label, stats["commands"], stats["elapsed_ms"], stats["errors"]))
+
+
+    print("BENCH: automatic configuration of 8 AFEs, replies after 5 ms, HUB sends 1 frame/ms")
+    for label, use_config_tasks, config_concurrency in (("default_full inline (before)", False, 0),
+                                                        ("tasks, 1 at a time", True, 1),
+                                                        ("tasks, 4 at a time (after)", True, 4),
+                                                        ("tasks, 8 at a time", True, 8)):
+        stats = await bench_fleet_bringup(use_config_tasks, config_concurrency)
+        print("BENCH:   {:32s} {}/8 configured in {} ms (first {} ms, median {} ms), longest main_process pass {:.1f} ms".format(
+            label, stats["configured"], stats["elapsed_ms"], stats["first_ms"], stats["median_ms"], stats["pass_max_ms"]))
+    print("BENCH: the same with AFE 32 answering after 200 ms; times of the 7 others")
+    for label, use_config_tasks, config_concurrency in (("default_full inline (before)", False, 0),
+                                                        ("tasks, 1 at a time", True, 1),
+                                                        ("tasks, 4 at a time (after)", True, 4)):
+        stats = await bench_fleet_bringup(use_config_tasks, config_concurrency, slow_afe_ids=(32,))
+        print("BENCH:   {:32s} first {} ms, median {} ms, last {} ms, all 8 in {} ms, longest main_process pass {:.1f} ms".format(
+            label, stats["first_ms"], stats["median_ms"], stats["last_ms"], stats["elapsed_ms"], stats["pass_max_ms"]))
+
+
+    print("BENCH: getSerialNumber on 16 AFEs at once, replies after 5 ms")
+    for label, use_futures in (("callback + Event per AFE (before)", False),
+                               ("query_afes futures (after)", True)):
+        stats = await bench_query_afes(use_futures)
+        print("BENCH:   {:34s} {}/16 answered in {} ms, {} tasks created".format(
+            label, stats["answered"], stats["elapsed_ms"], stats["tasks"]))
+
+
+    print("BENCH: AFE clock 80 ppm fast, sync replies 0..3 ms late, 1 h, timestamp converted every 1 s")
+    for label, use_clock_model in (("last sync pair, 2 s polls (before)", False),
+                                   ("ClockModel, adaptive polls (after)", True)):
+        stats = bench_clock_model(use_clock_model)
+        print("BENCH:   {:36s} {} syncs, error max {} ms rms {:.1f} ms{}".format(
+            label, stats["syncs"], stats["max_error_ms"], stats["rms_error_ms"],
+            ", fit {:.0f} us/sync, drift {:.1f} ppm".format(stats["fit_us"], stats["drift_ppm"]) if use_clock_model else ""))
+
+
+    print("BENCH: getTimestamp replies decoded 0..20 ms after the RX IRQ, 40 syncs")
+    for label, use_capture_time in (("decode time (before)", False),
+                                    ("RX IRQ capture time (after)", True)):
+        stats = bench_clock_decode_delay(use_capture_time)
+        print("BENCH:   {:36s} error max {} ms, fit rms {:.1f} ms, drift {:.0f} ppm, certain {}".format(
+            label, stats["max_error_ms"], stats["rms_ms"], stats["drift_ppm"], stats["certain"]))
+
+
+    print("BENCH: HUB ADC, 3 channels, 8 counts of noise per sample, 200 readings")
+    for label, use_sampler in (("single ADC.read() (before)", False),
+                               ("HubADCSampler, 16-sample bursts (after)", True)):
+        stats = bench_hub_adc(use_sampler)
+        print("BENCH:   {:40s} U_SIPM_MEAS spread {:.1f} mV, {:.0f} us CPU, {:.0f} us wall per reading".format(
+            label, stats["std_mv"], stats["cpu_us"], stats["wall_us"]))
+    print("BENCH: HUB ADC bursts of 16 samples at 10 kHz next to a task that only yields, 50 bursts")
+    for label, use_timer_irq in (("read_timed_multi (before)", False),
+                                 ("timer callback + ThreadSafeFlag (after)", True)):
+        stats = await bench_hub_adc_stall(use_timer_irq)
+        print("BENCH:   {:40s} other task gap max {:.0f} us, sampler CPU max {} us per burst, spread {:.1f} mV".format(
+            label, stats["gap_max_us"], stats["burst_us_max"], stats["std_mv"]))
+
+
+    print("BENCH: AFE command queue, depth 100; 500 commands with one taken every 5 ms")
+    for label, use_ring in (("list of dicts, pop(0) (before)", False),
+                            ("CommandQueue ring of records (after)", True)):
+        stats = await bench_command_queue(use_ring)
+        print("BENCH:   {:38s} {:.1f} us per enqueue+dequeue, {:.1f} heap blocks held per queued command, "
+              "producer woke {} times while full".format(
+                  label, stats["us_per_command"], stats["blocks_per_command"], stats["producer_wakeups"]))
+
+
+    stats = await bench_reply_decoder()
+    print("BENCH: reply decoder over a recorded mix of {} replies: {:.1f} us per frame".format(
+        stats["frames"], stats["us_per_frame"]))
+    for command, us in sorted(stats["per_command_us"].items()):
+        print("BENCH:   0x{:02X} {:6.1f} us".format(command, us))
+
+    stats = bench_decode_alloc()
+    print("BENCH: reply decoders over {} single-value frames: {:.1f} heap bytes and {:.2f} us per decoded value".format(
+        stats["values"], stats["bytes_per_value"], stats["us_per_value"]))
+
+    print("BENCH: getSensorDataSi_periodic set of 8 channels into the MeasurementStore")
+    stats = await bench_periodic_store()
+    for label, save_periodic_data in (("with log entry (opt-in)", True),
+                                      ("without log entry (default)", False)):
+        print("BENCH:   {:28s} {:5.1f} us and {:4.0f} heap bytes per set".format(
+            label, stats[save_periodic_data]["us_per_set"], stats[save_periodic_data]["bytes_per_set"]))
+    print("BENCH:   web views of the newest values {:.0f} us".format(stats["view_us"]))
+
+    print("BENCH: 1 h of periodic sets every 1 s, then the 1 min trend of all 8 channels")
+    for label, use_rollups in (("scan of the log lines (before)", False),
+                               ("MeasurementRollups (after)", True)):
+        stats = await bench_rollups(use_rollups)
+        print("BENCH:   {:32s} {:5.1f} us per set, trend of {} rows in {:6.1f} ms from {} bytes".format(
+            label, stats["us_per_set"], stats["rows"], stats["query_ms"], stats["bytes"]))
+
+
+if __name__ == "__main__":
+    uasyncio.run(main())
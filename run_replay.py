@@ -0,0 +1,138 @@
+# run_replay.py
+# Feeds a CAN capture written by RxDeviceCAN.start_capture() back into
+# RxDeviceCAN / HUBDevice under micropython_sim.
+#
+#   python3 run_replay.py capture.bin              # original timing
+#   python3 run_replay.py capture.bin --speed 10   # 10x faster
+#   python3 run_replay.py capture.bin --speed 0    # as fast as the HUB decodes
+#   python3 run_replay.py capture.bin --synthetic 8 2
+#       first records 2 s of telemetry from 8 AFEs into capture.bin
+import argparse
+import time as host_time  # host clock, before the sim replaces 'time'
+import struct
+
+from run_benchmark import BenchCAN, make_hub, stop_hub, periodic_frames
+import time  # utime_compat after micropython_sim is imported
+import uasyncio
+
+from my_RxDeviceCAN import RxDeviceCAN, CAPTURE_HEADER, CAPTURE_RECORD_FORMAT, CAPTURE_RECORD_SIZE, CAPTURE_FLAG_TX
+
+TICKS_PERIOD_US = 1 << 30  # pyboard ticks_us wraps at 2**30
+
+
+def read_capture(path):
+    """Returns the records of a capture file as (ticks_us, can_id, flags, data) tuples."""
+    with open(path, "rb") as f:
+        blob = f.read()
+    if blob[:len(CAPTURE_HEADER)] != CAPTURE_HEADER:
+        raise ValueError("{} is not a CAN capture (bad header)".format(path))
+    records = []
+    for offset in range(len(CAPTURE_HEADER), len(blob) - CAPTURE_RECORD_SIZE + 1, CAPTURE_RECORD_SIZE):
+        ticks_us, can_id, dlc, flags = struct.unpack_from(CAPTURE_RECORD_FORMAT, blob, offset)
+        records.append((ticks_us, can_id, flags, bytes(blob[offset + 8:offset + 8 + dlc])))
+    return records
+
+
+async def record_synthetic(path, n_afe, seconds, period_ms=50):
+    """
+    Records telemetry of n_afe AFEs through the real capture path of
+    RxDeviceCAN: every period_ms each AFE sends its 5-frame set, 1 ms apart.
+    """
+    can_bus = BenchCAN()
+    rx = RxDeviceCAN(can_bus, use_rxcallback=False)
+    rx.start_capture(path)
+    deadline = time.ticks_add(time.ticks_ms(), int(seconds * 1000))
+    value = 0.0
+    while time.ticks_diff(deadline, time.ticks_ms()) > 0:
+        start_ms = time.ticks_ms()
+        for afe_id in range(1, n_afe + 1):
+            for frame in periodic_frames(afe_id, value):
+                can_bus.inject(*frame)
+            rx.handle_can_rx()
+            while rx.borrow() is not None:
+                rx.release()
+            await uasyncio.sleep_ms(1)
+        rx.write_capture()
+        value += 0.1
+        await uasyncio.sleep_ms(period_ms - time.ticks_diff(time.ticks_ms(), start_ms))
+    rx.stop_capture()
+    return rx.capture_frames, rx.capture_dropped
+
+
+async def replay(records, speed):
+    """
+    Injects the RX records into a HUB with no known AFEs (they are added as
+    their frames arrive) and runs HUBDevice.main_loop meanwhile.
+    speed 1 keeps the original timing, 0 feeds frames as fast as the HUB
+    consumes them.
+    """
+    can_bus, rx, hub = make_hub(0)
+    rx_records = [r for r in records if not r[2] & CAPTURE_FLAG_TX]
+    loop_task = uasyncio.create_task(hub.main_loop())
+    high_water = rx.rx_message_buffer_max_len // 2
+
+    cpu_start = host_time.process_time()
+    start_ms = time.ticks_ms()
+    elapsed_capture_us = 0
+    prev_ticks = rx_records[0][0] if rx_records else 0
+    for ticks_us, can_id, flags, data in rx_records:
+        elapsed_capture_us += (ticks_us - prev_ticks) % TICKS_PERIOD_US
+        prev_ticks = ticks_us
+        if speed > 0:
+            due_ms = int(elapsed_capture_us / speed / 1000)
+            wait_ms = due_ms - time.ticks_diff(time.ticks_ms(), start_ms)
+            if wait_ms > 0:
+                rx.handle_can_rx()
+                await uasyncio.sleep_ms(wait_ms)
+        else:
+            while rx.pending() >= high_water:
+                await uasyncio.sleep_ms(0)
+        can_bus.inject(can_id, data)
+        if len(can_bus.rx) >= 3:  # bxCAN FIFO depth
+            rx.handle_can_rx()
+            await uasyncio.sleep_ms(0)  # The HUB runs between FIFO interrupts
+    rx.handle_can_rx()
+    while rx.pending():
+        await uasyncio.sleep_ms(1)
+    elapsed_ms = time.ticks_diff(time.ticks_ms(), start_ms)
+    cpu_s = host_time.process_time() - cpu_start
+    hub.run = False
+    rx.wake()
+    await uasyncio.sleep_ms(5)
+    loop_task.cancel()
+    stop_hub(hub)
+    stats = rx.get_stats()
+    return {
+        "frames": len(rx_records),
+        "tx_frames": len(records) - len(rx_records),
+        "capture_ms": elapsed_capture_us // 1000,
+        "elapsed_ms": elapsed_ms,
+        "cpu_s": cpu_s,
+        "afe_ids": sorted(afe.device_id for afe in hub.afe_devices),
+        "rx_overwritten": stats["rx_overwritten"] + stats["rx_telemetry_overwritten"],
+        "afe_rx_dropped": stats["afe_rx_dropped"],
+    }
+
+
+async def main(args):
+    if args.synthetic:
+        n_afe, seconds = args.synthetic
+        frames, dropped = await record_synthetic(args.capture, int(n_afe), float(seconds))
+        print("REPLAY: recorded {} frames ({} dropped) to {}".format(frames, dropped, args.capture))
+    records = read_capture(args.capture)
+    print("REPLAY: {} records from {}, speed {}".format(len(records), args.capture, args.speed or "max"))
+    stats = await replay(records, args.speed)
+    print("REPLAY: {} RX frames ({} TX skipped) spanning {} ms replayed in {} ms, {:.3f} s CPU, {} frames/s".format(
+        stats["frames"], stats["tx_frames"], stats["capture_ms"], stats["elapsed_ms"], stats["cpu_s"],
+        int(stats["frames"] * 1000 / stats["elapsed_ms"]) if stats["elapsed_ms"] else 0))
+    print("REPLAY: AFEs {}, ring overwritten {}, AFE queue dropped {}".format(
+        stats["afe_ids"], stats["rx_overwritten"], stats["afe_rx_dropped"]))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay a RxDeviceCAN capture under micropython_sim")
+    parser.add_argument("capture")
+    parser.add_argument("--speed", type=float, default=1.0, help="time scale, 0 = as fast as possible")
+    parser.add_argument("--synthetic", nargs=2, metavar=("N_AFE", "SECONDS"),
+                        help="record synthetic telemetry into CAPTURE first")
+    uasyncio.run(main(parser.parse_args()))